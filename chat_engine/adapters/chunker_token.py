@@ -1,61 +1,102 @@
 from __future__ import annotations
 
+import hashlib
 from dataclasses import dataclass
-from typing import Sequence, List
-from uuid import uuid4
+from typing import Iterable, Iterator, List, Optional
 
 from chat_engine.domain.rag_models import LoadedPage, DocumentChunk
 from chat_engine.ports.chunker import Chunker
-from chat_engine.ports.tokens import TokenCounter
+from chat_engine.ports.tokens import TokenCounter, TokenOffsets
+
+_SENTENCE_END = ".!?…"
+
+
+def chunk_id(source: str, page: Optional[int], start: int, text: str) -> str:
+    """id из содержимого и места чанка: повторный ingest того же текста даёт те же id (upsert, а не дубль)."""
+    key = f"{source}\0{'' if page is None else page}\0{start}\0{text}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def _at_space(text: str, pos: int) -> bool:
+    return text[pos - 1].isspace() or text[pos].isspace()
+
+
+def _at_sentence_end(text: str, pos: int) -> bool:
+    k = pos
+    while k > 0 and text[k - 1].isspace():
+        k -= 1
+    return k > 0 and text[k - 1] in _SENTENCE_END
+
+
+def _snap_end(text: str, bounds: List[int], lo: int, hi: int) -> int:
+    """Граница токена j в (lo, hi]: ближайшая к hi после конца предложения, иначе на пробеле, иначе hi."""
+    space = 0
+    for j in range(hi, lo, -1):
+        pos = bounds[j]
+        if not _at_space(text, pos):
+            continue
+        if _at_sentence_end(text, pos):
+            return j
+        space = space or j
+    return space or hi
+
+
+def _snap_start(text: str, bounds: List[int], lo: int, hi: int) -> int:
+    """Первая граница токена на пробеле в [lo, hi) — перекрытие не начинается с середины слова."""
+    for j in range(lo, hi):
+        if _at_space(text, bounds[j]):
+            return j
+    return lo
 
-def _new_id() -> str:
-    return uuid4().hex
 
 @dataclass
 class TokenChunker(Chunker):
+    """
+    Окна по chunk_tokens токенов самого счётчика: страница токенизируется один раз (token_offsets),
+    конец окна сдвигается назад к концу предложения, иначе к пробелу — не дальше половины окна.
+    DocumentChunk.tokens — число токенов окна, без повторного подсчёта.
+    Счётчик без token_offsets: оценка 4 символа на токен и count_text на каждый чанк.
+    """
     counter: TokenCounter
     chunk_tokens: int = 800
     overlap_tokens: int = 120
 
-    def chunk(self, pages: Sequence[LoadedPage]) -> Sequence[DocumentChunk]:
-        chunks: List[DocumentChunk] = []
-        max_chars = max(200, self.chunk_tokens * 4)
-        overlap_chars = max(0, min(self.overlap_tokens * 4, max_chars - 1))
-
+    def chunk(self, pages: Iterable[LoadedPage]) -> Iterator[DocumentChunk]:
+        size = max(1, int(self.chunk_tokens))
+        overlap = max(0, min(int(self.overlap_tokens), size - 1))
+        exact = isinstance(self.counter, TokenOffsets)
 
         for pg in pages:
             text = (pg.text or "").strip()
             if not text:
                 continue
 
-            pos = 0
-            n = len(text)
-
-            while pos < n:
-                end = min(n, pos + max_chars)
+            # bounds[i] — начало i-го токена в символах, bounds[n] — конец текста
+            bounds = self.counter.token_offsets(text) if exact else list(range(0, len(text), 4))  # type: ignore[attr-defined]
+            n = len(bounds)
+            bounds = list(bounds) + [len(text)]
 
-                if end < n:
-                    cut = text.rfind(" ", pos, end)
-                    if cut != -1 and cut > pos + 50:
-                        end = cut
+            s = 0
+            while s < n:
+                e = min(n, s + size)
+                if e < n:
+                    e = _snap_end(text, bounds, s + size // 2, e)
 
-                chunk_text = text[pos:end].strip()
+                raw = text[bounds[s]:bounds[e]]
+                chunk_text = raw.strip()
                 if chunk_text:
-                    tok = self.counter.count_text(chunk_text)
-                    chunks.append(
-                        DocumentChunk(
-                            id=_new_id(),
-                            text=chunk_text,
-                            source=pg.source,
-                            page=pg.page,
-                            tokens=tok,
-                            meta={},
-                        )
+                    start = bounds[s] + len(raw) - len(raw.lstrip())
+                    yield DocumentChunk(
+                        id=chunk_id(pg.source, pg.page, start, chunk_text),
+                        text=chunk_text,
+                        source=pg.source,
+                        page=pg.page,
+                        tokens=e - s if exact else self.counter.count_text(chunk_text),
+                        # позиция в тексте страницы — по ней RAG склеивает перекрывающиеся соседние чанки
+                        meta={"start": start, "end": start + len(chunk_text)},
                     )
 
-                if end >= n:
+                if e >= n:
                     break
 
-                pos = max(0, end - overlap_chars)
-
-        return chunks
+                s = _snap_start(text, bounds, max(s + 1, e - overlap), e) if overlap else e
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import random
+import re
+import sqlite3
+import zlib
+from array import array
+from pathlib import Path
+from threading import Lock
+from typing import List, Optional, Sequence, Set
+
+from chat_engine.adapters.vector_store_json import _chunk_from_dict, _chunk_to_dict
+from chat_engine.domain.rag_models import DocumentChunk
+from chat_engine.ports.near_duplicates import NearDuplicateIndex
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_PRIME = (1 << 61) - 1
+_IN_BATCH = 500
+
+
+def _shingles(text: str, k: int) -> Set[int]:
+    """crc32 от k-грамм слов (регистр и пунктуация не важны); короткий текст — одна k-грамма из всех слов."""
+    words = _WORD_RE.findall((text or "").lower())
+    if not words:
+        return {zlib.crc32((text or "").encode("utf-8"))}
+    grams = [" ".join(words[i : i + k]) for i in range(max(1, len(words) - k + 1))]
+    return {zlib.crc32(g.encode("utf-8")) for g in grams}
+
+
+class MinHashLshIndex(NearDuplicateIndex):
+    """
+    MinHash-сигнатуры чанков + LSH по полосам в одном sqlite-файле.
+    Сигнатура — num_perm минимумов хэшей (a*x + b) mod p по шинглам; доля совпавших позиций двух
+    сигнатур оценивает коэффициент Жаккара их множеств шинглов. В LSH попадают только канонические
+    чанки: bands полос по num_perm/bands позиций, кандидат — совпадение хотя бы одной полосы,
+    после чего похожесть проверяется по полной сигнатуре (threshold).
+    Сигнатура — array("Q"); numpy (если есть) только ускоряет её расчёт, результат тот же.
+    Группы, выросшие с последней перезаписи канонического чанка, помечены в таблице stale.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        threshold: float = 0.85,
+        num_perm: int = 128,
+        bands: int = 16,
+        shingle: int = 3,
+        seed: int = 1,
+    ):
+        if num_perm % bands:
+            raise ValueError(f"num_perm={num_perm} must be divisible by bands={bands}")
+        self.path = str(path)
+        self.threshold = float(threshold)
+        self.num_perm = int(num_perm)
+        self.bands = int(bands)
+        self.shingle = max(1, int(shingle))
+        # a < 2^31, x < 2^32: a*x + b не переполняет uint64; seed фиксирован — сигнатуры на диске стабильны
+        rng = random.Random(seed)
+        self._a = [rng.randrange(1, 1 << 31) for _ in range(self.num_perm)]
+        self._b = [rng.randrange(0, 1 << 31) for _ in range(self.num_perm)]
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " id TEXT PRIMARY KEY, canonical TEXT NOT NULL, source TEXT NOT NULL,"
+            " sig BLOB NOT NULL, chunk TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS chunks_canonical ON chunks (canonical)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, key BLOB NOT NULL, id TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS bands_key ON bands (band, key)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS bands_id ON bands (id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS stale (id TEXT PRIMARY KEY)")
+        self._db.commit()
+
+    def signature(self, text: str) -> "array[int]":
+        xs = sorted(_shingles(text, self.shingle))
+        try:
+            import numpy as np
+        except ImportError:
+            return array("Q", (min((a * x + b) % _PRIME for x in xs) for a, b in zip(self._a, self._b)))
+        x = np.asarray(xs, dtype=np.uint64)
+        a = np.asarray(self._a, dtype=np.uint64)[:, None]
+        b = np.asarray(self._b, dtype=np.uint64)[:, None]
+        return array("Q", ((a * x[None, :] + b) % np.uint64(_PRIME)).min(axis=1).astype("=u8").tobytes())
+
+    def _agreement(self, a: "array[int]", b: "array[int]") -> float:
+        return sum(x == y for x, y in zip(a, b)) / self.num_perm
+
+    def similarity(self, a: str, b: str) -> float:
+        return self._agreement(self.signature(a), self.signature(b))
+
+    def _band_keys(self, sig: "array[int]") -> List[bytes]:
+        rows = self.num_perm // self.bands
+        return [
+            hashlib.blake2b(sig[i * rows : (i + 1) * rows].tobytes(), digest_size=8).digest()
+            for i in range(self.bands)
+        ]
+
+    def _sig(self, blob: bytes) -> "array[int]":
+        return array("Q", blob)
+
+    def find(self, text: str) -> Optional[str]:
+        sig = self.signature(text)
+        keys = self._band_keys(sig)
+        with self._lock:
+            where = " OR ".join("(band = ? AND key = ?)" for _ in keys)
+            params = [p for band, key in enumerate(keys) for p in (band, key)]
+            cands = [r[0] for r in self._db.execute(f"SELECT DISTINCT id FROM bands WHERE {where}", params)]
+            best, best_sim = None, self.threshold
+            for i in range(0, len(cands), _IN_BATCH):
+                part = cands[i : i + _IN_BATCH]
+                rows = self._db.execute(
+                    f"SELECT id, sig FROM chunks WHERE id IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for cid, blob in rows:
+                    sim = self._agreement(self._sig(blob), sig)
+                    if sim >= best_sim:
+                        best, best_sim = cid, sim
+        return best
+
+    def add(self, chunk: DocumentChunk, canonical_id: Optional[str] = None) -> None:
+        sig = self.signature(chunk.text)
+        canonical = canonical_id or chunk.id
+        with self._lock:
+            self._db.execute("DELETE FROM bands WHERE id = ?", (chunk.id,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO chunks (id, canonical, source, sig, chunk) VALUES (?, ?, ?, ?, ?)",
+                (chunk.id, canonical, (chunk.source or "").lower(), sig.tobytes(),
+                 json.dumps(_chunk_to_dict(chunk), ensure_ascii=False)),
+            )
+            if canonical == chunk.id:
+                self._insert_bands(chunk.id, sig)
+            else:
+                self._db.execute("INSERT OR IGNORE INTO stale (id) VALUES (?)", (canonical,))
+            self._db.commit()
+
+    def stale(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT id FROM stale ORDER BY rowid")]
+
+    def rewritten(self, canonical_ids: Sequence[str]) -> None:
+        ids = list(canonical_ids)
+        with self._lock:
+            for i in range(0, len(ids), _IN_BATCH):
+                part = ids[i : i + _IN_BATCH]
+                self._db.execute(f"DELETE FROM stale WHERE id IN ({','.join('?' * len(part))})", part)
+            self._db.commit()
+
+    def _insert_bands(self, chunk_id: str, sig: "array[int]") -> None:
+        self._db.executemany(
+            "INSERT INTO bands (band, key, id) VALUES (?, ?, ?)",
+            [(band, key, chunk_id) for band, key in enumerate(self._band_keys(sig))],
+        )
+
+    def group(self, canonical_id: str) -> List[DocumentChunk]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chunk FROM chunks WHERE canonical = ? ORDER BY (id != canonical), rowid", (canonical_id,)
+            ).fetchall()
+        return [_chunk_from_dict(json.loads(r[0])) for r in rows]
+
+    def remove(self, chunk_ids: Sequence[str]) -> List[str]:
+        ids = list(dict.fromkeys(chunk_ids))
+        with self._lock:
+            canon = {}
+            for i in range(0, len(ids), _IN_BATCH):
+                part = ids[i : i + _IN_BATCH]
+                marks = ",".join("?" * len(part))
+                canon.update(self._db.execute(f"SELECT id, canonical FROM chunks WHERE id IN ({marks})", part))
+                self._db.execute(f"DELETE FROM chunks WHERE id IN ({marks})", part)
+                self._db.execute(f"DELETE FROM bands WHERE id IN ({marks})", part)
+            touched = self._regroup(set(canon.values()))
+            self._db.commit()
+        return touched
+
+    def remove_source(self, source: str) -> List[str]:
+        with self._lock:
+            key = (source or "").lower()
+            groups = {r[0] for r in self._db.execute("SELECT canonical FROM chunks WHERE source = ?", (key,))}
+            self._db.execute("DELETE FROM bands WHERE id IN (SELECT id FROM chunks WHERE source = ?)", (key,))
+            self._db.execute("DELETE FROM chunks WHERE source = ?", (key,))
+            touched = self._regroup(groups)
+            self._db.commit()
+        return touched
+
+    def _regroup(self, groups: Set[str]) -> List[str]:
+        """Группы, потерявшие чанки: выжившая каноническая — на перезапись; удалённую заменяет первый дубликат."""
+        touched: List[str] = []
+        for cid in sorted(groups):
+            if self._db.execute("SELECT 1 FROM chunks WHERE id = ?", (cid,)).fetchone() is not None:
+                touched.append(cid)
+                continue
+            row = self._db.execute(
+                "SELECT id, sig FROM chunks WHERE canonical = ? ORDER BY rowid LIMIT 1", (cid,)
+            ).fetchone()
+            if row is None:
+                continue
+            new_id, blob = row
+            self._db.execute("UPDATE chunks SET canonical = ? WHERE canonical = ?", (new_id, cid))
+            self._insert_bands(new_id, self._sig(blob))
+            touched.append(new_id)
+        return touched
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0])
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
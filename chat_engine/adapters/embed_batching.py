@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from threading import Condition, Event, Lock, Thread
+from typing import Any, Deque, Dict, List, Optional, Sequence
+
+from chat_engine.ports.embeddings import Embedder
+
+
+class _Histogram:
+    """Гистограмма по степеням двойки: бакет "<=N" считает значения из (N/2, N]."""
+
+    def __init__(self, max_bound: int = 1024):
+        self.bounds: List[int] = []
+        b = 1
+        while b < max_bound:
+            self.bounds.append(b)
+            b *= 2
+        self.bounds.append(b)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.n = 0
+
+    def add(self, value: int) -> None:
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.n += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        buckets = {f"<={b}": c for b, c in zip(self.bounds, self.counts) if c}
+        if self.counts[-1]:
+            buckets[f">{self.bounds[-1]}"] = self.counts[-1]
+        return {"count": self.n, "mean": (self.total / self.n) if self.n else 0.0, "buckets": buckets}
+
+
+class _Request:
+    __slots__ = ("texts", "done", "result", "error")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.done = Event()
+        self.result: Optional[List[List[float]]] = None
+        self.error: Optional[BaseException] = None
+
+
+class BatchingEmbedder(Embedder):
+    """
+    Micro-batching перед Embedder: запросы из многих потоков копятся до max_batch текстов
+    или max_wait_ms от первого в очереди, затем один вызов inner.embed, результаты раздаются обратно.
+    Батчи не меньше max_batch (индексация) идут в модель напрямую, мимо очереди.
+    Гистограммы: глубина очереди (в текстах) в момент постановки и размер батча модели.
+    """
+
+    def __init__(self, inner: Embedder, *, max_batch: int = 32, max_wait_ms: float = 2.0):
+        self.inner = inner
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._cv = Condition(Lock())
+        self._queue: Deque[_Request] = deque()
+        self._queued = 0
+        self._worker: Optional[Thread] = None
+        self._closed = False
+        self._stats_lock = Lock()
+        self.queue_depth = _Histogram()
+        self.batch_size = _Histogram()
+
+    @property
+    def dim(self) -> int:
+        return self.inner.dim
+
+    @property
+    def model_name(self) -> Optional[str]:
+        return getattr(self.inner, "model_name", None)
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        texts = list(texts)
+        if not texts:
+            return []
+        if len(texts) >= self.max_batch:
+            return self._run(texts)
+
+        req = _Request(texts)
+        with self._cv:
+            if self._closed:
+                raise RuntimeError("BatchingEmbedder is closed")
+            self._queue.append(req)
+            self._queued += len(texts)
+            depth = self._queued
+            self._ensure_worker()
+            self._cv.notify()
+        with self._stats_lock:
+            self.queue_depth.add(depth)
+
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result or []
+
+    def _run(self, texts: List[str]) -> List[List[float]]:
+        with self._stats_lock:
+            self.batch_size.add(len(texts))
+        return self.inner.embed(texts)
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = Thread(target=self._loop, name="embed-batcher", daemon=True)
+            self._worker.start()
+
+    def _take(self) -> List[_Request]:
+        """Ждёт первый запрос, добирает батч до max_batch текстов или до дедлайна; вызывать под self._cv."""
+        while not self._queue and not self._closed:
+            self._cv.wait()
+        if not self._queue:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while self._queued < self.max_batch and not self._closed:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            self._cv.wait(left)
+
+        batch: List[_Request] = []
+        size = 0
+        while self._queue and (not batch or size + len(self._queue[0].texts) <= self.max_batch):
+            req = self._queue.popleft()
+            batch.append(req)
+            size += len(req.texts)
+        self._queued -= size
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            with self._cv:
+                batch = self._take()
+            if not batch:
+                return
+            try:
+                vectors = self._run([t for r in batch for t in r.texts])
+                if len(vectors) != sum(len(r.texts) for r in batch):
+                    raise RuntimeError(f"Embedder returned {len(vectors)} vectors for {sum(len(r.texts) for r in batch)} texts")
+                pos = 0
+                for r in batch:
+                    r.result = vectors[pos : pos + len(r.texts)]
+                    pos += len(r.texts)
+            except BaseException as e:  # ошибку модели получает каждый ждущий поток
+                for r in batch:
+                    r.error = e
+            for r in batch:
+                r.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "queue_depth": self.queue_depth.snapshot(),
+                "batch_size": self.batch_size.snapshot(),
+            }
+
+    def close(self) -> None:
+        """Дорабатывает очередь и останавливает поток."""
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+        if self._worker is not None:
+            self._worker.join()
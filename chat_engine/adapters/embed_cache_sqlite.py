@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import struct
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Sequence
+
+from chat_engine.adapters.rag_cache import embedder_key
+from chat_engine.ports.embedding_cache import EmbeddingCache
+from chat_engine.ports.embeddings import Embedder
+
+# sqlite ограничивает число параметров в запросе (999 в старых сборках)
+_IN_BATCH = 500
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def embedder_id(embedder: Embedder) -> str:
+    """Строковый id эмбеддера для ключа кэша (класс, модель, размерность)."""
+    return "|".join(str(p) for p in embedder_key(embedder))
+
+
+def _pack(vec: Sequence[float]) -> bytes:
+    # float64 — после чтения вектор совпадает с тем, что вернул эмбеддер, бит в бит
+    return struct.pack(f"<{len(vec)}d", *vec)
+
+
+def _unpack(blob: bytes) -> List[float]:
+    return list(struct.unpack(f"<{len(blob) // 8}d", blob))
+
+
+def _now() -> int:
+    return time.time_ns() // 1000
+
+
+class SqliteEmbeddingCache(EmbeddingCache):
+    """
+    Content-addressed кэш эмбеддингов чанков в одном sqlite-файле.
+    Ключ — (id эмбеддера, sha256 текста), поэтому повторная загрузка неизменённого документа
+    (delete_by_source + upload) не пересчитывает эмбеддинги. WAL — несколько воркеров могут
+    читать и писать один файл.
+    max_bytes ограничивает суммарный объём векторов: при превышении удаляются давно не читавшиеся
+    записи (used — время последнего обращения), пока не останется 80% лимита; 0 — без лимита.
+    Освободившиеся страницы sqlite переиспользует, так что файл перестаёт расти.
+    """
+
+    def __init__(self, path: str, *, max_bytes: int = 0):
+        self.path = str(path)
+        self.max_bytes = max(0, int(max_bytes))
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=30.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " embedder TEXT NOT NULL, digest TEXT NOT NULL, vec BLOB NOT NULL,"
+            " PRIMARY KEY (embedder, digest)) WITHOUT ROWID"
+        )
+        columns = {r[1] for r in self._db.execute("PRAGMA table_info(embeddings)")}
+        if "used" not in columns:  # файлы до лимита: всем записям — «давно»
+            self._db.execute("ALTER TABLE embeddings ADD COLUMN used INTEGER NOT NULL DEFAULT 0")
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self._db.commit()
+        self._bytes = int(self._db.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0])
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get_many(self, embedder: Embedder, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        eid = embedder_id(embedder)
+        digests = [text_digest(t) for t in texts]
+        keys = list(dict.fromkeys(digests))
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            for i in range(0, len(keys), _IN_BATCH):
+                part = keys[i : i + _IN_BATCH]
+                rows = self._db.execute(
+                    f"SELECT digest, vec FROM embeddings WHERE embedder = ? AND digest IN ({','.join('?' * len(part))})",
+                    (eid, *part),
+                ).fetchall()
+                for digest, blob in rows:
+                    found[digest] = _unpack(blob)
+            if found and self.max_bytes:
+                hit = list(found)
+                now = _now()
+                for i in range(0, len(hit), _IN_BATCH):
+                    part = hit[i : i + _IN_BATCH]
+                    self._db.execute(
+                        f"UPDATE embeddings SET used = ? WHERE embedder = ? AND digest IN ({','.join('?' * len(part))})",
+                        (now, eid, *part),
+                    )
+                self._db.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return [found.get(d) for d in digests]
+
+    def put_many(self, embedder: Embedder, texts: Sequence[str], vectors: Sequence[List[float]]) -> None:
+        if not texts:
+            return
+        eid = embedder_id(embedder)
+        now = _now()
+        rows = [(eid, text_digest(t), _pack(v), now) for t, v in zip(texts, vectors)]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (embedder, digest, vec, used) VALUES (?, ?, ?, ?)", rows
+            )
+            self._bytes += sum(len(r[2]) for r in rows)  # замены считаются дважды — _prune пересчитает
+            if self.max_bytes and self._bytes > self.max_bytes:
+                self._prune()
+            self._db.commit()
+
+    def _prune(self) -> None:
+        """Под локом: удаляет самые давно использованные записи до 80% max_bytes."""
+        self._bytes = int(self._db.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0])
+        excess = self._bytes - int(self.max_bytes * 0.8)
+        if excess <= 0:
+            return
+        freed, cutoff = 0, None
+        for used, size in self._db.execute("SELECT used, LENGTH(vec) FROM embeddings ORDER BY used"):
+            freed += int(size)
+            cutoff = used
+            if freed >= excess:
+                break
+        self.evicted += self._db.execute("DELETE FROM embeddings WHERE used <= ?", (cutoff,)).rowcount
+        self._bytes = int(self._db.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0])
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evicted": self.evicted, "bytes": self._bytes}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -3,13 +3,16 @@ from __future__ import annotations
 import hashlib
 import math
 import re
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
 from collections.abc import Sequence
 
-from chat_engine.ports.embeddings import Embedder
+from chat_engine.domain.rag_models import SparseVector
+from chat_engine.ports.embeddings import SparseEmbedder
 
 _WORD_RE = re.compile(r"\w+", re.UNICODE)
+# словарь token -> (bucket, sign) растёт со словарём корпуса; при переполнении просто сбрасывается
+_TOKEN_CACHE_MAX = 1 << 20
 
 
 def _l2_normalize(vec: List[float]) -> List[float]:
@@ -20,22 +23,86 @@ def _l2_normalize(vec: List[float]) -> List[float]:
 
 
 @dataclass
-class HashingEmbedder(Embedder):
+class HashingEmbedder(SparseEmbedder):
+    """
+    Feature hashing: md5(token) -> (bucket, ±1), сумма по токенам, L2-нормировка.
+    md5 считается один раз на уникальный токен (кэш), батч собирается одной матрицей через
+    scatter-add (numpy, если установлен). Векторы совпадают с поэлементным вариантом бит в бит:
+    суммы целые, нормировка в float64.
+    embed_sparse отдаёт те же векторы разреженно: память O(токенов), а не O(dim), так что _dim
+    можно делать большим (2**18 и выше) без плотных матриц.
+    """
+
     _dim: int = 256
+    _token_cache: Dict[str, Tuple[int, float]] = field(default_factory=dict, repr=False, compare=False)
 
     @property
     def dim(self) -> int:
         return self._dim
 
+    def _hash(self, token: str) -> Tuple[int, float]:
+        hit = self._token_cache.get(token)
+        if hit is None:
+            h = hashlib.md5(token.encode("utf-8")).digest()
+            hit = (int.from_bytes(h[:4], "little") % self._dim, 1.0 if (h[4] & 1) == 1 else -1.0)
+            if len(self._token_cache) >= _TOKEN_CACHE_MAX:
+                self._token_cache.clear()
+            self._token_cache[token] = hit
+        return hit
+
+    def embed_matrix(self, texts: Sequence[str]):
+        """Батч -> numpy-матрица (len(texts) x dim, float64) с L2-нормированными строками."""
+        import numpy as np
+
+        rows: List[int] = []
+        cols: List[int] = []
+        signs: List[float] = []
+        for row, text in enumerate(texts):
+            for t in _WORD_RE.findall((text or "").lower()):
+                col, sign = self._hash(t)
+                rows.append(row)
+                cols.append(col)
+                signs.append(sign)
+
+        n, dim = len(texts), self._dim
+        flat = np.asarray(rows, dtype=np.int64) * dim + np.asarray(cols, dtype=np.int64)
+        mat = np.bincount(flat, weights=np.asarray(signs, dtype=np.float64), minlength=n * dim).reshape(n, dim)
+        norms = np.sqrt((mat * mat).sum(axis=1))
+        nz = norms > 0.0
+        mat[nz] /= norms[nz, None]
+        return mat
+
     def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        try:
+            return self.embed_matrix(texts).tolist()
+        except ImportError:
+            pass
+
         out: List[List[float]] = []
         for text in texts:
-            toks = _WORD_RE.findall((text or "").lower())
             vec = [0.0] * self._dim
-            for t in toks:
-                h = hashlib.md5(t.encode("utf-8")).digest()
-                idx = int.from_bytes(h[:4], "little") % self._dim
-                sign = 1.0 if (h[4] & 1) == 1 else -1.0
+            for t in _WORD_RE.findall((text or "").lower()):
+                idx, sign = self._hash(t)
                 vec[idx] += sign
             out.append(_l2_normalize(vec))
         return out
+
+    def embed_sparse(self, texts: Sequence[str]) -> List[SparseVector]:
+        out: List[SparseVector] = []
+        for text in texts:
+            acc: Dict[int, float] = {}
+            for t in _WORD_RE.findall((text or "").lower()):
+                idx, sign = self._hash(t)
+                acc[idx] = acc.get(idx, 0.0) + sign
+            nz = sorted((i, v) for i, v in acc.items() if v != 0.0)
+            norm = math.sqrt(sum(v * v for _, v in nz))
+            out.append(
+                SparseVector(
+                    dim=self._dim,
+                    indices=tuple(i for i, _ in nz),
+                    values=tuple(v / norm for _, v in nz),
+                )
+            )
+        return out
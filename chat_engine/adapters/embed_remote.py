@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import json
+import socket
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from chat_engine.ports.embeddings import Embedder
+
+# Протокол поверх Unix-сокета: кадры <u32 big-endian длина><payload>.
+#   запрос  — JSON {"op": "embed", "texts": [...]} или {"op": "info"};
+#   ответ   — JSON-заголовок {"ok": true, "n": N, "dim": D} + кадр с N*D float64 (little-endian)
+#             для embed, только заголовок для info; {"ok": false, "error": "..."} при ошибке.
+_LEN = struct.Struct(">I")
+
+
+def send_frame(sock: socket.socket, payload: bytes) -> None:
+    sock.sendall(_LEN.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        part = sock.recv(n - len(buf))
+        if not part:
+            raise ConnectionError("Embedding server closed the connection")
+        buf += part
+    return bytes(buf)
+
+
+def recv_frame(sock: socket.socket) -> bytes:
+    (n,) = _LEN.unpack(_recv_exact(sock, _LEN.size))
+    return _recv_exact(sock, n)
+
+
+def pack_vectors(vectors: Sequence[Sequence[float]]) -> Tuple[int, bytes]:
+    dim = len(vectors[0]) if vectors else 0
+    return dim, struct.pack(f"<{len(vectors) * dim}d", *(x for v in vectors for x in v))
+
+
+def unpack_vectors(blob: bytes, n: int, dim: int) -> List[List[float]]:
+    flat = struct.unpack(f"<{n * dim}d", blob)
+    return [list(flat[i * dim : (i + 1) * dim]) for i in range(n)]
+
+
+class RemoteEmbedder(Embedder):
+    """
+    Клиент embedding-сервера (chat_engine.app.embed_server) на том же хосте: модель загружена один раз
+    в процессе сервера, воркеры uvicorn ходят к нему через Unix-сокет. Соединение — своё на каждый поток;
+    оборванное соединение переоткрывается один раз (таймаут — нет).
+    """
+
+    def __init__(self, socket_path: str, *, timeout: float = 30.0):
+        self.socket_path = str(socket_path)
+        self.timeout = float(timeout)
+        self._local = threading.local()
+        self._info: Optional[Dict[str, Any]] = None
+
+    # ---------- transport ----------
+
+    def _connect(self) -> socket.socket:
+        """
+        connect в блокирующем режиме: AF_UNIX-сокет с таймаутом при полном backlog сервера сразу падает
+        с EAGAIN, а блокирующий ждёт accept. EAGAIN/ECONNREFUSED (сервер перезапускается) — повтор
+        с экспоненциальной паузой в пределах timeout; таймаут на чтение/запись ставится после connect.
+        """
+        deadline = time.monotonic() + self.timeout
+        delay = 0.005
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except (BlockingIOError, ConnectionRefusedError, InterruptedError):
+                sock.close()
+                if time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            sock.settimeout(self.timeout)
+            return sock
+
+    def _drop(self) -> None:
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _call(self, request: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[bytes]]:
+        payload = json.dumps(request, ensure_ascii=False).encode("utf-8")
+        for attempt in (0, 1):
+            sock = getattr(self._local, "sock", None)
+            try:
+                if sock is None:
+                    sock = self._local.sock = self._connect()
+                send_frame(sock, payload)
+                header = json.loads(recv_frame(sock).decode("utf-8"))
+                body = recv_frame(sock) if header.get("ok") and request.get("op") == "embed" else None
+            except (ConnectionError, FileNotFoundError):
+                # обрыв (сервер перезапустился, сокет пересоздаётся) — повтор на новом соединении
+                self._drop()
+                if attempt:
+                    raise
+                continue
+            except OSError:
+                # таймаут и прочее не лечатся повтором: он лишь удвоил бы задержку перед той же ошибкой
+                self._drop()
+                raise
+            if not header.get("ok"):
+                raise RuntimeError(f"Embedding server error: {header.get('error')}")
+            return header, body
+        raise AssertionError("unreachable")
+
+    # ---------- Embedder ----------
+
+    def info(self) -> Dict[str, Any]:
+        if self._info is None:
+            self._info, _ = self._call({"op": "info"})
+        return self._info
+
+    @property
+    def dim(self) -> int:
+        return int(self.info()["dim"])
+
+    @property
+    def model_name(self) -> Optional[str]:
+        return self.info().get("model_name")
+
+    @property
+    def remote_key(self) -> Tuple[Any, ...]:
+        """embedder_key модели на сервере: кэши общие с локальным режимом."""
+        return tuple(self.info()["key"])
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        texts = list(texts)
+        if not texts:
+            return []
+        header, body = self._call({"op": "embed", "texts": texts})
+        return unpack_vectors(body or b"", int(header["n"]), int(header["dim"]))
@@ -14,6 +14,10 @@ class SentenceTransformerEmbedder(Embedder):
         from sentence_transformers import SentenceTransformer
         self._model = SentenceTransformer(self.model_name)
 
+    @property
+    def dim(self) -> int:
+        return int(self._model.get_sentence_embedding_dimension())
+
     def embed(self, texts: Sequence[str]) -> List[List[float]]:
         vecs = self._model.encode(list(texts), normalize_embeddings=True)
         return [v.tolist() for v in vecs]
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Optional
+
+from chat_engine.adapters.vector_store_json import _atomic_write
+from chat_engine.ports.ingest_state import IngestStateStore
+
+
+class JsonlIngestStateStore(IngestStateStore):
+    """
+    файл JSONL: по строке {"source": ..., "state": {...} | null} на каждое изменение, последняя строка source побеждает.
+    put/clear — дозапись одной строки; когда устаревших строк становится много, файл переписывается целиком.
+    """
+
+    def __init__(self, path: str, *, compact_factor: int = 4):
+        self.path = Path(path)
+        self.compact_factor = max(2, int(compact_factor))
+        self._lock = Lock()
+        self._state: Optional[Dict[str, Dict[str, Any]]] = None
+        self._lines = 0
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._state is None:
+            state: Dict[str, Dict[str, Any]] = {}
+            lines = 0
+            if self.path.exists():
+                for line in self.path.read_text(encoding="utf-8").splitlines():
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # недописанная строка после падения
+                    lines += 1
+                    if isinstance(rec.get("state"), dict):
+                        state[str(rec.get("source"))] = rec["state"]
+                    else:
+                        state.pop(str(rec.get("source")), None)
+            self._state, self._lines = state, lines
+        return self._state
+
+    def _append(self, source: str, value: Optional[Dict[str, Any]]) -> None:
+        state = self._load()
+        if value is None:
+            state.pop(source, None)
+        else:
+            state[source] = value
+        if self._lines + 1 > self.compact_factor * max(16, len(state)):
+            _atomic_write(
+                self.path,
+                "".join(json.dumps({"source": s, "state": v}, ensure_ascii=False) + "\n" for s, v in state.items()),
+            )
+            self._lines = len(state)
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps({"source": source, "state": value}, ensure_ascii=False) + "\n")
+        self._lines += 1
+
+    def get(self, source: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._load().get(source)
+
+    def put(self, source: str, state: Dict[str, Any]) -> None:
+        with self._lock:
+            self._append(source, dict(state))
+
+    def clear(self, source: str) -> None:
+        with self._lock:
+            if source in self._load():
+                self._append(source, None)
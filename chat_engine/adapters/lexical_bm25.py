@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import heapq
+import json
+import math
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+from chat_engine.adapters.rwlock import RWLock
+from chat_engine.adapters.vector_store_json import (
+    _atomic_write,
+    _chunk_from_dict,
+    _chunk_to_dict,
+    _journal_paths,
+    _next_generation,
+    _OpLog,
+)
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter, is_grouped
+from chat_engine.ports.lexical_index import LexicalIndex
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _tokens(text: str) -> List[str]:
+    return _WORD_RE.findall((text or "").lower())
+
+
+class Bm25Index(LexicalIndex):
+    """
+    Инвертированный индекс с BM25 (Okapi).
+    файл JSON: { "docs": {"<chunk_id>": {"chunk": {...}, "len": N}}, "postings": {"<term>": {"<chunk_id>": tf}} }
+    Поиск трогает только постинги терминов запроса, а не все чанки.
+    Изменения дописываются в <path>.journal.jsonl (add / delete / delete_ids) и применяются при загрузке;
+    файл индекса переписывается целиком, только когда журнал перерос индекс.
+    """
+
+    def __init__(self, path: str, *, k1: float = 1.5, b: float = 0.75):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.k1 = float(k1)
+        self.b = float(b)
+        self._docs: Dict[str, DocumentChunk] = {}
+        self._lens: Dict[str, int] = {}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._by_source: Dict[str, Set[str]] = {}
+        self._grouped: Set[str] = set()  # канонические чанки групп почти-дубликатов
+        self._total_len = 0
+        self._generation = _next_generation()
+        self._rw = RWLock()  # поиски идут параллельно с фоновым ingest
+        self._log = _OpLog(_journal_paths(self.path)[0])
+        self._load()
+
+    def _load(self) -> None:
+        self._load_base()
+        if not self._log.journal.exists():
+            return
+        for line in self._log.journal.read_text(encoding="utf-8").splitlines():
+            try:
+                op = json.loads(line)
+            except ValueError:
+                continue  # недописанная последняя строка после падения
+            self._apply(op)
+
+    def _load_base(self) -> None:
+        if not self.path.exists():
+            return
+        try:
+            raw = self.path.read_text(encoding="utf-8")
+            data = json.loads(raw) if raw.strip() else {}
+        except Exception:
+            return
+        for cid, d in (data.get("docs", {}) or {}).items():
+            ch = _chunk_from_dict(d.get("chunk", {}))
+            self._docs[cid] = ch
+            self._lens[cid] = int(d.get("len", 0) or 0)
+            self._total_len += self._lens[cid]
+            self._by_source.setdefault(ch.source.lower(), set()).add(cid)
+            if is_grouped(ch.meta):
+                self._grouped.add(cid)
+        postings = data.get("postings", {})
+        self._postings = postings if isinstance(postings, dict) else {}
+
+    def _save(self) -> None:
+        data = {
+            "docs": {cid: {"chunk": _chunk_to_dict(ch), "len": self._lens[cid]} for cid, ch in self._docs.items()},
+            "postings": self._postings,
+        }
+        _atomic_write(self.path, json.dumps(data, ensure_ascii=False))
+        self._log.reset()
+
+    def _persist(self, ops: List[Dict[str, Any]]) -> None:
+        self._generation = _next_generation()
+        self._log.append(ops)
+        if self._log.due(len(self._docs)):
+            self._save()
+
+    def _apply(self, op: Dict[str, Any]) -> int:
+        if op.get("op") == "add":
+            self._add(_chunk_from_dict(op.get("chunk", {})))
+            return 1
+        if op.get("op") == "delete":
+            return self._remove_source(str(op.get("source", "")))
+        if op.get("op") == "delete_ids":
+            return self._remove_ids([str(cid) for cid in op.get("ids", [])])
+        return 0
+
+    def _add(self, ch: DocumentChunk) -> None:
+        if ch.id in self._docs:
+            self._remove(ch.id)
+        toks = _tokens(ch.text)
+        self._docs[ch.id] = ch
+        self._lens[ch.id] = len(toks)
+        self._total_len += len(toks)
+        self._by_source.setdefault(ch.source.lower(), set()).add(ch.id)
+        if is_grouped(ch.meta):
+            self._grouped.add(ch.id)
+        for term, tf in Counter(toks).items():
+            self._postings.setdefault(term, {})[ch.id] = tf
+
+    def _remove_source(self, source: str) -> int:
+        ids = self._by_source.pop(source.lower(), set())
+        for cid in list(ids):
+            self._remove(cid)
+        return len(ids)
+
+    def _remove_ids(self, chunk_ids: Sequence[str]) -> int:
+        ids = {cid for cid in chunk_ids if cid in self._docs}
+        for cid in ids:
+            self._remove(cid)
+        return len(ids)
+
+    def _remove(self, cid: str) -> None:
+        ch = self._docs.pop(cid)
+        self._total_len -= self._lens.pop(cid)
+        self._by_source.get(ch.source.lower(), set()).discard(cid)
+        self._grouped.discard(cid)
+        for term in set(_tokens(ch.text)):
+            plist = self._postings.get(term)
+            if plist is None:
+                continue
+            plist.pop(cid, None)
+            if not plist:
+                del self._postings[term]
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def count(self) -> int:
+        with self._rw.read():
+            return len(self._docs)
+
+    def add(self, chunks: Sequence[DocumentChunk]) -> None:
+        with self._rw.write():
+            if not chunks:
+                return
+            for ch in chunks:
+                self._add(ch)
+            self._persist([{"op": "add", "chunk": _chunk_to_dict(ch)} for ch in chunks])
+
+    def delete_by_source(self, source: str) -> int:
+        with self._rw.write():
+            op = {"op": "delete", "source": (source or "").lower()}
+            removed = self._apply(op)
+            if removed:
+                self._persist([op])
+            return removed
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        with self._rw.write():
+            op = {"op": "delete_ids", "ids": sorted(cid for cid in set(chunk_ids) if cid in self._docs)}
+            removed = self._apply(op)
+            if removed:
+                self._persist([op])
+            return removed
+
+    def search(self, query: str, top_k: int, *, where: Optional[SearchFilter] = None) -> List[DocumentChunk]:
+        with self._rw.read():
+            k = max(0, int(top_k))
+            n = len(self._docs)
+            if k == 0 or n == 0:
+                return []
+
+            allowed: Optional[Set[str]] = None
+            if where is not None:
+                pool = (
+                    set().union(self._grouped, *(self._by_source.get(src, set()) for src in where.sources))
+                    if where.sources is not None
+                    else set(self._docs)
+                )
+                allowed = {cid for cid in pool if where.matches_chunk(self._docs[cid])}
+                if not allowed:
+                    return []
+
+            avgdl = self._total_len / n if n else 0.0
+            scores: Dict[str, float] = {}
+            for term in set(_tokens(query)):
+                plist = self._postings.get(term)
+                if not plist:
+                    continue
+                df = len(plist)
+                idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+                for cid, tf in plist.items():
+                    if allowed is not None and cid not in allowed:
+                        continue
+                    norm = self.k1 * (1.0 - self.b + self.b * self._lens[cid] / avgdl) if avgdl else self.k1
+                    scores[cid] = scores.get(cid, 0.0) + idf * tf * (self.k1 + 1.0) / (tf + norm)
+
+            best = heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+            return [self._docs[cid] for cid, _ in best]
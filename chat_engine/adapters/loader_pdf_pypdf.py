@@ -1,22 +1,32 @@
 from __future__ import annotations
 
+import sys
 from pathlib import Path
-from typing import Sequence
+from typing import Any, Iterator
 
 from chat_engine.domain.rag_models import LoadedPage
-from chat_engine.ports.loaders import DocumentLoader
+from chat_engine.ports.loaders import PagedDocumentLoader
 
-class PdfLoaderPyPDF(DocumentLoader):
-    def load(self, path: str) -> Sequence[LoadedPage]:
-        try:
-            from pypdf import PdfReader 
-        except Exception as e:
-            raise RuntimeError("Для PDF нужен пакет pypdf: pip install pypdf") from e
 
+def _reader(path: str) -> Any:
+    try:
+        from pypdf import PdfReader
+    except Exception as e:
+        raise RuntimeError("Для PDF нужен пакет pypdf: pip install pypdf") from e
+    return PdfReader(str(path))
+
+
+class PdfLoaderPyPDF(PagedDocumentLoader):
+    def load(self, path: str) -> Iterator[LoadedPage]:
+        """Страницы извлекаются по одной, по мере того как их забирает чанкер."""
+        yield from self.load_pages(path, 0, sys.maxsize)
+
+    def page_count(self, path: str) -> int:
+        return len(_reader(path).pages)
+
+    def load_pages(self, path: str, start: int, stop: int) -> Iterator[LoadedPage]:
         p = Path(path)
-        reader = PdfReader(str(p))
-        pages: list[LoadedPage] = []
-        for i, page in enumerate(reader.pages, start=1):
-            text = page.extract_text() or ""
-            pages.append(LoadedPage(source=str(p), text=text, page=i))
-        return pages
+        reader = _reader(str(p))
+        for i in range(max(0, start), min(stop, len(reader.pages))):
+            text = reader.pages[i].extract_text() or ""
+            yield LoadedPage(source=str(p), text=text, page=i + 1)
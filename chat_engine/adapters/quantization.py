@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+from typing import Dict, Union
+
+import numpy as np
+
+
+def _kmeans_l2(data: np.ndarray, k: int, *, niter: int = 15, seed: int = 0) -> np.ndarray:
+    """Обычный (евклидов) k-means для кодбуков PQ."""
+    rng = np.random.default_rng(seed)
+    n = int(data.shape[0])
+    k = max(1, min(int(k), n))
+    centroids = data[rng.choice(n, size=k, replace=False)].astype(np.float32)
+    for _ in range(max(1, niter)):
+        d2 = (data * data).sum(1)[:, None] - 2.0 * data @ centroids.T + (centroids * centroids).sum(1)[None, :]
+        assign = np.argmin(d2, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        sizes = np.bincount(assign, minlength=k).astype(np.float32)
+        empty = sizes == 0
+        if empty.any():
+            sums[empty] = data[rng.choice(n, size=int(empty.sum()), replace=False)]
+            sizes[empty] = 1.0
+        centroids = sums / sizes[:, None]
+    return centroids.astype(np.float32)
+
+
+class ScalarQuantizer:
+    """
+    int8 на каждую координату: x ~ lo + (code + 128) * scale (lo/scale по измерениям).
+    ADC: q·x = const(q) + codes @ (q * scale), без декодирования векторов.
+    """
+
+    kind = "int8"
+    dtype = np.int8
+
+    def __init__(self, lo: np.ndarray, scale: np.ndarray):
+        self.lo = lo.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return int(self.lo.shape[0])
+
+    @classmethod
+    def train(cls, data: np.ndarray) -> "ScalarQuantizer":
+        lo = data.min(axis=0)
+        hi = data.max(axis=0)
+        scale = (hi - lo) / 255.0
+        scale[scale == 0.0] = 1.0
+        return cls(lo, scale)
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        codes = np.rint((x - self.lo) / self.scale) - 128.0
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def scores(self, codes: np.ndarray, q: np.ndarray) -> np.ndarray:
+        qs = q * self.scale
+        const = float(q @ self.lo) + 128.0 * float(qs.sum())
+        return codes.astype(np.float32) @ qs + const
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {"kind": np.asarray(self.kind), "lo": self.lo, "scale": self.scale}
+
+
+class ProductQuantizer:
+    """
+    PQ: вектор режется на m подпространств, каждое кодируется номером центроида (1 байт).
+    ADC: таблица q_j·c_j[i] (m x ksub), score = сумма табличных значений по кодам.
+    """
+
+    kind = "pq"
+    dtype = np.uint8
+
+    def __init__(self, codebooks: np.ndarray):
+        self.codebooks = codebooks.astype(np.float32)  # (m, ksub, dsub)
+
+    @property
+    def m(self) -> int:
+        return int(self.codebooks.shape[0])
+
+    @property
+    def code_size(self) -> int:
+        return self.m
+
+    @classmethod
+    def train(cls, data: np.ndarray, m: int = 8, ksub: int = 256) -> "ProductQuantizer":
+        n, dim = data.shape
+        if m <= 0 or dim % m:
+            raise ValueError(f"PQ: dim={dim} is not divisible by m={m}")
+        dsub = dim // m
+        k = max(1, min(int(ksub), 256, int(n)))
+        books = np.zeros((m, k, dsub), dtype=np.float32)
+        for j in range(m):
+            books[j] = _kmeans_l2(data[:, j * dsub : (j + 1) * dsub], k, seed=j)
+        return cls(books)
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        m, k, dsub = self.codebooks.shape
+        codes = np.zeros((x.shape[0], m), dtype=np.uint8)
+        for j in range(m):
+            sub = x[:, j * dsub : (j + 1) * dsub]
+            book = self.codebooks[j]
+            d2 = -2.0 * sub @ book.T + (book * book).sum(1)[None, :]
+            codes[:, j] = np.argmin(d2, axis=1)
+        return codes
+
+    def scores(self, codes: np.ndarray, q: np.ndarray) -> np.ndarray:
+        m, k, dsub = self.codebooks.shape
+        table = np.einsum("jkd,jd->jk", self.codebooks, q.reshape(m, dsub))
+        return table[np.arange(m)[None, :], codes.astype(np.int64)].sum(axis=1)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {"kind": np.asarray(self.kind), "codebooks": self.codebooks}
+
+
+Quantizer = Union[ScalarQuantizer, ProductQuantizer]
+
+
+def train_quantizer(kind: str, data: np.ndarray, *, pq_m: int = 8) -> Quantizer:
+    if kind == ScalarQuantizer.kind:
+        return ScalarQuantizer.train(data)
+    if kind == ProductQuantizer.kind:
+        return ProductQuantizer.train(data, m=pq_m)
+    raise ValueError(f"Unknown quantizer kind: {kind}")
+
+
+def load_quantizer(arrays) -> Quantizer:
+    kind = str(arrays["kind"])
+    if kind == ScalarQuantizer.kind:
+        return ScalarQuantizer(arrays["lo"], arrays["scale"])
+    if kind == ProductQuantizer.kind:
+        return ProductQuantizer(arrays["codebooks"])
+    raise ValueError(f"Unknown quantizer kind: {kind}")
@@ -1,13 +1,23 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Optional
+from typing import Any, Optional
 from collections.abc import Sequence
 
+from chat_engine.adapters.rag_cache import (
+    QueryEmbeddingCache,
+    QueryVector,
+    RetrievalCache,
+    embed_query,
+    normalize_query,
+    vector_fingerprint,
+)
+from chat_engine.adapters.rag_rerank import merge_adjacent, mmr_select, mmr_select_sparse
 from chat_engine.domain.models import Conversation, Message
-from chat_engine.domain.rag_models import DocumentChunk
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter, SparseVector
 from chat_engine.ports.augment import ContextAugmentor
-from chat_engine.ports.embeddings import Embedder
+from chat_engine.ports.embeddings import Embedder, SparseEmbedder
+from chat_engine.ports.lexical_index import LexicalIndex
 from chat_engine.ports.tokens import TokenCounter
 from chat_engine.ports.vector_store import VectorStore
 
@@ -26,6 +36,72 @@ def _loc(ch: DocumentChunk) -> str:
     return ch.source + (f":p{ch.page}" if ch.page else "")
 
 
+_LABEL_SOURCES = 3  # мест в подписи фрагмента; полный список — в meta["sources"] сообщения
+_LABEL_RANGES = 3  # диапазонов страниц одного источника в подписи
+
+
+def _page_ranges(pages: Sequence[int]) -> list[str]:
+    """[1, 2, 3, 7] -> ["1-3", "7"]."""
+    spans: list[list[int]] = []
+    for p in sorted(set(pages)):
+        if spans and spans[-1][1] == p - 1:
+            spans[-1][1] = p
+        else:
+            spans.append([p, p])
+    return [f"{a}-{b}" if a != b else str(a) for a, b in spans]
+
+
+def _pages_by_source(ch: DocumentChunk) -> dict[str, list[int]]:
+    """Места схлопнутого почти-дубликата (meta["sources"]): повторы одного источника — одна запись со страницами."""
+    out: dict[str, list[int]] = {}
+    for s in ch.meta.get("sources") or []:
+        pages = out.setdefault(str(s.get("source", "")), [])
+        if s.get("page"):
+            pages.append(int(s["page"]))
+    return out
+
+
+def _locs(ch: DocumentChunk, max_ranges: Optional[int] = None) -> list[str]:
+    """Все места, где встречается текст чанка: у схлопнутых почти-дубликатов — по одному на источник."""
+    if not isinstance(ch.meta.get("sources"), list) or not ch.meta["sources"]:
+        return [_loc(ch)]
+    out = []
+    for src, pages in _pages_by_source(ch).items():
+        ranges = _page_ranges(pages)
+        if max_ranges is not None and len(ranges) > max_ranges:
+            ranges = ranges[:max_ranges] + ["…"]
+        out.append(src + (f":p{','.join(ranges)}" if ranges else ""))
+    return out
+
+
+def _label(ch: DocumentChunk) -> str:
+    """Подпись фрагмента в контексте: ограничена по длине, сколько бы дубликатов ни было у чанка."""
+    locs = _locs(ch, max_ranges=_LABEL_RANGES)
+    if len(locs) > _LABEL_SOURCES:
+        locs = locs[:_LABEL_SOURCES] + [f"ещё {len(locs) - _LABEL_SOURCES}"]
+    return f"[{', '.join(locs)}]"
+
+
+def _rrf_fuse(rankings: Sequence[Sequence[DocumentChunk]], top_k: int, k: int = 60) -> list[DocumentChunk]:
+    """Reciprocal-rank fusion: score(d) = sum 1 / (k + rank_i(d))."""
+    scores: dict[str, float] = {}
+    by_id: dict[str, DocumentChunk] = {}
+    for ranking in rankings:
+        for rank, ch in enumerate(ranking, start=1):
+            scores[ch.id] = scores.get(ch.id, 0.0) + 1.0 / (k + rank)
+            by_id.setdefault(ch.id, ch)
+    best = sorted(scores, key=lambda cid: scores[cid], reverse=True)[: max(0, int(top_k))]
+    return [by_id[cid] for cid in best]
+
+
+def _insert_after_pinned(base: list[Message], msg: Message) -> list[Message]:
+    insert_at = 0
+    for i, m in enumerate(base):
+        if m.meta.get("pinned") is True:
+            insert_at = i + 1
+    return base[:insert_at] + [msg] + base[insert_at:]
+
+
 def _new_id(prefix: str) -> str:
     from uuid import uuid4
     return f"{prefix}_{uuid4().hex}"
@@ -39,6 +115,85 @@ class RagAugmentor(ContextAugmentor):
     top_k: int = 4
     max_rag_tokens: int = 250
     mode: str = "auto"  
+    lexical: Optional[LexicalIndex] = None
+    retrieval: str = "vector"  # vector | bm25 | hybrid
+    fetch_k: int = 20
+    rrf_k: int = 60
+    where: Optional[SearchFilter] = None
+    query_cache: Optional[QueryEmbeddingCache] = None
+    retrieval_cache: Optional[RetrievalCache] = None
+    mmr: bool = False  # MMR-переранжирование fetch_k кандидатов до top_k
+    mmr_lambda: float = 0.7
+    merge_chunks: bool = True  # склейка перекрывающихся соседних чанков перед упаковкой
+
+    def _embed_query(self, q: str, cache_info: dict[str, Any]) -> QueryVector:
+        if self.query_cache is None:
+            return embed_query(self.embedder, q)
+        qv, hit = self.query_cache.embed(self.embedder, q)
+        cache_info["embedding"] = {"hit": hit, **self.query_cache.stats()}
+        return qv
+
+    def _uses_lexical(self) -> bool:
+        return self.lexical is not None and self.retrieval != "vector"
+
+    def _search(self, qv: QueryVector, top_k: int) -> list[DocumentChunk]:
+        """Разреженный запрос уходит как есть только в разреженное хранилище; остальным — плотный на один поиск."""
+        if isinstance(qv, SparseVector) and not getattr(self.store, "sparse", False):
+            qv = qv.to_dense()
+        return self.store.search(qv, top_k=top_k, where=self.where)
+
+    def _retrieve(self, q: str, qv: Optional[QueryVector]) -> list[DocumentChunk]:
+        k = int(self.top_k)
+        n = max(k, int(self.fetch_k)) if self.mmr and qv is not None else k
+        if not self._uses_lexical():
+            hits = self._search(qv, n)
+        elif self.retrieval == "bm25":
+            hits = self.lexical.search(q, top_k=n, where=self.where)
+        else:
+            fetch = max(n, int(self.fetch_k))
+            dense = self._search(qv, fetch)
+            lexical = self.lexical.search(q, top_k=fetch, where=self.where)
+            hits = _rrf_fuse([dense, lexical], n, self.rrf_k)
+
+        if len(hits) > k and qv is not None:
+            hits = self._diversify(qv, hits, k)
+        return merge_adjacent(hits) if self.merge_chunks else hits
+
+    def _diversify(self, qv: QueryVector, hits: list[DocumentChunk], k: int) -> list[DocumentChunk]:
+        if isinstance(qv, SparseVector) and isinstance(self.embedder, SparseEmbedder):
+            # hashed-векторы дешевле пересчитать разреженно, чем развернуть сохранённые в dim
+            cands = self.embedder.embed_sparse([c.text for c in hits])
+            return [hits[i] for i in mmr_select_sparse(qv, cands, k, self.mmr_lambda)]
+        vecs = self.store.vectors([c.id for c in hits])
+        missing = [i for i, v in enumerate(vecs) if v is None]
+        if missing:
+            for i, v in zip(missing, self.embedder.embed([hits[i].text for i in missing])):
+                vecs[i] = v
+        return [hits[i] for i in mmr_select(qv, vecs, k, self.mmr_lambda)]
+
+    def _cache_key(self, q: str, qv: Optional[QueryVector]) -> Optional[tuple]:
+        """Ключ RetrievalCache или None, если кэшировать нельзя (хранилище не ведёт поколений)."""
+        if self.retrieval_cache is None:
+            return None
+        gens: list[int] = []
+        if qv is not None:
+            gens.append(int(getattr(self.store, "generation", 0) or 0))
+        if self._uses_lexical():
+            gens.append(int(getattr(self.lexical, "generation", 0) or 0))
+        if not gens or 0 in gens:
+            return None
+        return (
+            vector_fingerprint(qv) if qv is not None else None,
+            normalize_query(q) if self._uses_lexical() else None,
+            tuple(gens),
+            self.retrieval,
+            int(self.top_k),
+            int(self.fetch_k),
+            int(self.rrf_k),
+            int(self.max_rag_tokens),
+            self.where,
+            (self.mmr, float(self.mmr_lambda), self.merge_chunks),
+        )
 
     def augment(self, convo: Conversation, draft_context: Sequence[Message]) -> list[Message]:
         base = list(draft_context)
@@ -59,10 +214,39 @@ class RagAugmentor(ContextAugmentor):
         except Exception:
             pass
 
-        qv = self.embedder.embed([q])[0]
-        hits: list[DocumentChunk] = self.store.search(qv, top_k=int(self.top_k))
-        if not hits:
+        # сведения о кэшах кладутся в meta сообщения, а не в поля: augmentor общий для всех запросов
+        cache_info: dict[str, Any] = {}
+        qv = None if self.retrieval == "bm25" and self._uses_lexical() else self._embed_query(q, cache_info)
+
+        key = self._cache_key(q, qv)
+        if key is not None:
+            cached, hit = self.retrieval_cache.get(key)
+            cache_info["retrieval"] = {"hit": hit, **self.retrieval_cache.stats()}
+            if hit:
+                if cached is None:
+                    return base
+                text, meta = cached
+                rag_msg = Message(
+                    id=_new_id("rag"),
+                    role="system",
+                    content=text,
+                    created_at=last_user.created_at,
+                    meta={**meta, "cache": cache_info},
+                )
+                return _insert_after_pinned(base, rag_msg)
+
+        rag_msg = self._pack(self._retrieve(q, qv), last_user, cache_info)
+        if key is not None:
+            packed = None if rag_msg is None else (rag_msg.content, {k: v for k, v in rag_msg.meta.items() if k != "cache"})
+            self.retrieval_cache.put(key, packed)
+        if rag_msg is None:
             return base
+        return _insert_after_pinned(base, rag_msg)
+
+    def _pack(self, hits: Sequence[DocumentChunk], last_user: Message, cache_info: dict[str, Any]) -> Optional[Message]:
+        """Укладывает найденные чанки в один system-месседж в пределах max_rag_tokens."""
+        if not hits:
+            return None
 
         header = (
             "Релевантные фрагменты из документов (используй их при ответе). "
@@ -79,7 +263,8 @@ class RagAugmentor(ContextAugmentor):
                     "type": "retrieved_context",
                     "pinned": False,
                     "chosen": len(chosen_chunks),
-                    "sources": [_loc(c) for c in chosen_chunks],
+                    "sources": [loc for c in chosen_chunks for loc in _locs(c)],
+                    "cache": cache_info,
                 },
             )
 
@@ -87,7 +272,7 @@ class RagAugmentor(ContextAugmentor):
         parts: list[str] = [header]
 
         for ch in hits:
-            piece = f"[{_loc(ch)}]\n{(ch.text or '').strip()}\n\n"
+            piece = f"{_label(ch)}\n{(ch.text or '').strip()}\n\n"
             trial = "".join(parts) + piece
             trial_msg = make_msg(trial, chosen + [ch])
             tok = self.counter.count_messages([trial_msg])
@@ -102,13 +287,13 @@ class RagAugmentor(ContextAugmentor):
             ch0 = hits[0]
             text = (ch0.text or "").strip()
             if not text:
-                return base
+                return None
 
             lo, hi = 0, len(text)
             best = ""
             while lo <= hi:
                 mid = (lo + hi) // 2
-                trial = header + f"[{_loc(ch0)}]\n{text[:mid]}\n"
+                trial = header + f"{_label(ch0)}\n{text[:mid]}\n"
                 trial_msg = make_msg(trial, [ch0])
                 tok = self.counter.count_messages([trial_msg])
                 if tok <= int(self.max_rag_tokens):
@@ -118,18 +303,10 @@ class RagAugmentor(ContextAugmentor):
                     hi = mid - 1
 
             if not best:
-                return base
+                return None
 
             rag_msg = make_msg(best, [ch0])
-            rag_msg.meta["tokens"] = self.counter.count_messages([rag_msg])
         else:
-            final_text = "".join(parts)
-            rag_msg = make_msg(final_text, chosen)
-            rag_msg.meta["tokens"] = self.counter.count_messages([rag_msg])
-
-        insert_at = 0
-        for i, m in enumerate(base):
-            if m.meta.get("pinned") is True:
-                insert_at = i + 1
-
-        return base[:insert_at] + [rag_msg] + base[insert_at:]
+            rag_msg = make_msg("".join(parts), chosen)
+        rag_msg.meta["tokens"] = self.counter.count_messages([rag_msg])
+        return rag_msg
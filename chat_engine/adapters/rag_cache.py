@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import struct
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple, Union
+
+from chat_engine.domain.rag_models import SparseVector
+from chat_engine.ports.embeddings import Embedder, SparseEmbedder, embedder_key
+
+# вектор запроса: плотный или (у эмбеддеров с embed_sparse) разреженный
+QueryVector = Union[List[float], SparseVector]
+
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """Ключ запроса: схлопнутые пробелы по краям и внутри (регистр не трогаем — модель может быть cased)."""
+    return _WS_RE.sub(" ", text or "").strip()
+
+
+class QueryEmbeddingCache:
+    """
+    Ограниченный LRU эмбеддингов запросов: (эмбеддер, нормализованный текст) -> вектор.
+    Потокобезопасный, общий для всех пользователей; hits/misses — накопительные счётчики.
+    У SparseEmbedder (hashed bag-of-words) хранится SparseVector: запись стоит O(слов запроса),
+    а не O(dim) — при CE_HASH_DIM=2**18 плотные векторы съели бы гигабайты.
+    """
+
+    def __init__(self, max_items: int = 1024):
+        self.max_items = max(0, int(max_items))
+        self._lock = Lock()
+        self._items: "OrderedDict[Tuple[Hashable, ...], QueryVector]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, embedder: Embedder, text: str) -> Tuple[QueryVector, bool]:
+        """Вектор запроса (см. embed_query) и признак попадания в кэш."""
+        key = (*embedder_key(embedder), normalize_query(text))
+        with self._lock:
+            vec = self._items.get(key)
+            if vec is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return vec, True
+            self.misses += 1
+
+        vec = embed_query(embedder, text)
+        if self.max_items:
+            with self._lock:
+                self._items[key] = vec
+                self._items.move_to_end(key)
+                while len(self._items) > self.max_items:
+                    self._items.popitem(last=False)
+        return vec, False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
+
+
+def embed_query(embedder: Embedder, text: str) -> QueryVector:
+    """SparseEmbedder отдаёт разреженный вектор, остальные — плотный."""
+    if isinstance(embedder, SparseEmbedder):
+        return embedder.embed_sparse([text])[0]
+    return embedder.embed([text])[0]
+
+
+def vector_fingerprint(vec: QueryVector) -> str:
+    if isinstance(vec, SparseVector):
+        n = len(vec.indices)
+        packed = struct.pack(f"<q{n}q{n}d", vec.dim, *vec.indices, *vec.values)
+        return "s" + hashlib.sha1(packed).hexdigest()
+    return hashlib.sha1(struct.pack(f"<{len(vec)}d", *vec)).hexdigest()
+
+
+class RetrievalCache:
+    """
+    LRU готовых результатов RagAugmentor: ключ -> (текст, meta) собранного retrieved_context
+    или None («ничего не нашлось»). В ключ входят поколения хранилищ, поэтому любой upsert/delete
+    делает старые записи недостижимыми — они просто вытесняются из LRU.
+    """
+
+    def __init__(self, max_items: int = 512):
+        self.max_items = max(0, int(max_items))
+        self._lock = Lock()
+        self._items: "OrderedDict[Hashable, Optional[Tuple[str, Dict[str, Any]]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Tuple[Optional[Tuple[str, Dict[str, Any]]], bool]:
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key], True
+            self.misses += 1
+            return None, False
+
+    def put(self, key: Hashable, value: Optional[Tuple[str, Dict[str, Any]]]) -> None:
+        if not self.max_items:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from dataclasses import replace
+from typing import Optional
+
+from chat_engine.domain.rag_models import DocumentChunk, SparseVector
+
+# без offsets в meta (старые индексы) перекрытие ищется по тексту: столько символов начала
+# следующего чанка должно найтись в конце предыдущего
+_MIN_TEXT_OVERLAP = 32
+
+
+def mmr_select(
+    query: Sequence[float],
+    candidates: Sequence[Sequence[float]],
+    k: int,
+    lambda_: float = 0.7,
+) -> list[int]:
+    """
+    Maximal marginal relevance: жадно берём кандидата с max(lambda * sim(q, d) - (1 - lambda) * max sim(d, выбранные)).
+    Все попарные сходства — одна матрица C @ C.T (numpy, если он есть).
+    Возвращает индексы кандидатов в порядке выбора.
+    """
+    n = len(candidates)
+    k = max(0, min(int(k), n))
+    if k == 0:
+        return []
+    try:
+        import numpy as np
+    except ImportError:
+        return _mmr_select_py(query, candidates, k, lambda_)
+
+    cand = np.asarray(candidates, dtype=np.float32)
+    rel = cand @ np.asarray(query, dtype=np.float32)
+    sims = cand @ cand.T
+    chosen = [int(np.argmax(rel))]
+    max_sim = sims[chosen[0]].copy()
+    taken = np.zeros(n, dtype=bool)
+    taken[chosen[0]] = True
+    while len(chosen) < k:
+        score = lambda_ * rel - (1.0 - lambda_) * max_sim
+        score[taken] = -np.inf
+        j = int(np.argmax(score))
+        chosen.append(j)
+        taken[j] = True
+        np.maximum(max_sim, sims[j], out=max_sim)
+    return chosen
+
+
+def mmr_select_sparse(
+    query: SparseVector,
+    candidates: Sequence[SparseVector],
+    k: int,
+    lambda_: float = 0.7,
+) -> list[int]:
+    """
+    mmr_select для разреженных векторов без разворачивания в dim: скалярные произведения не меняются,
+    если оставить только координаты, ненулевые хоть у одного из векторов, — их и берём.
+    """
+    coords = sorted({i for v in (query, *candidates) for i in v.indices})
+    pos = {i: j for j, i in enumerate(coords)}
+
+    def compact(v: SparseVector) -> list[float]:
+        out = [0.0] * len(coords)
+        for i, x in zip(v.indices, v.values):
+            out[pos[i]] = x
+        return out
+
+    return mmr_select(compact(query), [compact(c) for c in candidates], k, lambda_)
+
+
+def _dot(a: Sequence[float], b: Sequence[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+def _mmr_select_py(query: Sequence[float], candidates: Sequence[Sequence[float]], k: int, lambda_: float) -> list[int]:
+    n = len(candidates)
+    rel = [_dot(query, c) for c in candidates]
+    sims = [[_dot(candidates[i], candidates[j]) for j in range(n)] for i in range(n)]
+    chosen = [max(range(n), key=lambda i: rel[i])]
+    max_sim = list(sims[chosen[0]])
+    while len(chosen) < k:
+        rest = [i for i in range(n) if i not in chosen]
+        j = max(rest, key=lambda i: lambda_ * rel[i] - (1.0 - lambda_) * max_sim[i])
+        chosen.append(j)
+        max_sim = [max(a, b) for a, b in zip(max_sim, sims[j])]
+    return chosen
+
+
+def _span(ch: DocumentChunk) -> Optional[tuple[int, int]]:
+    start, end = ch.meta.get("start"), ch.meta.get("end")
+    if isinstance(start, int) and isinstance(end, int):
+        return start, end
+    return None
+
+
+def _glue(a: DocumentChunk, b: DocumentChunk) -> Optional[DocumentChunk]:
+    """Склейка a и b (b идёт после a в тексте страницы), если они перекрываются или соседствуют."""
+    sa, sb = _span(a), _span(b)
+    if sa is not None and sb is not None:
+        if sb[0] < sa[0] or sb[0] > sa[1] + 1:
+            return None
+        # b начинается внутри a (overlap) или сразу за ним (между ними был только вырезанный пробел)
+        tail = b.text[sa[1] - sb[0]:] if sb[0] <= sa[1] else " " + b.text
+        span: Optional[tuple[int, int]] = (sa[0], max(sa[1], sb[1]))
+    else:
+        head = b.text[:_MIN_TEXT_OVERLAP]
+        at = a.text.find(head) if len(head) == _MIN_TEXT_OVERLAP else -1
+        if at < 0 or not b.text.startswith(a.text[at:]):
+            return None
+        tail = b.text[len(a.text) - at:]
+        span = None
+
+    meta = dict(a.meta)
+    meta["merged"] = list(a.meta.get("merged", [a.id])) + list(b.meta.get("merged", [b.id]))
+    if span is not None:
+        meta["start"], meta["end"] = span
+    return DocumentChunk(
+        id=a.id,
+        text=a.text + tail,
+        source=a.source,
+        page=a.page,
+        tokens=0,
+        meta=meta,
+    )
+
+
+def merge_adjacent(chunks: Sequence[DocumentChunk]) -> list[DocumentChunk]:
+    """
+    Склеивает перекрывающиеся/соседние чанки одного source+page в один фрагмент, чтобы перекрытие
+    чанкера (overlap_tokens) не тратило бюджет RAG дважды. Склеенный фрагмент стоит на месте
+    лучшего (самого раннего в ранжировании) из своих чанков.
+    """
+    out: list[Optional[DocumentChunk]] = list(chunks)
+    changed = True
+    while changed:
+        changed = False
+        for i, a in enumerate(out):
+            if a is None:
+                continue
+            for j in range(i + 1, len(out)):
+                b = out[j]
+                if b is None or (a.source, a.page) != (b.source, b.page):
+                    continue
+                glued = _glue(a, b) or _glue(b, a)
+                if glued is None:
+                    continue
+                out[i] = a = replace(glued, id=a.id)
+                out[j] = None
+                changed = True
+    return [c for c in out if c is not None]
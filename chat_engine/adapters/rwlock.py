@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+class RWLock:
+    """
+    Много читателей или один писатель — для хранилищ, в которые фоновый ingest пишет,
+    пока /chat по ним ищет. Ожидающий писатель не пропускает вперёд новых читателей
+    (иначе поток поисков откладывал бы запись бесконечно).
+    Реентерабельность: запись внутри записи и чтение внутри чтения/записи того же потока;
+    запись внутри чтения (upgrade) не поддерживается — это взаимоблокировка.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer: Optional[int] = None
+        self._depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        me = threading.get_ident()
+        held = getattr(self._local, "reads", 0)
+        counted = False
+        with self._cond:
+            if self._writer != me:
+                # поток, уже читающий, не ждёт писателя: тот ждёт его же
+                while not held and (self._writer is not None or self._writers_waiting):
+                    self._cond.wait()
+                self._readers += 1
+                counted = True
+        self._local.reads = held + 1
+        try:
+            yield
+        finally:
+            self._local.reads = held
+            if counted:
+                with self._cond:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+            else:
+                if getattr(self._local, "reads", 0):
+                    raise RuntimeError("RWLock: write inside read is not supported")
+                self._writers_waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._writers_waiting -= 1
+                self._writer, self._depth = me, 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._cond.notify_all()
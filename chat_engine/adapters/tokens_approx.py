@@ -4,10 +4,10 @@ import math
 from collections.abc import Sequence
 
 from chat_engine.domain.models import Message
-from chat_engine.ports.tokens import TokenCounter
+from chat_engine.ports.tokens import TokenOffsets
 
 
-class ApproxTokenCounter(TokenCounter):
+class ApproxTokenCounter(TokenOffsets):
     """
     MVP-оценка:
       - 1 токен ~ 4 символа
@@ -21,6 +21,10 @@ class ApproxTokenCounter(TokenCounter):
     def count_text(self, text: str) -> int:
         return max(1, int(math.ceil(len(text or "") / 4)))
 
+    def token_offsets(self, text: str) -> list[int]:
+        # та же оценка, что в count_text: "токен" — каждые 4 символа
+        return list(range(0, len(text or ""), 4))
+
     def count_messages(self, messages: Sequence[Message]) -> int:
         total = 0
         for m in messages:
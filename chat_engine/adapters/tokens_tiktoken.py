@@ -4,11 +4,11 @@ from dataclasses import dataclass
 from typing import Sequence
 
 from chat_engine.domain.models import Message
-from chat_engine.ports.tokens import TokenCounter
+from chat_engine.ports.tokens import TokenOffsets
 
 
 @dataclass
-class TiktokenTokenCounter(TokenCounter):
+class TiktokenTokenCounter(TokenOffsets):
     """
     Практичная версия для проекта:
     - per-message cost: tokens_per_message + tokens(content) + tokens(name if any)
@@ -25,6 +25,12 @@ class TiktokenTokenCounter(TokenCounter):
     def count_text(self, text: str) -> int:
         return len(self._enc.encode(text or ""))
 
+    def token_offsets(self, text: str) -> list[int]:
+        # документы могут содержать "<|endoftext|>" — для разметки это обычный текст;
+        # токен, начинающийся внутри многобайтового символа, получает смещение этого символа
+        _, offsets = self._enc.decode_with_offsets(self._enc.encode(text or "", disallowed_special=()))
+        return offsets
+
     def count_messages(self, messages: Sequence[Message]) -> int:
         total = 0
         for m in messages:
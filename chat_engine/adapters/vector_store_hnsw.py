@@ -0,0 +1,491 @@
+from __future__ import annotations
+
+import base64
+import heapq
+import json
+import math
+import random
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from chat_engine.adapters.rwlock import RWLock
+from chat_engine.adapters.vector_store_json import (
+    _CHUNK_OVERHEAD,
+    _PY_NUMBER,
+    _chunk_from_dict,
+    _chunk_to_dict,
+    _item_vector,
+    _journal_paths,
+    _next_generation,
+    _OpLog,
+    _read_items,
+    _write_items,
+)
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter, is_grouped
+from chat_engine.ports.vector_store import VectorStore
+
+
+class HnswVectorStore(VectorStore):
+    """
+    HNSW-граф (скалярное произведение) с инкрементальными вставками.
+    - upsert вставляет узлы в граф по одному; замена чанка = tombstone старого узла + новый узел;
+    - delete_by_source только помечает узлы tombstone'ами (они продолжают служить для навигации),
+      когда мёртвых становится больше rebuild_ratio, граф перестраивается из живых узлов;
+    - граф сохраняется в <path>.hnsw.npz, чанки — в тот же JSON, что у JsonVectorStore
+      (изменения дописываются в его журнал, базовый файл переписывается, когда журнал перерос его).
+      Батч дописывает в <path>.hnsw.log только свою дельту графа (новые узлы, изменённые списки
+      соседей, tombstone'ы, точку входа); npz переписывается вместе с базовым JSON и после перестройки.
+      При старте граф читается с диска (npz + дельты) и перестраивается только если не совпал с JSON.
+    Запрос с фильтром where не ходит по графу: живые узлы отбираются по индексу source -> узлы
+    и скорятся точно (граф при селективном фильтре отдавал бы почти одних отфильтрованных соседей).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        m: int = 16,
+        ef_construction: int = 100,
+        ef_search: int = 64,
+        rebuild_ratio: float = 0.3,
+        seed: int = 0,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._graph_path = Path(str(self.path) + ".hnsw.npz")
+        self._graph_log = Path(str(self.path) + ".hnsw.log")
+
+        self.m = max(2, int(m))
+        self.ef_construction = max(self.m, int(ef_construction))
+        self.ef_search = max(1, int(ef_search))
+        self.rebuild_ratio = float(rebuild_ratio)
+        self._ml = 1.0 / math.log(self.m)
+        self._rng = random.Random(seed)
+
+        self._reset(0)
+        self._generation = _next_generation()
+        self._rw = RWLock()  # поиски идут параллельно с фоновым ingest
+        self._log = _OpLog(_journal_paths(self.path)[0])
+        self._load()
+
+    # ---------- state ----------
+
+    def _reset(self, dim: int) -> None:
+        self._vecs = np.zeros((0, dim), dtype=np.float32)
+        self._n = 0
+        self._node_ids: List[str] = []
+        self._chunks: List[Optional[DocumentChunk]] = []
+        self._dead: List[bool] = []
+        self._n_dead = 0  # число True в _dead: _maybe_rebuild на каждой записи не пересчитывает список
+        self._levels: List[int] = []
+        self._links: List[Dict[int, List[int]]] = [{}]
+        self._entry = -1
+        self._ids: Dict[str, int] = {}
+        self._by_source: Dict[str, Set[int]] = {}
+        self._grouped: Set[int] = set()  # канонические чанки групп почти-дубликатов (фильтр по всем их местам)
+        # что изменилось с последней записи графа на диск: узлы от _saved_n, списки (слой, узел), tombstone'ы
+        self._saved_n = 0
+        self._touched: Set[Tuple[int, int]] = set()
+        self._killed: Set[int] = set()
+        self._renumbered = True  # граф собран заново — дельтой его не записать
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def dim(self) -> int:
+        return int(self._vecs.shape[1])
+
+    def _append_node(self, ch: DocumentChunk, vec: np.ndarray) -> int:
+        if self._n == self._vecs.shape[0]:
+            grown = np.zeros((max(16, self._n * 2), vec.shape[0]), dtype=np.float32)
+            grown[: self._n] = self._vecs[: self._n]
+            self._vecs = grown
+        node = self._n
+        self._vecs[node] = vec
+        self._n += 1
+        self._node_ids.append(ch.id)
+        self._chunks.append(ch)
+        self._dead.append(False)
+        self._ids[ch.id] = node
+        self._by_source.setdefault((ch.source or "").lower(), set()).add(node)
+        if is_grouped(ch.meta):
+            self._grouped.add(node)
+        return node
+
+    def _kill(self, node: int) -> None:
+        ch = self._chunks[node]
+        if ch is not None:
+            self._by_source.get((ch.source or "").lower(), set()).discard(node)
+        self._grouped.discard(node)
+        self._killed.add(node)
+        if not self._dead[node]:
+            self._dead[node] = True
+            self._n_dead += 1
+        self._chunks[node] = None
+        if self._ids.get(self._node_ids[node]) == node:
+            del self._ids[self._node_ids[node]]
+
+    # ---------- graph ----------
+
+    def _search_layer(self, q: np.ndarray, entry: List[int], ef: int, layer: int) -> List[Tuple[float, int]]:
+        """Жадный best-first поиск на одном слое; возвращает до ef пар (score, node) по убыванию."""
+        visited = set(entry)
+        sims = (self._vecs[entry] @ q).tolist()
+        cand = [(-s, e) for s, e in zip(sims, entry)]
+        heapq.heapify(cand)
+        res = [(s, e) for s, e in zip(sims, entry)]
+        heapq.heapify(res)
+        while len(res) > ef:
+            heapq.heappop(res)
+
+        links = self._links[layer]
+        while cand:
+            neg, c = heapq.heappop(cand)
+            if len(res) >= ef and -neg < res[0][0]:
+                break
+            nbrs = [v for v in links.get(c, ()) if v not in visited]
+            if not nbrs:
+                continue
+            visited.update(nbrs)
+            for s, v in zip((self._vecs[nbrs] @ q).tolist(), nbrs):
+                if len(res) < ef or s > res[0][0]:
+                    heapq.heappush(cand, (-s, v))
+                    heapq.heappush(res, (s, v))
+                    if len(res) > ef:
+                        heapq.heappop(res)
+        return sorted(res, reverse=True)
+
+    def _greedy_entry(self, q: np.ndarray, down_to: int) -> List[int]:
+        ep = [self._entry]
+        for layer in range(self._levels[self._entry], down_to, -1):
+            ep = [self._search_layer(q, ep, 1, layer)[0][1]]
+        return ep
+
+    def _shrink(self, node: int, layer: int, m_max: int) -> None:
+        nbrs = self._links[layer][node]
+        sims = self._vecs[nbrs] @ self._vecs[node]
+        keep = np.argsort(-sims, kind="stable")[:m_max]
+        self._links[layer][node] = [nbrs[int(i)] for i in keep]
+        self._touched.add((layer, node))
+
+    def _insert(self, node: int) -> None:
+        q = self._vecs[node]
+        level = int(-math.log(1.0 - self._rng.random()) * self._ml)
+        self._levels.append(level)
+        while len(self._links) <= level:
+            self._links.append({})
+        for layer in range(level + 1):
+            self._links[layer][node] = []
+            self._touched.add((layer, node))
+
+        if self._entry < 0:
+            self._entry = node
+            return
+
+        top = self._levels[self._entry]
+        ep = self._greedy_entry(q, level)
+        for layer in range(min(level, top), -1, -1):
+            found = self._search_layer(q, ep, self.ef_construction, layer)
+            m_max = self.m * 2 if layer == 0 else self.m
+            nbrs = [v for _, v in found[: self.m]]
+            self._links[layer][node] = nbrs
+            self._touched.add((layer, node))
+            for v in nbrs:
+                lst = self._links[layer][v]
+                lst.append(node)
+                self._touched.add((layer, v))
+                if len(lst) > m_max:
+                    self._shrink(v, layer, m_max)
+            ep = [v for _, v in found]
+
+        if level > top:
+            self._entry = node
+
+    def _rebuild(self) -> None:
+        live = [(ch, self._vecs[i].copy()) for i, ch in enumerate(self._chunks) if ch is not None and not self._dead[i]]
+        self._reset(self.dim)
+        for ch, v in live:
+            self._insert(self._append_node(ch, v))
+
+    # ---------- persistence ----------
+
+    def _load(self) -> None:
+        chunks: List[DocumentChunk] = []
+        rows: List[List[float]] = []
+        for it in _read_items(self.path):
+            v = _item_vector(it) if isinstance(it, dict) else None
+            if isinstance(v, list) and v and (not rows or len(v) == len(rows[0])):
+                chunks.append(_chunk_from_dict(it.get("chunk", {})))
+                rows.append(v)
+        if not rows:
+            return
+
+        mat = np.asarray(rows, dtype=np.float32)
+        if self._load_graph(chunks, mat.shape[1]):
+            return
+
+        self._reset(mat.shape[1])
+        for ch, v in zip(chunks, mat):
+            self._insert(self._append_node(ch, v))
+        self._save_graph()
+
+    def _load_graph(self, chunks: List[DocumentChunk], dim: int) -> bool:
+        if not self._graph_path.exists():
+            return False
+        try:
+            data = np.load(self._graph_path)
+            vecs = data["vectors"].astype(np.float32)
+            node_ids = [str(x) for x in data["ids"].tolist()]
+            dead = [bool(x) for x in data["dead"].tolist()]
+            levels = data["levels"].astype(int).tolist()
+            entry = int(data["entry"])
+            links: List[Dict[int, List[int]]] = []
+            for layer in range(int(data["layers"])):
+                nodes = data[f"l{layer}_nodes"].tolist()
+                rows = data[f"l{layer}_links"]
+                links.append({node: [int(v) for v in row if v >= 0] for node, row in zip(nodes, rows)})
+            if vecs.shape[1] != dim:
+                return False
+
+            blocks = [vecs]
+            for rec in self._read_graph_log():
+                if int(rec["n0"]) != len(node_ids):
+                    return False
+                new_ids = [str(x) for x in rec["ids"]]
+                if new_ids:
+                    blocks.append(np.frombuffer(base64.b64decode(rec["vectors"]), dtype="<f4").reshape(len(new_ids), dim))
+                node_ids.extend(new_ids)
+                dead.extend(False for _ in new_ids)
+                levels.extend(int(x) for x in rec["levels"])
+                for node in rec["dead"]:
+                    dead[int(node)] = True
+                for layer, node, nbrs in rec["links"]:
+                    while len(links) <= int(layer):
+                        links.append({})
+                    links[int(layer)][int(node)] = [int(v) for v in nbrs]
+                entry = int(rec["entry"])
+            vecs = np.concatenate(blocks) if len(blocks) > 1 else vecs
+
+            by_id = {ch.id: ch for ch in chunks}
+            live_ids = {cid for cid, d in zip(node_ids, dead) if not d}
+            if live_ids != set(by_id) or len(levels) != len(node_ids):
+                return False
+
+            self._reset(dim)
+            self._vecs, self._n = vecs, int(vecs.shape[0])
+            self._node_ids, self._dead, self._levels, self._entry, self._links = node_ids, dead, levels, entry, links
+            self._n_dead = sum(dead)
+            self._chunks = [None if d else by_id[cid] for cid, d in zip(node_ids, dead)]
+            self._ids = {cid: i for i, (cid, d) in enumerate(zip(node_ids, dead)) if not d}
+            for node in self._ids.values():
+                ch = self._chunks[node]
+                self._by_source.setdefault((ch.source or "").lower(), set()).add(node)  # type: ignore[union-attr]
+                if is_grouped(ch.meta):  # type: ignore[union-attr]
+                    self._grouped.add(node)
+            self._saved_n, self._renumbered = self._n, False
+            return True
+        except Exception:
+            self._reset(dim)
+            return False
+
+    def _read_graph_log(self) -> List[Dict[str, Any]]:
+        if not self._graph_log.exists():
+            return []
+        out = []
+        for line in self._graph_log.read_text(encoding="utf-8").splitlines():
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                break  # недописанная последняя дельта после падения: граф не сойдётся с JSON и перестроится
+        return out
+
+    def _save_graph(self) -> None:
+        """Полный снимок графа; дельты после него не нужны."""
+        arrays: Dict[str, np.ndarray] = {
+            "vectors": self._vecs[: self._n],
+            "ids": np.asarray(self._node_ids, dtype=str),
+            "dead": np.asarray(self._dead, dtype=bool),
+            "levels": np.asarray(self._levels, dtype=np.int32),
+            "entry": np.asarray(self._entry),
+            "layers": np.asarray(len(self._links)),
+        }
+        for layer, links in enumerate(self._links):
+            width = max((len(v) for v in links.values()), default=0)
+            mat = np.full((len(links), width), -1, dtype=np.int32)
+            for i, nbrs in enumerate(links.values()):
+                mat[i, : len(nbrs)] = nbrs
+            arrays[f"l{layer}_nodes"] = np.fromiter(links.keys(), dtype=np.int32, count=len(links))
+            arrays[f"l{layer}_links"] = mat
+
+        tmp = self._graph_path.with_name(self._graph_path.name + ".tmp.npz")
+        np.savez(tmp, **arrays)
+        tmp.replace(self._graph_path)
+        self._graph_log.unlink(missing_ok=True)
+        self._mark_saved()
+
+    def _append_graph(self) -> None:
+        """Дельта с последней записи: O(батча и затронутых им списков соседей), а не O(графа)."""
+        n0 = self._saved_n
+        rec = {
+            "n0": n0,
+            "ids": self._node_ids[n0 : self._n],
+            "levels": self._levels[n0 : self._n],
+            "vectors": base64.b64encode(np.ascontiguousarray(self._vecs[n0 : self._n], dtype="<f4").tobytes()).decode("ascii"),
+            "dead": sorted(self._killed),
+            "links": [[layer, node, self._links[layer][node]] for layer, node in sorted(self._touched)],
+            "entry": self._entry,
+        }
+        with self._graph_log.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(rec) + "\n")
+        self._mark_saved()
+
+    def _mark_saved(self) -> None:
+        self._saved_n, self._renumbered = self._n, False
+        self._touched.clear()
+        self._killed.clear()
+
+    def _save(self) -> None:
+        items = [
+            {"chunk": _chunk_to_dict(ch), "vector": self._vecs[i].tolist()}
+            for i, ch in enumerate(self._chunks)
+            if ch is not None
+        ]
+        _write_items(self.path, items)
+        self._log.reset()
+        self._save_graph()
+
+    def _persist(self, ops: List[Dict[str, Any]]) -> None:
+        self._log.append(ops)
+        if self._log.due(len(self._ids)):
+            self._save()
+        elif self._renumbered:
+            self._save_graph()
+        else:
+            self._append_graph()
+
+    def _maybe_rebuild(self) -> None:
+        dead = self._n_dead
+        if dead and dead > self.rebuild_ratio * self._n:
+            self._rebuild()
+
+    # ---------- VectorStore ----------
+
+    def count(self) -> int:
+        with self._rw.read():
+            return len(self._ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Оценка памяти: векторы + узлы (tombstone'ы тоже) с ~2m соседями на нижнем слое в python-списках."""
+        with self._rw.read():
+            return int(self._vecs.nbytes + self._n * (_CHUNK_OVERHEAD + 2 * self.m * _PY_NUMBER))
+
+    def vectors(self, chunk_ids: Sequence[str]) -> List[Optional[List[float]]]:
+        with self._rw.read():
+            nodes = [self._ids.get(cid) for cid in chunk_ids]
+            return [None if n is None else self._vecs[n].tolist() for n in nodes]
+
+    def delete_by_source(self, source: str) -> int:
+        with self._rw.write():
+            s = (source or "").lower()
+            victims = sorted(self._by_source.pop(s, set()))
+            for node in victims:
+                self._kill(node)
+            if victims:
+                self._maybe_rebuild()
+                self._generation = _next_generation()
+                self._persist([{"op": "delete", "source": s}])
+            return len(victims)
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        with self._rw.write():
+            victims = sorted({self._ids[cid] for cid in chunk_ids if cid in self._ids})
+            ids = sorted(self._node_ids[node] for node in victims)
+            for node in victims:
+                self._kill(node)
+            if victims:
+                self._maybe_rebuild()
+                self._generation = _next_generation()
+                self._persist([{"op": "delete_ids", "ids": ids}])
+            return len(victims)
+
+    def upsert(self, chunks: Sequence[DocumentChunk], vectors: Sequence[List[float]]) -> None:
+        with self._rw.write():
+            pairs = list(zip(chunks, vectors))
+            if not pairs:
+                return
+
+            block = np.asarray([v for _, v in pairs], dtype=np.float32)
+            if block.ndim != 2:
+                raise ValueError("Vectors must have the same dimension")
+            if self._n and block.shape[1] != self.dim:
+                raise ValueError(f"Vector dim mismatch: got {block.shape[1]} expected {self.dim}")
+            if not self._n:
+                self._reset(int(block.shape[1]))
+
+            for (ch, _), vec in zip(pairs, block):
+                old = self._ids.get(ch.id)
+                if old is not None:
+                    self._kill(old)
+                self._insert(self._append_node(ch, vec))
+
+            self._maybe_rebuild()
+            self._generation = _next_generation()
+            self._persist([
+                {"op": "upsert", "item": {"chunk": _chunk_to_dict(ch), "vector": vec}}
+                for (ch, _), vec in zip(pairs, block.tolist())
+            ])
+
+    def _eligible(self, where: SearchFilter) -> List[int]:
+        if where.sources is not None:
+            pool: Set[int] = set().union(self._grouped, *(self._by_source.get(s, set()) for s in where.sources))
+        else:
+            pool = set(self._ids.values())
+        return sorted(node for node in pool if where.matches_chunk(self._chunks[node]))  # type: ignore[arg-type]
+
+    def search(
+        self,
+        query_vector: List[float],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[DocumentChunk]:
+        with self._rw.read():
+            k = max(0, int(top_k))
+            if k == 0 or not self._ids:
+                return []
+
+            q = np.asarray(query_vector, dtype=np.float32)
+            if q.shape[0] != self.dim:
+                raise ValueError(f"Query dim mismatch: got {q.shape[0]} expected {self.dim}")
+
+            if where is not None:
+                nodes = self._eligible(where)
+                if not nodes:
+                    return []
+                scores = self._vecs[nodes] @ q
+                order = np.argsort(-scores, kind="stable")[:k]
+                return [self._chunks[nodes[int(i)]] for i in order]  # type: ignore[misc]
+
+            ep = self._greedy_entry(q, 0)
+            ef = max(self.ef_search, k)
+            while True:
+                found = self._search_layer(q, ep, ef, 0)
+                live = [node for _, node in found if not self._dead[node]]
+                if len(live) >= k or ef >= self._n:
+                    break
+                ef *= 2
+            return [self._chunks[node] for node in live[:k]]  # type: ignore[misc]
+
+    def compact(self) -> Dict[str, int]:
+        """Перестраивает граф без tombstone-узлов."""
+        with self._rw.write():
+            before = self._n
+            self._rebuild()
+            self._generation = _next_generation()
+            self._save()
+            return {"nodes_before": before, "nodes_after": self._n}
@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import json
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from chat_engine.adapters.vector_store_json import _next_generation
+from chat_engine.adapters.vector_store_numpy import NumpyVectorStore, _top_k, _top_k_rows
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter
+
+
+def _normalize_rows(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return x / norms
+
+
+def train_kmeans(data: np.ndarray, k: int, *, niter: int = 10, seed: int = 0) -> np.ndarray:
+    """Сферический k-means (скалярное произведение), центроиды нормированы."""
+    rng = np.random.default_rng(seed)
+    n = int(data.shape[0])
+    k = max(1, min(int(k), n))
+    centroids = _normalize_rows(data[rng.choice(n, size=k, replace=False)].astype(np.float32))
+    for _ in range(max(1, niter)):
+        assign = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        sizes = np.bincount(assign, minlength=k)
+        empty = np.flatnonzero(sizes == 0)
+        if empty.size:
+            sums[empty] = data[rng.choice(n, size=empty.size, replace=False)]
+        centroids = _normalize_rows(sums)
+    return centroids.astype(np.float32)
+
+
+class IvfVectorStore(NumpyVectorStore):
+    """
+    IVF поверх NumpyVectorStore: векторы разбиты на nlist списков по ближайшему центроиду,
+    запрос сканирует только nprobe ближайших списков.
+    - центроиды обучаются при ingest, как только строк хватает (>= nlist * min_points_per_list);
+    - новые строки добавляются в списки без переобучения;
+    - когда самый большой список > imbalance * средний, переобучение идёт в фоновом потоке — но не раньше,
+      чем строк станет в retrain_growth раз больше, чем при прошлом обучении: на перекошенных данных
+      k-means не выравнивает списки, и без этого порога перезапускался бы после каждого upsert;
+    - центроиды и назначения сохраняются рядом с JSON (<path>.ivf.npz) при обучении и компакции, а батч
+      ingest дописывает в <path>.ivf.log только назначения своих строк.
+    До обучения поиск точный (brute force); с фильтром where — тоже точный, но только по отобранным строкам
+    (пробы списков при селективном фильтре теряли бы почти весь top_k).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        nlist: int = 64,
+        nprobe: int = 8,
+        imbalance: float = 4.0,
+        min_points_per_list: int = 8,
+        retrain_growth: float = 1.5,
+    ):
+        self.nlist = max(1, int(nlist))
+        self.nprobe = max(1, int(nprobe))
+        self.imbalance = float(imbalance)
+        self.min_points_per_list = max(1, int(min_points_per_list))
+        self.retrain_growth = max(1.0, float(retrain_growth))
+        self._trained_n = 0  # строк в выборке последнего обучения центроидов
+
+        self._centroids: Optional[np.ndarray] = None
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._lists: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._retrain_thread: Optional[threading.Thread] = None
+
+        super().__init__(path)
+        self._index_path = Path(str(self.path) + ".ivf.npz")
+        self._index_log = Path(str(self.path) + ".ivf.log")
+        self._load_index()
+
+    # ---------- index state ----------
+
+    def _load_index(self) -> None:
+        """
+        Центроиды и назначения из .ivf.npz плюс дельты .ivf.log; строки, для которых назначения не нашлось
+        (после падения между журналом и логом или из индекса старого формата), назначаются заново.
+        """
+        n = len(self._chunks)
+        if n and self._index_path.exists():
+            try:
+                data = np.load(self._index_path)
+                centroids = data["centroids"]
+                if centroids.shape[1] == self.dim:
+                    known: Dict[str, int] = {}
+                    if "ids" in data.files:
+                        known = dict(zip((str(x) for x in data["ids"].tolist()), data["assign"].tolist()))
+                    records = self._read_index_log()
+                    for rec in records:
+                        if rec is not None:
+                            known.update(zip(rec["ids"], rec["assign"]))
+                    if records and records[-1] is None:
+                        known = {}  # в оборванной дельте могли быть новые векторы старых id: снимку не верим
+                    self._centroids = centroids.astype(np.float32)
+                    # индексы старого формата: считаем, что обучены на текущих строках
+                    self._trained_n = int(data["trained"]) if "trained" in data.files else n
+                    self._assign = np.asarray([known.get(ch.id, -1) for ch in self._chunks], dtype=np.int32)
+                    missing = np.flatnonzero(self._assign < 0)
+                    if missing.size:
+                        self._assign[missing] = self._assign_rows(missing)
+                    self._lists = None
+                    return
+            except Exception:
+                self._centroids, self._assign = None, np.zeros(0, dtype=np.int32)
+        self._maybe_train()
+
+    def _read_index_log(self) -> List[Optional[Dict[str, Any]]]:
+        """Дельты по порядку; None в конце — недописанная после падения дельта."""
+        if not self._index_log.exists():
+            return []
+        out: List[Optional[Dict[str, Any]]] = []
+        for line in self._index_log.read_text(encoding="utf-8").splitlines():
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                out.append(None)
+                break
+        return out
+
+    def _save_index(self) -> None:
+        """Полный снимок (обучение, компакция базового файла); дельты после него не нужны."""
+        if self._centroids is None:
+            self._index_path.unlink(missing_ok=True)
+        else:
+            m = self._assign.shape[0]
+            tmp = self._index_path.with_name(self._index_path.name + ".tmp.npz")
+            np.savez(
+                tmp,
+                centroids=self._centroids,
+                ids=np.asarray([ch.id for ch in self._chunks[:m]], dtype=str),
+                assign=self._assign[:m],
+                trained=np.int64(self._trained_n),
+            )
+            tmp.replace(self._index_path)
+        self._index_log.unlink(missing_ok=True)
+
+    def _append_index(self, rows: np.ndarray) -> None:
+        """Назначения строк батча — O(батча); удаления не пишутся: удалённых id просто нет в JSON."""
+        rec = {"ids": [self._chunks[int(i)].id for i in rows], "assign": self._assign[rows].tolist()}
+        with self._index_log.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(rec) + "\n")
+
+    def _save(self) -> None:
+        super()._save()
+        self._save_index()
+
+    def _assign_rows(self, rows: np.ndarray) -> np.ndarray:
+        assert self._centroids is not None
+        return np.argmax(self._mat[rows] @ self._centroids.T, axis=1).astype(np.int32)
+
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        """CSR-представление списков: (строки, отсортированные по списку; границы списков)."""
+        if self._lists is None:
+            assert self._centroids is not None
+            order = np.argsort(self._assign, kind="stable")
+            bounds = np.searchsorted(self._assign[order], np.arange(self._centroids.shape[0] + 1))
+            self._lists = (order, bounds)
+        return self._lists
+
+    def _maybe_train(self) -> None:
+        n = len(self._chunks)
+        if self._centroids is not None or n < self.nlist * self.min_points_per_list:
+            return
+        self._install(train_kmeans(self._mat[:n], self.nlist), n)
+
+    def _install(self, centroids: np.ndarray, trained_n: int) -> None:
+        with self._rw.write():
+            self._centroids = centroids
+            self._trained_n = int(trained_n)
+            self._assign = self._assign_rows(np.arange(len(self._chunks)))
+            self._lists = None
+            self._generation = _next_generation()
+            self._save_index()
+
+    def _is_unbalanced(self) -> bool:
+        if self._centroids is None or not len(self._chunks):
+            return False
+        sizes = np.bincount(self._assign, minlength=self._centroids.shape[0])
+        return float(sizes.max()) > self.imbalance * float(sizes.mean())
+
+    def _should_retrain(self) -> bool:
+        return len(self._chunks) >= self.retrain_growth * self._trained_n and self._is_unbalanced()
+
+    def _retrain_async(self) -> None:
+        if self._retrain_thread is not None and self._retrain_thread.is_alive():
+            return
+        sample = np.array(self._mat[: len(self._chunks)], copy=True)
+
+        def run() -> None:
+            self._install(train_kmeans(sample, self.nlist), len(sample))
+
+        self._retrain_thread = threading.Thread(target=run, name="ivf-retrain", daemon=True)
+        self._retrain_thread.start()
+
+    def wait_for_retrain(self, timeout: Optional[float] = None) -> None:
+        t = self._retrain_thread
+        if t is not None:
+            t.join(timeout)
+
+    # ---------- VectorStore ----------
+
+    def _keep_rows(self, keep: np.ndarray) -> None:
+        super()._keep_rows(keep)
+        if self._centroids is not None:
+            self._assign = self._assign[keep]
+            self._lists = None
+
+    def upsert(self, chunks: Sequence[DocumentChunk], vectors: Sequence[List[float]]) -> None:
+        with self._rw.write():
+            super().upsert(chunks, vectors)
+            if self._centroids is None:
+                self._maybe_train()
+                return
+
+            n = len(self._chunks)
+            if self._assign.shape[0] < n:
+                self._assign = np.concatenate([self._assign, np.zeros(n - self._assign.shape[0], dtype=np.int32)])
+            rows = np.asarray(sorted({self._ids[ch.id] for ch in chunks}), dtype=np.int64)
+            if rows.size:
+                self._assign[rows] = self._assign_rows(rows)
+                self._lists = None
+                self._append_index(rows)
+
+            if self._should_retrain():
+                self._retrain_async()
+
+    def search(
+        self,
+        query_vector: List[float],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[DocumentChunk]:
+        with self._rw.read():
+            if self._centroids is None or where is not None or len(query_vector) != self.dim:
+                return super().search(query_vector, top_k, where=where)
+
+            k = max(0, int(top_k))
+            if k == 0:
+                return []
+            q = np.asarray(query_vector, dtype=np.float32)
+            probe = _top_k(self._centroids @ q, min(self.nprobe, self._centroids.shape[0]))
+            return self._scan_lists(q, probe, k)
+
+    def _scan_lists(self, q: np.ndarray, probe: np.ndarray, k: int) -> List[DocumentChunk]:
+        order, bounds = self._inverted_lists()
+        rows = np.concatenate([order[bounds[c] : bounds[c + 1]] for c in probe])
+        if rows.size == 0:
+            return []
+        scores = self._mat[rows] @ q
+        return [self._chunks[int(rows[i])] for i in _top_k(scores, k)]
+
+    def search_many(
+        self,
+        query_matrix: Sequence[List[float]],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[List[DocumentChunk]]:
+        with self._rw.read():
+            qm = np.asarray(query_matrix, dtype=np.float32)
+            if self._centroids is None or where is not None or qm.ndim != 2 or qm.shape[1] != self.dim:
+                return super().search_many(query_matrix, top_k, where=where)
+
+            k = max(0, int(top_k))
+            if k == 0:
+                return [[] for _ in range(qm.shape[0])]
+            probes = _top_k_rows(qm @ self._centroids.T, min(self.nprobe, self._centroids.shape[0]))
+            return [self._scan_lists(q, probe, k) for q, probe in zip(qm, probes)]
@@ -1,13 +1,24 @@
 from __future__ import annotations
 
+import itertools
 import json
+import threading
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from typing import Any, Dict, List, Sequence, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
 
-from chat_engine.domain.rag_models import DocumentChunk
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter, SparseVector, is_grouped
 from chat_engine.ports.vector_store import VectorStore
 
 
+_generations = itertools.count(1)
+
+
+def _next_generation() -> int:
+    """Номера поколений хранилищ уникальны в процессе: пара (хранилище, состояние) не повторяется даже после перезагрузки."""
+    return next(_generations)
+
+
 def _dot(a: List[float], b: List[float]) -> float:
     n = min(len(a), len(b))
     return sum(a[i] * b[i] for i in range(n))
@@ -19,106 +30,508 @@ def _atomic_write(path: Path, text: str) -> None:
     tmp.replace(path)
 
 
+_path_locks: Dict[str, threading.Lock] = {}
+_path_locks_guard = threading.Lock()
+
+
+def _compaction_lock(path: Path) -> threading.Lock:
+    """
+    Один на файл в процессе: его держит компактор от переноса журнала в .old до удаления .old.
+    Загрузка того же файла другим экземпляром (например, после выгрузки из NamespaceRegistry)
+    ждёт его, иначе она «доделала» бы чужую живую компакцию и потеряла записи нового журнала.
+    """
+    key = str(path.resolve())
+    with _path_locks_guard:
+        return _path_locks.setdefault(key, threading.Lock())
+
+
+def _journal_paths(path: Path) -> Tuple[Path, Path]:
+    """(текущий журнал, журнал, который сейчас сливается в базовый файл компактором)."""
+    journal = path.with_name(path.name + ".journal.jsonl")
+    return journal, journal.with_name(journal.name + ".old")
+
+
+def _read_base(path: Path) -> List[Dict[str, Any]]:
+    if not path.exists():
+        return []
+    try:
+        raw = path.read_text(encoding="utf-8")
+        data = json.loads(raw) if raw.strip() else {}
+        items = data.get("items", [])
+        return items if isinstance(items, list) else []
+    except Exception:
+        return []
+
+
+def _replay(items: List[Dict[str, Any]], journal: Path) -> List[Dict[str, Any]]:
+    """Применяет операции журнала (upsert / delete по source / delete_ids) к списку items."""
+    rows: Dict[str, int] = {}
+    by_source: Dict[str, Set[int]] = {}
+    for i, it in enumerate(items):
+        c = it.get("chunk", {})
+        rows[str(c.get("id", ""))] = i
+        by_source.setdefault(str(c.get("source", "") or "").lower(), set()).add(i)
+
+    out: List[Optional[Dict[str, Any]]] = list(items)
+    for line in journal.read_text(encoding="utf-8").splitlines():
+        try:
+            op = json.loads(line)
+        except ValueError:
+            continue  # недописанная последняя строка после падения
+        if op.get("op") == "upsert":
+            item = op.get("item", {})
+            c = item.get("chunk", {})
+            cid = str(c.get("id", ""))
+            old = rows.get(cid)
+            if old is not None:
+                out[old] = None
+            rows[cid] = len(out)
+            by_source.setdefault(str(c.get("source", "") or "").lower(), set()).add(len(out))
+            out.append(item)
+        elif op.get("op") == "delete":
+            for row in by_source.pop(str(op.get("source", "")).lower(), set()):
+                out[row] = None
+        elif op.get("op") == "delete_ids":
+            for cid in op.get("ids", []):
+                row = rows.pop(str(cid), None)
+                if row is not None and out[row] is not None:
+                    by_source.get(_item_source(out[row]), set()).discard(row)  # type: ignore[arg-type]
+                    out[row] = None
+    return [it for it in out if it is not None]
+
+
+def _read_items(path: Path) -> List[Dict[str, Any]]:
+    """Базовый файл + ещё не слитые журналы JsonVectorStore (их видят все бэкенды с этим форматом)."""
+    items = _read_base(path)
+    for journal in reversed(_journal_paths(path)):
+        if journal.exists():
+            items = _replay(items, journal)
+    return items
+
+
+def _write_items(path: Path, items: List[Dict[str, Any]]) -> None:
+    """Полная перезапись базового файла; журналы после неё не нужны."""
+    _atomic_write(path, json.dumps({"items": items}, ensure_ascii=False, indent=2))
+    for journal in _journal_paths(path):
+        journal.unlink(missing_ok=True)
+
+
+def _append_ops(journal: Path, ops: Sequence[Dict[str, Any]]) -> None:
+    with journal.open("a", encoding="utf-8") as f:
+        f.write("".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops))
+
+
+def _count_ops(journal: Path) -> int:
+    if not journal.exists():
+        return 0
+    with journal.open("rb") as f:
+        return sum(1 for _ in f)
+
+
+class _OpLog:
+    """
+    Журнал операций рядом с базовым файлом — для хранилищ, которые держат всё в памяти (numpy, hnsw, bm25).
+    Батч дописывает O(батча); базовый файл переписывается, когда журнал перерос живое состояние
+    (due), так что суммарная запись линейна по объёму ingest, а не O(N²/batch).
+    """
+
+    def __init__(self, journal: Path, min_ops: int = 2000):
+        self.journal = journal
+        self.min_ops = max(1, int(min_ops))
+        self.ops = _count_ops(journal)
+
+    def append(self, ops: Sequence[Dict[str, Any]]) -> None:
+        _append_ops(self.journal, ops)
+        self.ops += len(ops)
+
+    def due(self, live: int) -> bool:
+        return self.ops >= max(self.min_ops, int(live))
+
+    def reset(self) -> None:
+        """Базовый файл только что переписан целиком (_write_items удаляет журналы)."""
+        self.journal.unlink(missing_ok=True)
+        self.ops = 0
+
+
+def _chunk_to_dict(ch: DocumentChunk) -> Dict[str, Any]:
+    return {
+        "id": ch.id,
+        "text": ch.text,
+        "source": ch.source,
+        "page": ch.page,
+        "tokens": int(ch.tokens),
+        "meta": ch.meta,
+    }
+
+
+def _chunk_from_dict(c: Dict[str, Any]) -> DocumentChunk:
+    return DocumentChunk(
+        id=str(c.get("id", "")),
+        text=str(c.get("text", "")),
+        source=str(c.get("source", "")),
+        page=c.get("page"),
+        tokens=int(c.get("tokens", 0) or 0),
+        meta=c.get("meta", {}) if isinstance(c.get("meta", {}), dict) else {},
+    )
+
+
+def _sparse_to_dict(v: SparseVector) -> Dict[str, Any]:
+    return {"dim": int(v.dim), "idx": list(v.indices), "val": list(v.values)}
+
+
+def _sparse_dot(query: List[float], sp: Dict[str, Any]) -> float:
+    n = len(query)
+    return sum(query[i] * x for i, x in zip(sp.get("idx", []), sp.get("val", [])) if i < n)
+
+
+Item = Dict[str, Any]
+
+
+def _item_vector(it: Item) -> Optional[List[float]]:
+    """Плотный вектор строки; разреженные строки ({"sparse": {...}}) разворачиваются."""
+    v = it.get("vector")
+    if isinstance(v, list):
+        return v
+    sp = it.get("sparse")
+    if isinstance(sp, dict):
+        return SparseVector(int(sp.get("dim", 0)), tuple(sp.get("idx", [])), tuple(sp.get("val", []))).to_dense()
+    return None
+
+
+def _item_id(it: Item) -> str:
+    return str(it.get("chunk", {}).get("id", ""))
+
+
+def _item_source(it: Item) -> str:
+    return str(it.get("chunk", {}).get("source", "") or "").lower()
+
+
+def _item_grouped(it: Item) -> bool:
+    meta = it.get("chunk", {}).get("meta")
+    return isinstance(meta, dict) and is_grouped(meta)
+
+
+# грубая оценка памяти на чанк сверх вектора: текст, метаданные, id, служебные структуры
+_CHUNK_OVERHEAD = 1024
+_PY_NUMBER = 32  # float/int из json в python-списке: объект + указатель
+
+
+def _item_nbytes(it: Item) -> int:
+    """Оценка памяти строки: векторы здесь — python-списки, разреженные — только ненулевые координаты."""
+    n = _CHUNK_OVERHEAD
+    v = it.get("vector")
+    if isinstance(v, list):
+        n += _PY_NUMBER * len(v)
+    sp = it.get("sparse")
+    if isinstance(sp, dict):
+        n += 2 * _PY_NUMBER * len(sp.get("idx", []))
+    return n
+
+
+@dataclass(frozen=True)
+class _Snapshot:
+    """
+    Состояние JsonVectorStore на одно поколение. Списки и словари общие у всех снимков между компакциями
+    и только дополняются: новая строка дописывается в items, удалённая получает в died поколение удаления.
+    Снимок видит первые n строк; строка жива, если died[row] == 0 или она удалена позже его generation.
+    Поэтому запись стоит O(батча), а не копии хранилища, а читатели по-прежнему обходятся без локов.
+    """
+    items: List[Item] = field(default_factory=list)
+    died: List[int] = field(default_factory=list)
+    rows: Dict[str, int] = field(default_factory=dict)  # chunk id -> последняя живая строка
+    by_source: Dict[str, List[int]] = field(default_factory=dict)  # включая удалённые строки
+    grouped: List[int] = field(default_factory=list)  # строки канонических чанков групп почти-дубликатов
+    n: int = 0
+    live: int = 0
+    dead: int = 0
+    generation: int = 0
+    nbytes: int = 0  # _item_nbytes по всем строкам, включая удалённые (они в памяти до компакции)
+
+    def alive(self, row: int) -> bool:
+        if row >= self.n:
+            return False
+        d = self.died[row]
+        return d == 0 or d > self.generation
+
+    def append(self, item: Item) -> int:
+        """Только для писателя под локом: строка станет видна снимкам с n > row."""
+        row = len(self.items)
+        self.items.append(item)
+        self.died.append(0)
+        self.by_source.setdefault(_item_source(item), []).append(row)
+        if _item_grouped(item):
+            self.grouped.append(row)
+        self.rows[_item_id(item)] = row
+        return row
+
+    @staticmethod
+    def build(items: Sequence[Item], generation: int) -> "_Snapshot":
+        snap = _Snapshot(generation=generation)
+        for it in items:
+            old = snap.rows.get(_item_id(it))
+            if old is not None:
+                snap.died[old] = generation  # повтор id: жива последняя строка
+            snap.append(it)
+        n = len(snap.items)
+        nbytes = sum(_item_nbytes(it) for it in snap.items)
+        return replace(snap, n=n, live=len(snap.rows), dead=n - len(snap.rows), nbytes=nbytes)
+
+
 class JsonVectorStore(VectorStore):
     """
     файл JSON: { "items": [ {"chunk": {...}, "vector": [...]}, ... ] }
     upsert делаем по chunk.id (чтобы не раздувать файл бесконечно)
+
+    sparse=True: векторы хранятся как {"sparse": {"dim", "idx", "val"}} — только ненулевые координаты,
+    скоринг идёт по ним же (для hashed bag-of-words это доли процента от dim), а разреженный запрос
+    (SparseVector) не разворачивается вовсе. Строки обоих видов
+    могут лежать в одном файле; numpy/hnsw при загрузке разворачивают разреженные в плотные.
+
+    Изменения не переписывают файл: они дописываются в журнал <path>.journal.jsonl, а в памяти
+    держатся индексы chunk id -> строка и source -> строки; удалённые строки становятся tombstone'ами.
+    Так замена документа стоит O(чанков документа). Когда tombstone'ов больше compact_ratio
+    или в журнале накопилось max_journal_ops операций, фоновый компактор переписывает базовый файл.
+
+    Состояние в памяти — снимок (_Snapshot) над общими append-only структурами: поиск берёт текущий
+    снимок без локов, писатели (под локом) дописывают строки, отмечают удалённые поколением и атомарно
+    подменяют ссылку на снимок. Поиск во время ingest видит либо старое, либо новое состояние целиком.
     """
 
-    def __init__(self, path: str):
+    def __init__(
+        self,
+        path: str,
+        *,
+        compact_ratio: float = 0.3,
+        max_journal_ops: int = 2000,
+        sparse: bool = False,
+    ):
         self.path = Path(path)
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        self._items: List[Dict[str, Any]] = []
+        self._journal, self._journal_old = _journal_paths(self.path)
+        self.compact_ratio = float(compact_ratio)
+        self.max_journal_ops = max(1, int(max_journal_ops))
+        self._sparse = bool(sparse)
+
+        self._lock = threading.RLock()
+        self._compactor: Optional[threading.Thread] = None
+        self._snap = _Snapshot()
+        self._journal_ops = 0
         self._load()
 
     def _load(self) -> None:
-        if not self.path.exists():
-            self._items = []
-            return
-        try:
-            raw = self.path.read_text(encoding="utf-8")
-            data = json.loads(raw) if raw.strip() else {}
-            items = data.get("items", [])
-            self._items = items if isinstance(items, list) else []
-        except Exception:
-            self._items = []
+        with _compaction_lock(self.path):
+            items = _read_items(self.path)
+            if self._journal_old.exists():
+                # компактор упал, не дописав базовый файл (живой держал бы лок) — доделываем синхронно
+                _write_items(self.path, items)
+            else:
+                self._journal_ops = _count_ops(self._journal)
+        self._snap = _Snapshot.build(items, _next_generation())
+
+    def _append_journal(self, ops: List[Dict[str, Any]]) -> None:
+        _append_ops(self._journal, ops)
+        self._journal_ops += len(ops)
 
-    def _save(self) -> None:
-        _atomic_write(self.path, json.dumps({"items": self._items}, ensure_ascii=False, indent=2))
+    @property
+    def generation(self) -> int:
+        return self._snap.generation
+
+    @property
+    def sparse(self) -> bool:
+        return self._sparse
+
+    @property
+    def dim(self) -> int:
+        snap = self._snap
+        for row in range(snap.n):
+            if snap.alive(row):
+                it = snap.items[row]
+                if isinstance(it.get("sparse"), dict):
+                    return int(it["sparse"].get("dim", 0))
+                v = it.get("vector", [])
+                return len(v) if isinstance(v, list) else 0
+        return 0
 
     def count(self) -> int:
-        return len(self._items)
+        return self._snap.live
+
+    @property
+    def nbytes(self) -> int:
+        """Оценка памяти хранилища (для LRU коллекций NamespaceRegistry)."""
+        return self._snap.nbytes
+
+    def vectors(self, chunk_ids: Sequence[str]) -> List[Optional[List[float]]]:
+        """По последнему записанному состоянию (rows общий у снимков)."""
+        snap = self._snap
+        rows = [snap.rows.get(cid) for cid in chunk_ids]
+        return [None if r is None else _item_vector(snap.items[r]) for r in rows]
+
+    def _kill(self, snap: _Snapshot, victims: Sequence[int], generation: int) -> None:
+        """Под локом: строки victims (живые в последнем состоянии) удалены в поколении generation."""
+        for row in victims:
+            snap.died[row] = generation
+            cid = _item_id(snap.items[row])
+            if snap.rows.get(cid) == row:
+                del snap.rows[cid]
 
     def delete_by_source(self, source: str) -> int:
-        before = len(self._items)
         s = (source or "").lower()
-        self._items = [
-            it for it in self._items
-            if (it.get("chunk", {}).get("source", "") or "").lower() != s
-        ]
-        removed = before - len(self._items)
-        if removed:
-            self._save()
-        return removed
+        with self._lock:
+            snap = self._snap
+            victims = [row for row in snap.by_source.get(s, ()) if snap.died[row] == 0]
+            if not victims:
+                return 0
+            gen = _next_generation()
+            self._kill(snap, victims, gen)
+            self._append_journal([{"op": "delete", "source": s}])
+            self._snap = replace(snap, live=snap.live - len(victims), dead=snap.dead + len(victims), generation=gen)
+            self._maybe_compact()
+        return len(victims)
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        with self._lock:
+            snap = self._snap
+            victims = {snap.rows[cid]: cid for cid in chunk_ids if cid in snap.rows}
+            if not victims:
+                return 0
+            gen = _next_generation()
+            self._kill(snap, list(victims), gen)
+            self._append_journal([{"op": "delete_ids", "ids": sorted(victims.values())}])
+            self._snap = replace(snap, live=snap.live - len(victims), dead=snap.dead + len(victims), generation=gen)
+            self._maybe_compact()
+        return len(victims)
 
     def upsert(self, chunks: Sequence[DocumentChunk], vectors: Sequence[List[float]]) -> None:
-        idx: Dict[str, int] = {}
-        for i, it in enumerate(self._items):
-            ch = it.get("chunk", {})
-            cid = str(ch.get("id", ""))
-            if cid:
-                idx[cid] = i
-
-        changed = False
-        for ch, v in zip(chunks, vectors):
-            item = {
-                "chunk": {
-                    "id": ch.id,
-                    "text": ch.text,
-                    "source": ch.source,
-                    "page": ch.page,
-                    "tokens": int(ch.tokens),
-                    "meta": ch.meta,
-                },
-                "vector": list(v),
-            }
-
-            if ch.id in idx:
-                self._items[idx[ch.id]] = item
-            else:
-                self._items.append(item)
-            changed = True
+        if self._sparse:
+            self._upsert_items([
+                {"chunk": _chunk_to_dict(ch), "sparse": _sparse_to_dict(SparseVector.from_dense(v))}
+                for ch, v in zip(chunks, vectors)
+            ])
+        else:
+            self._upsert_items([{"chunk": _chunk_to_dict(ch), "vector": list(v)} for ch, v in zip(chunks, vectors)])
+
+    def upsert_sparse(self, chunks: Sequence[DocumentChunk], vectors: Sequence[SparseVector]) -> None:
+        if not self._sparse:
+            self.upsert(chunks, [v.to_dense() for v in vectors])
+            return
+        self._upsert_items([{"chunk": _chunk_to_dict(ch), "sparse": _sparse_to_dict(v)} for ch, v in zip(chunks, vectors)])
 
-        if changed:
-            self._save()
+    def _upsert_items(self, new_items: List[Item]) -> None:
+        if not new_items:
+            return
+        with self._lock:
+            snap = self._snap
+            gen = _next_generation()
+            replaced = 0
+            for item in new_items:
+                old = snap.rows.get(_item_id(item))
+                if old is not None:
+                    self._kill(snap, [old], gen)
+                    replaced += 1
+                snap.append(item)
+
+            self._append_journal([{"op": "upsert", "item": item} for item in new_items])
+            self._snap = replace(
+                snap,
+                n=len(snap.items),
+                live=snap.live + len(new_items) - replaced,
+                dead=snap.dead + replaced,
+                generation=gen,
+                nbytes=snap.nbytes + sum(_item_nbytes(it) for it in new_items),
+            )
+            self._maybe_compact()
 
-    def search(self, query_vector: List[float], top_k: int) -> List[DocumentChunk]:
+    # ---------- compaction ----------
+
+    def _maybe_compact(self) -> None:
+        snap = self._snap
+        if snap.dead > self.compact_ratio * snap.n or self._journal_ops >= self.max_journal_ops:
+            self._compact_async()
+
+    def _compact_async(self) -> None:
+        """
+        Под локом: снимок без tombstone'ов и журнал откладывается в .old (новые записи идут в новый журнал).
+        В фоне: пишем базовый файл из живых строк и удаляем .old.
+        Содержимое не меняется, поэтому поколение тоже.
+        Лок файла (_compaction_lock) берётся здесь и отпускается потоком компактора; занят — компакция откладывается.
+        """
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            file_lock = _compaction_lock(self.path)
+            if not file_lock.acquire(blocking=False):
+                return
+            snap = self._snap
+            live = [snap.items[row] for row in range(snap.n) if snap.died[row] == 0]
+            self._snap = _Snapshot.build(live, snap.generation)
+            if self._journal.exists():
+                self._journal.replace(self._journal_old)
+            self._journal_ops = 0
+
+        def run() -> None:
+            try:
+                _atomic_write(self.path, json.dumps({"items": live}, ensure_ascii=False, indent=2))
+                self._journal_old.unlink(missing_ok=True)
+            finally:
+                file_lock.release()
+
+        self._compactor = threading.Thread(target=run, name="json-store-compact", daemon=True)
+        self._compactor.start()
+
+    def wait_for_compaction(self, timeout: Optional[float] = None) -> None:
+        t = self._compactor
+        if t is not None:
+            t.join(timeout)
+
+    def compact(self) -> Dict[str, int]:
+        """Синхронно сливает журнал и tombstone'ы в базовый файл."""
+        self.wait_for_compaction()
+        with self._lock:
+            before = self._snap.n
+            self._compact_async()
+        self.wait_for_compaction()
+        return {"rows_before": before, "rows_after": self._snap.n}
+
+    def search(
+        self,
+        query_vector: Union[List[float], SparseVector],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[DocumentChunk]:
+        """query_vector может быть и SparseVector (запрос hashed-эмбеддера): тогда скоринг — sparse·sparse."""
         k = max(0, int(top_k))
-        if k == 0 or not self._items:
+        snap = self._snap
+        if k == 0 or not snap.live:
             return []
+        sparse_query = dict(zip(query_vector.indices, query_vector.values)) if isinstance(query_vector, SparseVector) else None
+
+        rows: Iterable[int] = range(snap.n)
+        if where is not None and where.sources is not None:
+            rows = sorted(set(snap.grouped).union(*(snap.by_source.get(s, ()) for s in where.sources)))
 
-        scored: List[Tuple[float, Dict[str, Any]]] = []
-        for it in self._items:
-            v = it.get("vector", [])
-            if not isinstance(v, list) or not v:
+        scored: List[Tuple[float, Item]] = []
+        for row in rows:
+            if not snap.alive(row):
+                continue
+            it = snap.items[row]
+            v = it.get("vector")
+            sp = it.get("sparse")
+            if not (isinstance(v, list) and v) and not isinstance(sp, dict):
                 continue
-            score = _dot(query_vector, v)
+            if where is not None:
+                c = it.get("chunk", {})
+                if not where.matches(str(c.get("source", "")), c.get("page"), c.get("meta") or {}):
+                    continue
+            if isinstance(v, list) and v:
+                score = query_vector.dot(v) if sparse_query is not None else _dot(query_vector, v)
+            elif sparse_query is not None:
+                score = sum(sparse_query.get(i, 0.0) * x for i, x in zip(sp.get("idx", []), sp.get("val", [])))
+            else:
+                score = _sparse_dot(query_vector, sp)
             scored.append((score, it))
 
         scored.sort(key=lambda x: x[0], reverse=True)
         top = scored[:k]
 
-        out: List[DocumentChunk] = []
-        for _, it in top:
-            c = it.get("chunk", {})
-            out.append(
-                DocumentChunk(
-                    id=str(c.get("id", "")),
-                    text=str(c.get("text", "")),
-                    source=str(c.get("source", "")),
-                    page=c.get("page"),
-                    tokens=int(c.get("tokens", 0) or 0),
-                    meta=c.get("meta", {}) if isinstance(c.get("meta", {}), dict) else {},
-                )
-            )
-        return out
+        return [_chunk_from_dict(it.get("chunk", {})) for _, it in top]
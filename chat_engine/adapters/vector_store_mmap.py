@@ -0,0 +1,587 @@
+from __future__ import annotations
+
+import json
+import math
+import mmap
+import struct
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from chat_engine.adapters.rwlock import RWLock
+from chat_engine.adapters.quantization import Quantizer, load_quantizer, train_quantizer
+from chat_engine.adapters.vector_store_json import _atomic_write, _chunk_from_dict, _chunk_to_dict, _next_generation
+from chat_engine.adapters.vector_store_numpy import _top_k, _top_k_rows
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter, is_grouped
+from chat_engine.ports.vector_store import VectorStore
+
+_MAGIC = b"CEVS"
+_VERSION = 1
+# magic(4) | version(u32) | dim(u32) | rows(u64) | padding до 32 байт
+_HEADER = struct.Struct("<4sIIQ")
+_HEADER_SIZE = 32
+_TRAIN_SAMPLE = 65536
+
+
+def _write_vec_file(path: Path, block: np.ndarray) -> None:
+    rows, dim = block.shape
+    header = _HEADER.pack(_MAGIC, _VERSION, dim, rows).ljust(_HEADER_SIZE, b"\0")
+    with path.open("wb") as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(block, dtype="<f4").tobytes())
+
+
+def _read_vec_header(path: Path) -> Tuple[int, int]:
+    with path.open("rb") as f:
+        magic, version, dim, rows = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError(f"Bad vector segment header: {path}")
+    return int(dim), int(rows)
+
+
+def _page_column(chunks) -> np.ndarray:
+    return np.asarray([-1 if ch.page is None else int(ch.page) for ch in chunks], dtype="<i4")
+
+
+def _source_ranges(chunks: Sequence[DocumentChunk]) -> Dict[str, List[List[int]]]:
+    """source -> список [start, stop) подряд идущих строк сегмента."""
+    out: Dict[str, List[List[int]]] = {}
+    for row, ch in enumerate(chunks):
+        ranges = out.setdefault(ch.source, [])
+        if ranges and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+    return out
+
+
+@dataclass
+class _Segment:
+    name: str
+    rows: int
+    sources: Dict[str, List[List[int]]]
+    vectors: np.ndarray
+    offsets: np.ndarray
+    meta: mmap.mmap
+    dead: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=bool))
+    codes: Optional[np.ndarray] = None
+    pages: Optional[np.ndarray] = None
+    grouped: Optional[List[int]] = None  # строки-канонические чанки групп почти-дубликатов
+
+    def chunk(self, row: int) -> DocumentChunk:
+        start, stop = int(self.offsets[row]), int(self.offsets[row + 1])
+        return _chunk_from_dict(json.loads(self.meta[start:stop].decode("utf-8")))
+
+    def live(self) -> int:
+        return self.rows - int(self.dead.sum())
+
+
+class MmapVectorStore(VectorStore):
+    """
+    Бинарное хранилище из append-only сегментов в каталоге root:
+      manifest.json        — список сегментов, строки по source, tombstones (точка коммита)
+      <seg>.vec            — заголовок + float32-матрица (rows x dim), открывается через mmap
+      <seg>.meta.jsonl     — метаданные чанков, по строке на чанк (читаются через mmap по смещению)
+      <seg>.off            — uint64-смещения строк в .meta.jsonl
+      <seg>.ids            — id чанков (нужны только для upsert по id, читаются лениво)
+      <seg>.codes          — коды квантования (если включено), держатся в RAM
+      <seg>.pages          — int32 page по строкам (-1 = нет), для фильтров where; читается лениво
+      quantizer.npz        — параметры квантователя (int8 min/scale или кодбуки PQ)
+
+    Старт = чтение manifest + mmap сегментов, не зависит от объёма корпуса.
+    upsert пишет новый сегмент, delete_by_source только помечает строки tombstone'ами;
+    compact() сливает живые строки в один сегмент.
+    Сегменты сливаются и сами, по уровням размера: как только на одном уровне (живых строк
+    ~ merge_factor**уровень) набирается merge_factor сегментов, они становятся одним сегментом следующего;
+    сегмент, в котором удалено больше max_dead_ratio строк, переписывается без них. Поэтому сегментов
+    O(merge_factor * log N), а не по одному на батч ingest, и каждая строка переписывается O(log N) раз.
+
+    quantization="int8"|"pq": поиск идёт по кодам в RAM (asymmetric distance computation),
+    затем top-rerank кандидатов пересчитываются точно по float32 из mmap (rerank=0 — без этого).
+    Квантователь обучается на первом upsert и переобучается (на выборке из всех живых строк), когда
+    хранилище выросло в retrain_growth раз с прошлого обучения, и при compact(). Перекодирование
+    всех сегментов при росте в разы в сумме линейно по числу строк.
+
+    Фильтр where превращается в битовую маску строк сегмента до скоринга: source — по диапазонам
+    из manifest, page — по .pages, meta — разбором только уже отобранных строк; канонические чанки
+    групп почти-дубликатов (их строки тоже в manifest) проверяются по всем своим местам.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        *,
+        quantization: str = "none",
+        pq_m: int = 8,
+        rerank: int = 32,
+        retrain_growth: float = 2.0,
+        merge_factor: int = 8,
+        max_dead_ratio: float = 0.3,
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._manifest_path = self.root / "manifest.json"
+        self._quantizer_path = self.root / "quantizer.npz"
+        self.quantization = quantization
+        self.pq_m = int(pq_m)
+        self.rerank = max(0, int(rerank))
+        self.retrain_growth = max(1.0, float(retrain_growth))
+        self.merge_factor = max(2, int(merge_factor))
+        self.max_dead_ratio = float(max_dead_ratio)
+        self._quantizer: Optional[Quantizer] = None
+        self._trained_rows = 0  # живых строк при последнем обучении квантователя
+        self._dim = 0
+        self._next_seq = 1
+        self._segments: List[_Segment] = []
+        self._id_index: Optional[Dict[str, Tuple[str, int]]] = None
+        self._generation = _next_generation()
+        self._rw = RWLock()  # поиски идут параллельно с фоновым ingest
+        self._load()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def dim(self) -> int:
+        return self._dim
+
+    # ---------- manifest / segments ----------
+
+    def _load(self) -> None:
+        self._segments = []
+        if self.quantization != "none" and self._quantizer_path.exists():
+            arrays = np.load(self._quantizer_path)
+            q = load_quantizer(arrays)
+            self._quantizer = q if q.kind == self.quantization else None
+            # у квантователей старого формата числа нет: переобучатся на первом upsert
+            self._trained_rows = int(arrays["trained_rows"]) if "trained_rows" in arrays.files else 0
+        if not self._manifest_path.exists():
+            return
+        data = json.loads(self._manifest_path.read_text(encoding="utf-8") or "{}")
+        self._dim = int(data.get("dim", 0) or 0)
+        self._next_seq = int(data.get("next_seq", 1) or 1)
+        tombstones: Dict[str, List[int]] = data.get("tombstones", {}) or {}
+        for s in data.get("segments", []):
+            seg = self._open_segment(str(s["name"]), dict(s.get("sources", {})), s.get("grouped"))
+            dead = tombstones.get(seg.name)
+            if dead:
+                seg.dead[np.asarray(dead, dtype=np.int64)] = True
+            self._segments.append(seg)
+
+        if self.quantization != "none" and self._quantizer is None and self._segments:
+            self._train_quantizer(self._training_sample(), sum(seg.live() for seg in self._segments))
+
+    def _open_segment(
+        self, name: str, sources: Dict[str, List[List[int]]], grouped: Optional[List[int]] = None
+    ) -> _Segment:
+        vec_path = self.root / f"{name}.vec"
+        dim, rows = _read_vec_header(vec_path)
+        vectors = (
+            np.memmap(vec_path, dtype="<f4", mode="r", offset=_HEADER_SIZE, shape=(rows, dim))
+            if rows
+            else np.zeros((0, dim), dtype=np.float32)
+        )
+        offsets = np.memmap(self.root / f"{name}.off", dtype="<u8", mode="r")
+        with (self.root / f"{name}.meta.jsonl").open("rb") as f:
+            meta = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        seg = _Segment(
+            name=name,
+            rows=rows,
+            sources=sources,
+            vectors=vectors,
+            offsets=offsets,
+            meta=meta,
+            dead=np.zeros(rows, dtype=bool),
+            grouped=grouped,
+        )
+        self._attach_codes(seg)
+        return seg
+
+    def _attach_codes(self, seg: _Segment) -> None:
+        """Читает коды сегмента с диска, а если их нет (или квантователь сменился) — кодирует заново."""
+        q = self._quantizer
+        if q is None:
+            seg.codes = None
+            return
+        path = self.root / f"{seg.name}.codes"
+        if path.exists() and path.stat().st_size == seg.rows * q.code_size * np.dtype(q.dtype).itemsize:
+            seg.codes = np.fromfile(path, dtype=q.dtype).reshape(seg.rows, q.code_size)
+            return
+        seg.codes = q.encode(np.asarray(seg.vectors, dtype=np.float32))
+        seg.codes.tofile(path)
+
+    def _training_sample(self) -> np.ndarray:
+        """Не больше _TRAIN_SAMPLE живых строк, равномерно по всем сегментам (без склейки всего хранилища)."""
+        lives = [np.flatnonzero(~seg.dead) for seg in self._segments]
+        total = sum(len(live) for live in lives)
+        picks = (
+            np.sort(np.random.default_rng(0).choice(total, size=_TRAIN_SAMPLE, replace=False))
+            if total > _TRAIN_SAMPLE
+            else np.arange(total)
+        )
+        out: List[np.ndarray] = []
+        start = 0
+        for seg, live in zip(self._segments, lives):
+            lo, hi = np.searchsorted(picks, [start, start + len(live)])
+            if hi > lo:
+                out.append(np.asarray(seg.vectors[live[picks[lo:hi] - start]], dtype=np.float32))
+            start += len(live)
+        return np.concatenate(out) if out else np.zeros((0, self._dim), dtype=np.float32)
+
+    def _maybe_retrain(self) -> None:
+        """Под записью: первое обучение или рост живых строк в retrain_growth раз."""
+        if self.quantization == "none":
+            return
+        live = sum(seg.live() for seg in self._segments)
+        if self._quantizer is None or live >= self.retrain_growth * max(1, self._trained_rows):
+            self._train_quantizer(self._training_sample(), live)
+
+    def _train_quantizer(self, data: np.ndarray, rows: int) -> None:
+        if len(data) > _TRAIN_SAMPLE:
+            data = data[np.random.default_rng(0).choice(len(data), size=_TRAIN_SAMPLE, replace=False)]
+        self._quantizer = train_quantizer(self.quantization, data, pq_m=self.pq_m)
+        self._trained_rows = int(rows)
+        tmp = self.root / "quantizer.tmp.npz"
+        np.savez(tmp, trained_rows=np.int64(rows), **self._quantizer.to_arrays())
+        tmp.replace(self._quantizer_path)
+        for seg in self._segments:
+            (self.root / f"{seg.name}.codes").unlink(missing_ok=True)
+            self._attach_codes(seg)
+
+    def _save_manifest(self) -> None:
+        data: Dict[str, Any] = {
+            "version": _VERSION,
+            "dim": self._dim,
+            "next_seq": self._next_seq,
+            "segments": [
+                {"name": s.name, "rows": s.rows, "sources": s.sources, "grouped": self._grouped(s)}
+                for s in self._segments
+            ],
+            "tombstones": {s.name: np.flatnonzero(s.dead).tolist() for s in self._segments if s.dead.any()},
+        }
+        _atomic_write(self._manifest_path, json.dumps(data, ensure_ascii=False))
+
+    def _write_segment(self, chunks: Sequence[DocumentChunk], block: np.ndarray) -> _Segment:
+        name = f"seg-{self._next_seq:06d}"
+        self._next_seq += 1
+
+        offsets = [0]
+        with (self.root / f"{name}.meta.jsonl").open("wb") as f:
+            for ch in chunks:
+                line = json.dumps(_chunk_to_dict(ch), ensure_ascii=False).encode("utf-8") + b"\n"
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.asarray(offsets, dtype="<u8").tofile(self.root / f"{name}.off")
+        (self.root / f"{name}.ids").write_text("".join(f"{ch.id}\n" for ch in chunks), encoding="utf-8")
+        _page_column(chunks).tofile(self.root / f"{name}.pages")
+        _write_vec_file(self.root / f"{name}.vec", block)
+
+        grouped = [row for row, ch in enumerate(chunks) if is_grouped(ch.meta)]
+        return self._open_segment(name, _source_ranges(chunks), grouped)
+
+    def _ids(self) -> Dict[str, Tuple[str, int]]:
+        if self._id_index is None:
+            index: Dict[str, Tuple[str, int]] = {}
+            for seg in self._segments:
+                ids = (self.root / f"{seg.name}.ids").read_text(encoding="utf-8").splitlines()
+                for row, cid in enumerate(ids):
+                    if not seg.dead[row]:
+                        index[cid] = (seg.name, row)
+            self._id_index = index
+        return self._id_index
+
+    def _segment(self, name: str) -> _Segment:
+        return next(s for s in self._segments if s.name == name)
+
+    def _pages(self, seg: _Segment) -> np.ndarray:
+        if seg.pages is None:
+            path = self.root / f"{seg.name}.pages"
+            if path.exists() and path.stat().st_size == seg.rows * 4:
+                seg.pages = np.fromfile(path, dtype="<i4")
+            else:
+                seg.pages = _page_column(seg.chunk(r) for r in range(seg.rows))
+                seg.pages.tofile(path)
+        return seg.pages
+
+    def _grouped(self, seg: _Segment) -> List[int]:
+        """Строки групп почти-дубликатов; у сегментов из старого manifest — разбором .meta.jsonl один раз."""
+        if seg.grouped is None:
+            seg.grouped = [row for row in range(seg.rows) if is_grouped(seg.chunk(row).meta)]
+        return seg.grouped
+
+    def _blocked(self, seg: _Segment, where: Optional[SearchFilter]) -> np.ndarray:
+        """Маска строк, которые не участвуют в поиске: tombstones + всё, что не прошло фильтр."""
+        if where is None:
+            return seg.dead
+        blocked = seg.dead.copy()
+        if where.sources is not None:
+            allowed = np.zeros(seg.rows, dtype=bool)
+            for src, ranges in seg.sources.items():
+                if src.lower() in where.sources:
+                    for start, stop in ranges:
+                        allowed[start:stop] = True
+            blocked |= ~allowed
+        if where.pages is not None:
+            blocked |= ~np.isin(self._pages(seg), list(where.pages))
+        if where.locates:
+            # схлопнутый почти-дубликат подходит и по месту из meta["sources"]
+            for row in self._grouped(seg):
+                if blocked[row] and not seg.dead[row] and where.matches_chunk(seg.chunk(row)):
+                    blocked[row] = False
+        if where.meta:
+            for row in np.flatnonzero(~blocked):
+                if not where.matches_chunk(seg.chunk(int(row))):
+                    blocked[row] = True
+        return blocked
+
+    # ---------- VectorStore ----------
+
+    def count(self) -> int:
+        with self._rw.read():
+            return sum(s.live() for s in self._segments)
+
+    @property
+    def nbytes(self) -> int:
+        """Оценка памяти в куче: векторы и метаданные в mmap (page cache) не считаются — коды, маски, индекс id."""
+        with self._rw.read():
+            n = sum(seg.rows + (seg.codes.nbytes if seg.codes is not None else 0) for seg in self._segments)
+            return int(n + 128 * len(self._id_index or ()))
+
+    def vectors(self, chunk_ids: Sequence[str]) -> List[Optional[List[float]]]:
+        with self._rw.read():
+            ids = self._ids()
+            out: List[Optional[List[float]]] = []
+            for cid in chunk_ids:
+                loc = ids.get(cid)
+                out.append(None if loc is None else np.asarray(self._segment(loc[0]).vectors[loc[1]], dtype=np.float32).tolist())
+            return out
+
+    def delete_by_source(self, source: str) -> int:
+        with self._rw.write():
+            s = (source or "").lower()
+            removed = 0
+            for seg in self._segments:
+                for src, ranges in seg.sources.items():
+                    if src.lower() != s:
+                        continue
+                    for start, stop in ranges:
+                        removed += int((~seg.dead[start:stop]).sum())
+                        seg.dead[start:stop] = True
+
+            if removed:
+                if self._id_index is not None:
+                    self._id_index = {
+                        cid: loc for cid, loc in self._id_index.items() if not self._segment(loc[0]).dead[loc[1]]
+                    }
+                self._commit(self._merge_tiers())
+            return removed
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        with self._rw.write():
+            ids = self._ids()
+            removed = 0
+            for cid in set(chunk_ids):
+                loc = ids.pop(cid, None)
+                if loc is not None:
+                    self._segment(loc[0]).dead[loc[1]] = True
+                    removed += 1
+            if removed:
+                self._commit(self._merge_tiers())
+            return removed
+
+    def upsert(self, chunks: Sequence[DocumentChunk], vectors: Sequence[List[float]]) -> None:
+        with self._rw.write():
+            latest: Dict[str, int] = {}
+            pairs = list(zip(chunks, vectors))
+            for i, (ch, _) in enumerate(pairs):
+                latest[ch.id] = i
+            pairs = [pairs[i] for i in sorted(latest.values())]
+            if not pairs:
+                return
+
+            block = np.asarray([v for _, v in pairs], dtype=np.float32)
+            if block.ndim != 2:
+                raise ValueError("Vectors must have the same dimension")
+            if self._dim and block.shape[1] != self._dim:
+                raise ValueError(f"Vector dim mismatch: got {block.shape[1]} expected {self._dim}")
+            self._dim = int(block.shape[1])
+
+            ids = self._ids()
+            for ch, _ in pairs:
+                old = ids.get(ch.id)
+                if old is not None:
+                    self._segment(old[0]).dead[old[1]] = True
+
+            seg = self._write_segment([ch for ch, _ in pairs], block)
+            self._segments.append(seg)
+            for row, (ch, _) in enumerate(pairs):
+                ids[ch.id] = (seg.name, row)
+            self._maybe_retrain()
+            self._commit(self._merge_tiers())
+
+    def search(
+        self,
+        query_vector: List[float],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[DocumentChunk]:
+        with self._rw.read():
+            k = max(0, int(top_k))
+            if k == 0 or not self._segments:
+                return []
+
+            q = np.asarray(query_vector, dtype=np.float32)
+            if self._quantizer is not None and q.shape[0] == self._dim:
+                return self._search_quantized(q, k, where)
+            d = min(self._dim, int(q.shape[0]))
+
+            cand_scores: List[np.ndarray] = []
+            cand_rows: List[Tuple[_Segment, np.ndarray]] = []
+            for seg in self._segments:
+                blocked = self._blocked(seg, where)
+                if seg.rows == 0 or blocked.all():
+                    continue
+                scores = np.asarray(seg.vectors[:, :d] @ q[:d], dtype=np.float32)
+                scores[blocked] = -np.inf
+                top = _top_k(scores, min(k, seg.rows - int(blocked.sum())))
+                cand_scores.append(scores[top])
+                cand_rows.append((seg, top))
+
+            if not cand_scores:
+                return []
+
+            flat = np.concatenate(cand_scores)
+            owners = [(seg, int(r)) for seg, rows in cand_rows for r in rows]
+            return [owners[i][0].chunk(owners[i][1]) for i in _top_k(flat, k)]
+
+    def search_many(
+        self,
+        query_matrix: Sequence[List[float]],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[List[DocumentChunk]]:
+        with self._rw.read():
+            k = max(0, int(top_k))
+            qm = np.asarray(query_matrix, dtype=np.float32)
+            if qm.ndim != 2 or self._quantizer is not None or qm.shape[1] != self._dim:
+                return [self.search(q, top_k, where=where) for q in query_matrix]
+            if k == 0 or not self._segments:
+                return [[] for _ in range(qm.shape[0])]
+
+            cand_scores: List[np.ndarray] = []
+            cand_rows: List[Tuple[_Segment, np.ndarray]] = []
+            for seg in self._segments:
+                blocked = self._blocked(seg, where)
+                if seg.rows == 0 or blocked.all():
+                    continue
+                scores = np.asarray(qm @ seg.vectors.T, dtype=np.float32)
+                scores[:, blocked] = -np.inf
+                top = _top_k_rows(scores, min(k, seg.rows - int(blocked.sum())))
+                cand_scores.append(np.take_along_axis(scores, top, axis=1))
+                cand_rows.append((seg, top))
+
+            if not cand_scores:
+                return [[] for _ in range(qm.shape[0])]
+
+            flat = np.concatenate(cand_scores, axis=1)
+            out: List[List[DocumentChunk]] = []
+            for qi, best in enumerate(_top_k_rows(flat, k)):
+                owners = [(seg, int(r)) for seg, rows in cand_rows for r in rows[qi]]
+                out.append([owners[i][0].chunk(owners[i][1]) for i in best])
+            return out
+
+    def _search_quantized(self, q: np.ndarray, k: int, where: Optional[SearchFilter] = None) -> List[DocumentChunk]:
+        assert self._quantizer is not None
+        n_cand = max(k, self.rerank)
+
+        cand_scores: List[np.ndarray] = []
+        owners: List[Tuple[_Segment, int]] = []
+        for seg in self._segments:
+            blocked = self._blocked(seg, where)
+            if seg.rows == 0 or seg.codes is None or blocked.all():
+                continue
+            scores = self._quantizer.scores(seg.codes, q).astype(np.float32)
+            scores[blocked] = -np.inf
+            top = _top_k(scores, min(n_cand, seg.rows - int(blocked.sum())))
+            cand_scores.append(scores[top])
+            owners.extend((seg, int(r)) for r in top)
+
+        if not cand_scores:
+            return []
+        best = [owners[i] for i in _top_k(np.concatenate(cand_scores), n_cand)]
+
+        if self.rerank:
+            exact = np.asarray([float(seg.vectors[row] @ q) for seg, row in best], dtype=np.float32)
+            best = [best[i] for i in _top_k(exact, k)]
+        return [seg.chunk(row) for seg, row in best[:k]]
+
+    # ---------- maintenance ----------
+
+    def _tier(self, seg: _Segment) -> int:
+        return int(math.log(max(1, seg.live()), self.merge_factor))
+
+    def _merge_tiers(self) -> List[_Segment]:
+        """
+        Под записью: сливает переполненные уровни и сегменты с долей tombstones выше max_dead_ratio
+        (пока есть что сливать — слитый сегмент может переполнить следующий уровень).
+        Возвращает вышедшие из manifest сегменты: их файлы удаляются после коммита (_commit).
+        """
+        retired: List[_Segment] = []
+        while True:
+            victims = [seg for seg in self._segments if seg.rows - seg.live() > self.max_dead_ratio * seg.rows]
+            tiers: Dict[int, List[_Segment]] = {}
+            for seg in self._segments:
+                if all(seg is not v for v in victims):
+                    tiers.setdefault(self._tier(seg), []).append(seg)
+            for segs in tiers.values():
+                if len(segs) >= self.merge_factor:
+                    victims.extend(segs)
+            if not victims:
+                return retired
+            self._merge(victims)
+            retired.extend(victims)
+
+    def _merge(self, victims: List[_Segment], *, retrain: bool = False) -> int:
+        """Живые строки victims -> один новый сегмент в конце списка; возвращает число строк в нём."""
+        chunks: List[DocumentChunk] = []
+        blocks: List[np.ndarray] = []
+        for seg in victims:
+            live = np.flatnonzero(~seg.dead)
+            if live.size == 0:
+                continue
+            blocks.append(np.asarray(seg.vectors[live], dtype=np.float32))
+            chunks.extend(seg.chunk(int(r)) for r in live)
+
+        self._segments = [seg for seg in self._segments if all(seg is not v for v in victims)]
+        if chunks:
+            merged = np.concatenate(blocks)
+            if retrain and self.quantization != "none":
+                self._train_quantizer(merged, len(merged))
+            seg = self._write_segment(chunks, merged)
+            self._segments.append(seg)
+            if self._id_index is not None:
+                for row, ch in enumerate(chunks):
+                    self._id_index[ch.id] = (seg.name, row)
+        return len(chunks)
+
+    def _commit(self, retired: Sequence[_Segment]) -> None:
+        """Новое поколение + manifest (точка коммита), затем удаление файлов слитых сегментов."""
+        self._generation = _next_generation()
+        self._save_manifest()
+        for seg in retired:
+            seg.meta.close()
+            for ext in (".vec", ".meta.jsonl", ".off", ".ids", ".codes", ".pages"):
+                (self.root / f"{seg.name}{ext}").unlink(missing_ok=True)
+
+    def compact(self) -> Dict[str, int]:
+        """Сливает живые строки всех сегментов в один новый сегмент и удаляет старые файлы."""
+        with self._rw.write():
+            old = list(self._segments)
+            rows = self._merge(old, retrain=True)
+            self._commit(old)
+            return {"segments_before": len(old), "segments_after": len(self._segments), "rows": rows}
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import hashlib
+import re
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import RLock
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from chat_engine.adapters.vector_store_json import _CHUNK_OVERHEAD
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter, SparseVector
+from chat_engine.ports.lexical_index import LexicalIndex
+from chat_engine.ports.vector_store import VectorStore
+
+_UNSAFE_RE = re.compile(r"[^A-Za-z0-9_-]+")
+
+OpenNamespace = Callable[[str], Tuple[VectorStore, Optional[LexicalIndex]]]
+
+
+def namespace_slug(namespace: str) -> str:
+    """Безопасное имя файла для namespace; если пришлось что-то заменить — добавляется хэш (без коллизий)."""
+    ns = namespace or "default"
+    safe = _UNSAFE_RE.sub("_", ns)[:64]
+    if safe == ns:
+        return safe
+    return f"{safe}-{hashlib.sha1(ns.encode('utf-8')).hexdigest()[:10]}"
+
+
+def _approx_nbytes(store: VectorStore) -> int:
+    """Оценка самого хранилища (nbytes: разреженные, python-списки, mmap считают по-своему), иначе count x плотный float32."""
+    nbytes = getattr(store, "nbytes", None)
+    if nbytes is not None:
+        return int(nbytes)
+    dim = int(getattr(store, "dim", 0) or 0)
+    return int(store.count()) * (4 * dim + _CHUNK_OVERHEAD)
+
+
+@dataclass
+class _Tenant:
+    store: VectorStore
+    lexical: Optional[LexicalIndex]
+    nbytes: int
+
+
+@dataclass
+class _NsLock:
+    lock: RLock
+    users: int = 0  # потоков, взявших или ждущих лок: пока они есть, лок не удаляется из реестра
+
+
+def _retire(tenants: Sequence[_Tenant]) -> None:
+    """Выгруженное хранилище дописывает фоновую компакцию, прежде чем ссылку на него отпустят."""
+    for t in tenants:
+        wait = getattr(t.store, "wait_for_compaction", None)
+        if wait is not None:
+            wait()
+
+
+class NamespaceRegistry:
+    """
+    Отдельная коллекция (векторное хранилище + опционально BM25) на каждый namespace (user_id / tenant).
+    - коллекция открывается лениво, при первом обращении к ней;
+    - открытые коллекции лежат в LRU, и когда оценка их памяти превышает max_bytes,
+      самые давно использованные выгружаются (данные уже на диске — хранилища пишут при каждом изменении);
+    - запись и загрузка одного namespace сериализованы, так что выгруженную во время записи коллекцию
+      перечитают только после того, как запись закончилась.
+    """
+
+    def __init__(self, open_namespace: OpenNamespace, *, max_bytes: int, with_lexical: bool = False):
+        self._open = open_namespace
+        self.max_bytes = max(0, int(max_bytes))
+        self.with_lexical = bool(with_lexical)
+        self._lock = RLock()
+        self._ns_locks: Dict[str, _NsLock] = {}  # только для загруженных или занятых namespace
+        self._loaded: "OrderedDict[str, _Tenant]" = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+
+    # ---------- handles ----------
+
+    def store(self, namespace: str) -> "NamespacedVectorStore":
+        return NamespacedVectorStore(self, namespace)
+
+    def lexical_index(self, namespace: str) -> Optional["NamespacedLexicalIndex"]:
+        return NamespacedLexicalIndex(self, namespace) if self.with_lexical else None
+
+    def loaded(self) -> List[str]:
+        """Открытые сейчас namespace, от давно использованного к последнему."""
+        with self._lock:
+            return list(self._loaded)
+
+    def loaded_bytes(self) -> int:
+        with self._lock:
+            return sum(t.nbytes for t in self._loaded.values())
+
+    # ---------- LRU ----------
+
+    @contextmanager
+    def _ns_locked(self, namespace: str) -> Iterator[None]:
+        """
+        Лок namespace. Выгруженный namespace, который никто не держит, теряет лок (иначе реестр рос бы
+        на лок за каждый когда-либо виденный user_id); занятый — удаляет последний отпустивший.
+        """
+        with self._lock:
+            entry = self._ns_locks.get(namespace)
+            if entry is None:
+                entry = self._ns_locks[namespace] = _NsLock(RLock())
+            entry.users += 1
+        try:
+            with entry.lock:
+                yield
+        finally:
+            with self._lock:
+                entry.users -= 1
+                if not entry.users and namespace not in self._loaded:
+                    del self._ns_locks[namespace]
+
+    def _hit(self, namespace: str) -> Optional[_Tenant]:
+        with self._lock:
+            t = self._loaded.get(namespace)
+            if t is not None:
+                self._loaded.move_to_end(namespace)
+            return t
+
+    def _tenant(self, namespace: str) -> _Tenant:
+        t = self._hit(namespace)
+        if t is not None:
+            return t
+        with self._ns_locked(namespace):
+            t = self._hit(namespace)
+            if t is not None:
+                return t
+            store, lexical = self._open(namespace)
+            t = _Tenant(store=store, lexical=lexical, nbytes=_approx_nbytes(store))
+            with self._lock:
+                self._loaded[namespace] = t
+                self.loads += 1
+                evicted = self._evict()
+            _retire(evicted)
+            return t
+
+    def _evict(self) -> List[_Tenant]:
+        """Под self._lock; выгруженные коллекции вызывающий отдаёт в _retire уже без лока."""
+        evicted: List[_Tenant] = []
+        total = sum(t.nbytes for t in self._loaded.values())
+        while total > self.max_bytes and len(self._loaded) > 1:
+            ns, t = self._loaded.popitem(last=False)
+            total -= t.nbytes
+            self.evictions += 1
+            evicted.append(t)
+            entry = self._ns_locks.get(ns)
+            if entry is not None and not entry.users:
+                del self._ns_locks[ns]
+        return evicted
+
+    @contextmanager
+    def _writing(self, namespace: str) -> Iterator[_Tenant]:
+        with self._ns_locked(namespace):
+            t = self._tenant(namespace)
+            yield t
+            with self._lock:
+                t.nbytes = _approx_nbytes(t.store)
+                evicted = self._evict()
+            _retire(evicted)
+
+
+class NamespacedVectorStore(VectorStore):
+    """Лёгкая ручка на коллекцию namespace: каждый вызов берёт её из реестра (и при нужде загружает)."""
+
+    def __init__(self, registry: NamespaceRegistry, namespace: str):
+        self.registry = registry
+        self.namespace = namespace
+
+    def upsert(self, chunks: Sequence[DocumentChunk], vectors: Sequence[List[float]]) -> None:
+        with self.registry._writing(self.namespace) as t:
+            t.store.upsert(chunks, vectors)
+
+    def upsert_sparse(self, chunks: Sequence[DocumentChunk], vectors: Sequence[SparseVector]) -> None:
+        with self.registry._writing(self.namespace) as t:
+            t.store.upsert_sparse(chunks, vectors)
+
+    @property
+    def sparse(self) -> bool:
+        return bool(getattr(self.registry._tenant(self.namespace).store, "sparse", False))
+
+    def search(
+        self,
+        query_vector: List[float],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[DocumentChunk]:
+        return self.registry._tenant(self.namespace).store.search(query_vector, top_k, where=where)
+
+    def search_many(
+        self,
+        query_matrix: Sequence[List[float]],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[List[DocumentChunk]]:
+        return self.registry._tenant(self.namespace).store.search_many(query_matrix, top_k, where=where)
+
+    def count(self) -> int:
+        return self.registry._tenant(self.namespace).store.count()
+
+    def vectors(self, chunk_ids: Sequence[str]) -> List[Optional[List[float]]]:
+        return self.registry._tenant(self.namespace).store.vectors(chunk_ids)
+
+    @property
+    def generation(self) -> int:
+        return self.registry._tenant(self.namespace).store.generation
+
+    def delete_by_source(self, source: str) -> int:
+        with self.registry._writing(self.namespace) as t:
+            return t.store.delete_by_source(source)
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        with self.registry._writing(self.namespace) as t:
+            return t.store.delete_ids(chunk_ids)
+
+    def compact(self) -> Dict[str, int]:
+        with self.registry._writing(self.namespace) as t:
+            compact = getattr(t.store, "compact", None)
+            return compact() if compact is not None else {}
+
+
+class NamespacedLexicalIndex(LexicalIndex):
+    """То же для BM25-индекса namespace."""
+
+    def __init__(self, registry: NamespaceRegistry, namespace: str):
+        self.registry = registry
+        self.namespace = namespace
+
+    def _index(self, t: _Tenant) -> LexicalIndex:
+        if t.lexical is None:
+            raise RuntimeError(f"Namespace {self.namespace!r} has no lexical index")
+        return t.lexical
+
+    def add(self, chunks: Sequence[DocumentChunk]) -> None:
+        with self.registry._writing(self.namespace) as t:
+            self._index(t).add(chunks)
+
+    def search(self, query: str, top_k: int, *, where: Optional[SearchFilter] = None) -> List[DocumentChunk]:
+        return self._index(self.registry._tenant(self.namespace)).search(query, top_k, where=where)
+
+    def count(self) -> int:
+        return self._index(self.registry._tenant(self.namespace)).count()
+
+    @property
+    def generation(self) -> int:
+        return self._index(self.registry._tenant(self.namespace)).generation
+
+    def delete_by_source(self, source: str) -> int:
+        with self.registry._writing(self.namespace) as t:
+            return self._index(t).delete_by_source(source)
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        with self.registry._writing(self.namespace) as t:
+            return self._index(t).delete_ids(chunk_ids)
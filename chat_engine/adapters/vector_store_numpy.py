@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from chat_engine.adapters.rwlock import RWLock
+from chat_engine.adapters.vector_store_json import (
+    _CHUNK_OVERHEAD,
+    _chunk_from_dict,
+    _chunk_to_dict,
+    _item_vector,
+    _journal_paths,
+    _next_generation,
+    _OpLog,
+    _read_items,
+    _write_items,
+)
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter, is_grouped
+from chat_engine.ports.vector_store import VectorStore
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k лучших scores по убыванию: argpartition O(N) + сортировка только k кандидатов."""
+    n = int(scores.shape[0])
+    if k <= 0 or n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < n:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(n)
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def _top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """_top_k построчно для матрицы scores (m x N) -> (m x min(k, N))."""
+    m, n = scores.shape
+    k = min(int(k), n)
+    if k <= 0:
+        return np.zeros((m, 0), dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < n else np.tile(np.arange(n), (m, 1))
+    part = np.take_along_axis(scores, idx, axis=1)
+    return np.take_along_axis(idx, np.argsort(-part, axis=1, kind="stable"), axis=1)
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Все векторы лежат в одной непрерывной float32-матрице (N x dim):
+    поиск = один matvec + частичный отбор top-k (argpartition).
+    На диске тот же JSON, что и у JsonVectorStore, поэтому бэкенды взаимозаменяемы; изменения дописываются
+    в тот же журнал (<path>.journal.jsonl), базовый файл переписывается, только когда журнал перерос его.
+    Для фильтров (where) рядом с матрицей лежат столбцы атрибутов: код source и page по строкам,
+    так что отбор подходящих строк — векторная операция, а скорятся только они. Канонические чанки
+    групп почти-дубликатов помечены отдельным столбцом и проверяются по всем своим местам.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._chunks: List[DocumentChunk] = []
+        self._ids: Dict[str, int] = {}
+        self._mat = np.zeros((0, 0), dtype=np.float32)
+        self._src = np.zeros(0, dtype=np.int32)
+        self._page = np.zeros(0, dtype=np.int32)
+        self._multi = np.zeros(0, dtype=np.int32)  # 1 — канонический чанк группы почти-дубликатов
+        self._src_codes: Dict[str, int] = {}
+        self._generation = _next_generation()
+        self._rw = RWLock()  # поиски идут параллельно с фоновым ingest
+        self._log = _OpLog(_journal_paths(self.path)[0])
+        self._load()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def dim(self) -> int:
+        return int(self._mat.shape[1])
+
+    def _load(self) -> None:
+        self._chunks, self._ids = [], {}
+        self._mat = np.zeros((0, 0), dtype=np.float32)
+        items = _read_items(self.path)
+
+        rows: List[List[float]] = []
+        dim = 0
+        for it in items:
+            v = _item_vector(it) if isinstance(it, dict) else None
+            if not isinstance(v, list) or not v:
+                continue
+            if dim == 0:
+                dim = len(v)
+            if len(v) != dim:
+                continue
+            ch = _chunk_from_dict(it.get("chunk", {}))
+            self._ids[ch.id] = len(self._chunks)
+            self._chunks.append(ch)
+            rows.append(v)
+
+        if rows:
+            self._mat = np.asarray(rows, dtype=np.float32)
+        self._src = np.zeros(len(self._chunks), dtype=np.int32)
+        self._page = np.zeros(len(self._chunks), dtype=np.int32)
+        self._multi = np.zeros(len(self._chunks), dtype=np.int32)
+        for i, ch in enumerate(self._chunks):
+            self._set_attrs(i, ch)
+
+    def _set_attrs(self, i: int, ch: DocumentChunk) -> None:
+        src = (ch.source or "").lower()
+        code = self._src_codes.get(src)
+        if code is None:
+            code = self._src_codes[src] = len(self._src_codes)
+        self._src[i] = code
+        self._page[i] = -1 if ch.page is None else int(ch.page)
+        self._multi[i] = int(is_grouped(ch.meta))
+
+    def _save(self) -> None:
+        n = len(self._chunks)
+        items = [
+            {"chunk": _chunk_to_dict(ch), "vector": row}
+            for ch, row in zip(self._chunks, self._mat[:n].tolist())
+        ]
+        _write_items(self.path, items)
+        self._log.reset()
+
+    def _persist(self, ops: List[Dict[str, Any]]) -> None:
+        """Изменение — строками журнала JsonVectorStore; базовый файл переписывается, когда журнал перерос его."""
+        self._log.append(ops)
+        if self._log.due(len(self._chunks)):
+            self._save()
+
+    def _reserve(self, rows: int, dim: int) -> None:
+        """Амортизированный рост: ёмкость удваивается, занятые строки — [:len(self._chunks)]."""
+        cap, cur_dim = self._mat.shape
+        n = len(self._chunks)
+        if cur_dim != dim:
+            if n:
+                raise ValueError(f"Vector dim mismatch: got {dim} expected {cur_dim}")
+            cap = 0
+        elif rows <= cap:
+            return
+        new_cap = max(rows, cap * 2, 16)
+        grown = np.zeros((new_cap, dim), dtype=np.float32)
+        if n:
+            grown[:n] = self._mat[:n]
+        self._mat = grown
+        for name in ("_src", "_page", "_multi"):
+            col = np.zeros(new_cap, dtype=np.int32)
+            col[:n] = getattr(self, name)[:n]
+            setattr(self, name, col)
+
+    def count(self) -> int:
+        with self._rw.read():
+            return len(self._chunks)
+
+    @property
+    def nbytes(self) -> int:
+        """Оценка памяти: матрица и столбцы атрибутов (с запасом ёмкости) + чанки."""
+        with self._rw.read():
+            columns = self._src.nbytes + self._page.nbytes + self._multi.nbytes
+            return int(self._mat.nbytes + columns + len(self._chunks) * _CHUNK_OVERHEAD)
+
+    def vectors(self, chunk_ids: Sequence[str]) -> List[Optional[List[float]]]:
+        with self._rw.read():
+            rows = [self._ids.get(cid) for cid in chunk_ids]
+            return [None if r is None else self._mat[r].tolist() for r in rows]
+
+    def delete_by_source(self, source: str) -> int:
+        with self._rw.write():
+            s = (source or "").lower()
+            keep = [i for i, ch in enumerate(self._chunks) if (ch.source or "").lower() != s]
+            return self._delete(keep, {"op": "delete", "source": s})
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        with self._rw.write():
+            dead = {self._ids[cid]: cid for cid in chunk_ids if cid in self._ids}
+            if not dead:
+                return 0
+            keep = [i for i in range(len(self._chunks)) if i not in dead]
+            return self._delete(keep, {"op": "delete_ids", "ids": sorted(dead.values())})
+
+    def _delete(self, keep: List[int], op: Dict[str, Any]) -> int:
+        """Оставляет строки keep; op — та же операция в формате журнала."""
+        with self._rw.write():
+            removed = len(self._chunks) - len(keep)
+            if not removed:
+                return 0
+
+            self._keep_rows(np.asarray(keep, dtype=np.int64))
+            self._generation = _next_generation()
+            self._persist([op])
+            return removed
+
+    def _keep_rows(self, keep: np.ndarray) -> None:
+        """Оставляет только строки keep (в исходном порядке); наследники досинхронизируют свои индексы."""
+        self._mat = self._mat[keep] if keep.size else np.zeros((0, self.dim), dtype=np.float32)
+        self._src = self._src[keep]
+        self._page = self._page[keep]
+        self._multi = self._multi[keep]
+        self._chunks = [self._chunks[int(i)] for i in keep]
+        self._ids = {ch.id: i for i, ch in enumerate(self._chunks)}
+
+    def upsert(self, chunks: Sequence[DocumentChunk], vectors: Sequence[List[float]]) -> None:
+        with self._rw.write():
+            pairs = list(zip(chunks, vectors))
+            if not pairs:
+                return
+
+            block = np.asarray([v for _, v in pairs], dtype=np.float32)
+            if block.ndim != 2:
+                raise ValueError("Vectors must have the same dimension")
+            self._reserve(len(self._chunks) + len(pairs), int(block.shape[1]))
+
+            for (ch, _), row in zip(pairs, block):
+                i = self._ids.get(ch.id)
+                if i is None:
+                    i = len(self._chunks)
+                    self._ids[ch.id] = i
+                    self._chunks.append(ch)
+                else:
+                    self._chunks[i] = ch
+                self._mat[i] = row
+                self._set_attrs(i, ch)
+
+            self._generation = _next_generation()
+            self._persist([
+                {"op": "upsert", "item": {"chunk": _chunk_to_dict(ch), "vector": row}}
+                for (ch, _), row in zip(pairs, block.tolist())
+            ])
+
+    def _eligible(self, where: SearchFilter) -> np.ndarray:
+        """Строки, проходящие фильтр: source/page — по столбцам атрибутов, meta — проверкой чанков."""
+        n = len(self._chunks)
+        mask = np.ones(n, dtype=bool)
+        if where.sources is not None:
+            codes = [self._src_codes[s] for s in where.sources if s in self._src_codes]
+            mask &= np.isin(self._src[:n], codes)
+        if where.pages is not None:
+            mask &= np.isin(self._page[:n], list(where.pages))
+        if where.locates:
+            # схлопнутые почти-дубликаты могут подойти по месту из meta["sources"] — их проверяем поштучно
+            extra = np.flatnonzero((self._multi[:n] != 0) & ~mask)
+            hit = [int(i) for i in extra if where.matches_chunk(self._chunks[int(i)])]
+            mask[hit] = True
+        rows = np.flatnonzero(mask)
+        if where.meta and rows.size:
+            rows = rows[np.asarray([where.matches_chunk(self._chunks[int(i)]) for i in rows], dtype=bool)]
+        return rows
+
+    def search(
+        self,
+        query_vector: List[float],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[DocumentChunk]:
+        with self._rw.read():
+            k = max(0, int(top_k))
+            n = len(self._chunks)
+            if k == 0 or n == 0:
+                return []
+
+            q = np.asarray(query_vector, dtype=np.float32)
+            d = min(self.dim, int(q.shape[0]))
+            if where is None:
+                scores = self._mat[:n, :d] @ q[:d]
+                return [self._chunks[i] for i in _top_k(scores, k)]
+
+            rows = self._eligible(where)
+            scores = self._mat[rows, :d] @ q[:d]
+            return [self._chunks[int(rows[i])] for i in _top_k(scores, k)]
+
+    def search_many(
+        self,
+        query_matrix: Sequence[List[float]],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> List[List[DocumentChunk]]:
+        with self._rw.read():
+            k = max(0, int(top_k))
+            n = len(self._chunks)
+            if len(query_matrix) == 0:
+                return []
+            if k == 0 or n == 0:
+                return [[] for _ in query_matrix]
+
+            qm = np.asarray(query_matrix, dtype=np.float32)
+            d = min(self.dim, int(qm.shape[1]))
+            rows = np.arange(n) if where is None else self._eligible(where)
+            scores = qm[:, :d] @ self._mat[rows, :d].T
+            return [[self._chunks[int(rows[i])] for i in row] for row in _top_k_rows(scores, k)]
@@ -2,14 +2,20 @@ from __future__ import annotations
 
 import json
 import logging
+import os
+import uuid
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 
 from chat_engine.app.settings import AppSettings
 from chat_engine.app.wiring import build_bundle
+from chat_engine.domain.rag_models import SearchFilter
+from chat_engine.use_cases.ingest_jobs import IngestJobQueue, IngestQueueFull
+from chat_engine.use_cases.rag_indexer import IngestProgress
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 log = logging.getLogger("chat_engine")
@@ -19,12 +25,22 @@ settings = AppSettings.from_env()
 
 UPLOADS_DIR = Path("./uploads")
 ALLOWED_EXTS = {".txt", ".md", ".pdf"}
+UPLOAD_PIECE_BYTES = 1 << 20  # загрузка пишется на диск кусками, файл целиком в памяти не держится
+
+ingest_jobs = IngestJobQueue(workers=settings.rag.ingest_jobs, max_pending=settings.rag.ingest_queue_max)
+
+
+@app.on_event("shutdown")
+def close_ingest_jobs():
+    """На остановке сервера запущенные индексации дорабатывают, а не обрываются посреди батча."""
+    ingest_jobs.close(wait=True)
 
 
 class ChatRequest(BaseModel):
     conversation_id: str
     user_id: str = "default"
     message: str
+    sources: Optional[List[str]] = None
 
 
 class ChatResponse(BaseModel):
@@ -37,9 +53,18 @@ def health():
     return {"ok": True}
 
 
+@app.get("/stats/embedder")
+def embedder_stats():
+    """Гистограммы micro-batching (глубина очереди, размер батча); {} — эмбеддер без батчинга."""
+    embedder = build_bundle(settings, user_id="default").indexer.embedder
+    stats = getattr(embedder, "stats", None)
+    return stats() if callable(stats) else {}
+
+
 @app.post("/chat", response_model=ChatResponse)
 def chat(req: ChatRequest):
-    bundle = build_bundle(settings, user_id=req.user_id)
+    rag_filter = SearchFilter.build(sources=req.sources) if req.sources else None
+    bundle = build_bundle(settings, user_id=req.user_id, rag_filter=rag_filter)
     answer, meta = bundle.engine.handle_user_message_ex(req.conversation_id, req.message)
     log.info(json.dumps({"event": "chat", **meta}, ensure_ascii=False))
     return ChatResponse(answer=answer, meta=meta)
@@ -94,7 +119,7 @@ def delete_fact(user_id: str, fact_id: str):
     return {"deleted": ok}
 
 
-@app.post("/documents/upload")
+@app.post("/documents/upload", status_code=202)
 async def upload_document(
     user_id: str = Query(default="default"),
     replace: bool = Query(default=True),
@@ -113,21 +138,40 @@ async def upload_document(
 
     UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
     dst = UPLOADS_DIR / safe_name
+    # пишем во временный файл и подменяем атомарно: задача, читающая прежнюю версию, её и дочитает
+    part = UPLOADS_DIR / f".{safe_name}.{uuid.uuid4().hex}.part"
 
     try:
-        data = await file.read()
-        dst.write_bytes(data)
+        with part.open("wb") as f:
+            while True:
+                piece = await file.read(UPLOAD_PIECE_BYTES)
+                if not piece:
+                    break
+                await run_in_threadpool(f.write, piece)
+        os.replace(part, dst)
     except Exception as e:
+        part.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
 
     bundle = build_bundle(settings, user_id=user_id)
 
-    if replace:
-        bundle.rag_store.delete_by_source(str(dst))
+    def run(paths: List[str], progress: IngestProgress) -> int:
+        return bundle.indexer.ingest_paths(paths, replace=replace, progress=progress)
 
+    # задачи одного хранилища выполняются по очереди; с CE_RAG_NAMESPACES у каждого пользователя своё
+    store_key = user_id if settings.rag.namespaces else "default"
     try:
-        n = bundle.indexer.ingest_paths([str(dst)])
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        job = ingest_jobs.submit(store_key, [str(dst)], run)
+    except IngestQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+    return {"stored_as": str(dst), **job.to_dict(), "status_url": f"/documents/jobs/{job.job_id}"}
+
 
-    return {"stored_as": str(dst), "ingested_chunks": n, "store_size": bundle.rag_store.count()}
+@app.get("/documents/jobs/{job_id}")
+def ingest_job_status(job_id: str):
+    """Статус фоновой индексации: queued | running | done | failed, счётчики страниц/чанков и эмбеддинги/сек."""
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.to_dict()
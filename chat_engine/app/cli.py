@@ -4,10 +4,10 @@ import argparse
 import json
 import logging
 from dataclasses import replace
-from pathlib import Path
 
 from chat_engine.app.settings import AppSettings
 from chat_engine.app.wiring import build_bundle
+from chat_engine.domain.rag_models import SearchFilter
 
 
 def main() -> None:
@@ -26,6 +26,14 @@ def main() -> None:
 
     parser.add_argument("--ingest", nargs="+", default=None, help="Paths to ingest (txt/md/pdf)")
     parser.add_argument("--ingest-replace", action="store_true", help="Delete old chunks by source before ingest")
+    parser.add_argument(
+        "--ingest-workers",
+        type=int,
+        default=None,
+        help="Processes for text extraction and chunking (default: CE_INGEST_WORKERS)",
+    )
+    parser.add_argument("--compact", action="store_true", help="Merge vector store segments and drop deleted rows")
+    parser.add_argument("--rag-source", nargs="+", default=None, help="Restrict RAG search to these sources")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -51,15 +59,21 @@ def main() -> None:
         rag = replace(rag, rag_top_k=args.rag_top_k)
     settings = replace(settings, engine=eng, rag=rag)
 
-    bundle = build_bundle(settings, user_id=args.uid)
+    rag_filter = SearchFilter.build(sources=args.rag_source) if args.rag_source else None
+    bundle = build_bundle(settings, user_id=args.uid, rag_filter=rag_filter)
     engine = bundle.engine
     mem_store = bundle.memory_store
 
+    if args.compact:
+        if not hasattr(bundle.rag_store, "compact"):
+            print("Vector store backend does not support compaction")
+            return
+        stats = bundle.rag_store.compact()
+        print(f"Compacted: {json.dumps(stats, ensure_ascii=False)}. Store size: {bundle.rag_store.count()}")
+        return
+
     if args.ingest is not None:
-        if args.ingest_replace:
-            for p in args.ingest:
-                bundle.rag_store.delete_by_source(str(Path(p)))
-        n = bundle.indexer.ingest_paths(args.ingest)
+        n = bundle.indexer.ingest_paths(args.ingest, replace=args.ingest_replace, workers=args.ingest_workers)
         print(f"Ingested chunks: {n}. Store size: {bundle.rag_store.count()}")
         return
 
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import socketserver
+from dataclasses import replace
+from pathlib import Path
+from typing import Any, Dict
+
+from chat_engine.adapters.embed_remote import pack_vectors, recv_frame, send_frame
+from chat_engine.adapters.rag_cache import embedder_key
+from chat_engine.app.settings import AppSettings
+from chat_engine.app.wiring import build_embedder
+from chat_engine.ports.embeddings import Embedder
+
+log = logging.getLogger("chat_engine.embed_server")
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    server: "EmbeddingServer"
+
+    def handle(self) -> None:
+        while True:
+            try:
+                request = json.loads(recv_frame(self.request).decode("utf-8"))
+            except (ConnectionError, OSError):
+                return
+            try:
+                self._reply(request)
+            except (ConnectionError, OSError):
+                return
+
+    def _reply(self, request: Dict[str, Any]) -> None:
+        embedder = self.server.embedder
+        op = request.get("op")
+        try:
+            if op == "info":
+                send_frame(self.request, _json(self.server.info))
+                return
+            if op != "embed":
+                raise ValueError(f"Unknown op: {op!r}")
+            vectors = embedder.embed(list(request.get("texts") or []))
+        except Exception as e:  # ошибка модели уходит клиенту, соединение живёт дальше
+            send_frame(self.request, _json({"ok": False, "error": f"{type(e).__name__}: {e}"}))
+            return
+        dim, blob = pack_vectors(vectors)
+        send_frame(self.request, _json({"ok": True, "n": len(vectors), "dim": dim}))
+        send_frame(self.request, blob)
+
+
+def _json(obj: Dict[str, Any]) -> bytes:
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Один процесс с одной моделью на хост. Соединение клиента обслуживает свой поток, а одиночные
+    запросы разных воркеров сводятся в общие батчи BatchingEmbedder'ом (CE_EMBED_BATCH_SIZE).
+    """
+
+    daemon_threads = True
+    # воркеры uvicorn открывают соединения пачкой при старте; backlog по умолчанию (5) их не вмещает
+    request_queue_size = 256
+
+    def __init__(self, socket_path: str, embedder: Embedder):
+        path = Path(socket_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            path.unlink()  # сокет от упавшего процесса
+        self.embedder = embedder
+        self.info = {
+            "ok": True,
+            "dim": getattr(embedder, "dim", None),
+            "model_name": getattr(embedder, "model_name", None),
+            "key": list(embedder_key(embedder)),
+        }
+        super().__init__(str(path), _Handler)
+        os.chmod(str(path), 0o600)
+
+    def server_close(self) -> None:
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Shared embedding model behind a Unix socket")
+    parser.add_argument("--socket", default=None, help="Socket path (default: CE_EMBED_SOCKET)")
+    parser.add_argument("--backend", choices=["sbert", "hash"], default="sbert")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    settings = AppSettings.from_env()
+    settings = replace(settings, engine=replace(settings.engine, embedder_backend=args.backend))
+    socket_path = args.socket or settings.rag.embed_socket
+
+    server = EmbeddingServer(socket_path, build_embedder(settings))
+    log.info(json.dumps({"event": "embed_server", "socket": socket_path, **server.info}, ensure_ascii=False))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import os
 from dataclasses import dataclass
+from typing import Optional
 
 
 def _env_int(name: str, default: int) -> int:
@@ -14,6 +15,16 @@ def _env_int(name: str, default: int) -> int:
         return default
 
 
+def _env_float(name: str, default: float) -> float:
+    v = os.getenv(name)
+    if v is None or v.strip() == "":
+        return default
+    try:
+        return float(v)
+    except Exception:
+        return default
+
+
 def _env_str(name: str, default: str) -> str:
     v = os.getenv(name)
     return default if v is None or v.strip() == "" else v
@@ -26,6 +37,14 @@ def _env_bool(name: str, default: bool) -> bool:
     return v.strip().lower() in {"1", "true", "yes", "y", "on"}
 
 
+def _env_opt_bool(name: str, default: Optional[bool]) -> Optional[bool]:
+    """Как _env_bool, но без переменной остаётся default (None — «решит wiring»)."""
+    v = os.getenv(name)
+    if v is None or v.strip() == "":
+        return default
+    return v.strip().lower() in {"1", "true", "yes", "y", "on"}
+
+
 def _env_choice(name: str, default: str, allowed: set[str]) -> str:
     v = os.getenv(name)
     if v is None or v.strip() == "":
@@ -68,7 +87,8 @@ class EngineSettings:
     llm_backend: str = "mock"          # mock | ollama
     summarizer_backend: str = "mock"   # mock | llm
     tokenizer_backend: str = "approx"  # approx | tiktoken
-    embedder_backend: str = "hash"     # hash | sbert
+    embedder_backend: str = "hash"     # hash | sbert | remote
+    vector_store_backend: str = "json"  # json | numpy | mmap | ivf | hnsw
 
     ollama_url: str = "http://127.0.0.1:11434"
     ollama_model: str = "llama3.1:8b"
@@ -79,10 +99,45 @@ class RagSettings:
     rag_store_path: str = "./rag_store.json"
     rag_top_k: int = 4
     rag_max_tokens: int = 250
+    retrieval: str = "vector"  # vector | bm25 | hybrid
+    namespaces: bool = False  # отдельная коллекция на user_id
+    namespace_max_mb: int = 512
+    query_cache_size: int = 1024  # 0 — без кэша эмбеддингов запросов
+    retrieval_cache_size: int = 512  # 0 — без кэша результатов поиска
+    mmr: bool = False
+    mmr_lambda: float = 0.7
+    merge_adjacent: bool = True
+    # постоянный кэш эмбеддингов чанков (sqlite рядом с CE_RAG_STORE); None — только для sbert/remote:
+    # hashed-вектор дешевле пересчитать, чем прочитать
+    embed_cache: Optional[bool] = None
+    embed_cache_max_mb: int = 1024  # потолок векторов в кэше; сверх него вытесняются давно не нужные
+    embed_batch_size: int = 32  # micro-batching запросов к sbert; 1 — выключить
+    embed_batch_wait_ms: float = 2.0
+    embed_socket: str = "./embed.sock"  # Unix-сокет embedding-сервера для CE_EMBEDDER=remote
+    hash_dim: int = 256  # размерность HashingEmbedder
+    sparse_vectors: bool = False  # хранить hashed-векторы разреженно (CE_VECTOR_STORE=json)
+    ingest_batch: int = 256  # чанков на один embed + upsert при ingest
+    ingest_workers: int = 0  # процессов для извлечения текста и чанкинга; 0/1 — в текущем процессе
+    ingest_pages_per_task: int = 16
+    ingest_jobs: int = 2  # фоновых задач индексации одновременно (/documents/upload)
+    ingest_queue_max: int = 64  # задач в очереди, дальше — 429
+    dedup: bool = False  # схлопывать почти-дубликаты чанков при ingest (MinHash/LSH)
+    dedup_threshold: float = 0.85  # оценка Жаккара по шинглам, начиная с которой чанки считаются дубликатами
 
     chunk_tokens: int = 800
     overlap_tokens: int = 120
 
+    ivf_nlist: int = 64
+    ivf_nprobe: int = 8
+
+    quantization: str = "none"  # none | int8 | pq (для CE_VECTOR_STORE=mmap)
+    pq_m: int = 8
+    rerank_k: int = 32
+
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 100
+    hnsw_ef_search: int = 64
+
     sbert_model: str = "sentence-transformers/all-MiniLM-L6-v2"
 
 
@@ -118,7 +173,10 @@ class AppSettings:
             llm_backend=_env_choice("CE_LLM", EngineSettings.llm_backend, {"mock", "ollama"}),
             summarizer_backend=_env_choice("CE_SUMMARIZER", EngineSettings.summarizer_backend, {"mock", "llm"}),
             tokenizer_backend=_env_choice("CE_TOKENIZER", EngineSettings.tokenizer_backend, {"approx", "tiktoken"}),
-            embedder_backend=_env_choice("CE_EMBEDDER", EngineSettings.embedder_backend, {"hash", "sbert"}),
+            embedder_backend=_env_choice("CE_EMBEDDER", EngineSettings.embedder_backend, {"hash", "sbert", "remote"}),
+            vector_store_backend=_env_choice(
+                "CE_VECTOR_STORE", EngineSettings.vector_store_backend, {"json", "numpy", "mmap", "ivf", "hnsw"}
+            ),
 
             ollama_url=_env_str("CE_OLLAMA_URL", EngineSettings.ollama_url),
             ollama_model=_env_str("CE_OLLAMA_MODEL", EngineSettings.ollama_model),
@@ -128,8 +186,38 @@ class AppSettings:
             rag_store_path=_env_str("CE_RAG_STORE", RagSettings.rag_store_path),
             rag_top_k=_env_int("CE_RAG_TOPK", RagSettings.rag_top_k),
             rag_max_tokens=_env_int("CE_RAG_MAX_TOKENS", RagSettings.rag_max_tokens),
+            retrieval=_env_choice("CE_RAG_RETRIEVAL", RagSettings.retrieval, {"vector", "bm25", "hybrid"}),
+            namespaces=_env_bool("CE_RAG_NAMESPACES", RagSettings.namespaces),
+            namespace_max_mb=_env_int("CE_RAG_NS_MAX_MB", RagSettings.namespace_max_mb),
+            query_cache_size=_env_int("CE_QUERY_CACHE_SIZE", RagSettings.query_cache_size),
+            retrieval_cache_size=_env_int("CE_RETRIEVAL_CACHE_SIZE", RagSettings.retrieval_cache_size),
+            mmr=_env_bool("CE_RAG_MMR", RagSettings.mmr),
+            mmr_lambda=_env_float("CE_RAG_MMR_LAMBDA", RagSettings.mmr_lambda),
+            merge_adjacent=_env_bool("CE_RAG_MERGE_ADJACENT", RagSettings.merge_adjacent),
+            embed_cache=_env_opt_bool("CE_EMBED_CACHE", RagSettings.embed_cache),
+            embed_cache_max_mb=_env_int("CE_EMBED_CACHE_MAX_MB", RagSettings.embed_cache_max_mb),
+            embed_batch_size=_env_int("CE_EMBED_BATCH_SIZE", RagSettings.embed_batch_size),
+            embed_batch_wait_ms=_env_float("CE_EMBED_BATCH_WAIT_MS", RagSettings.embed_batch_wait_ms),
+            embed_socket=_env_str("CE_EMBED_SOCKET", RagSettings.embed_socket),
+            hash_dim=_env_int("CE_HASH_DIM", RagSettings.hash_dim),
+            sparse_vectors=_env_bool("CE_SPARSE_VECTORS", RagSettings.sparse_vectors),
+            ingest_batch=_env_int("CE_INGEST_BATCH", RagSettings.ingest_batch),
+            ingest_workers=_env_int("CE_INGEST_WORKERS", RagSettings.ingest_workers),
+            ingest_pages_per_task=_env_int("CE_INGEST_PAGES_PER_TASK", RagSettings.ingest_pages_per_task),
+            ingest_jobs=_env_int("CE_INGEST_JOBS", RagSettings.ingest_jobs),
+            ingest_queue_max=_env_int("CE_INGEST_QUEUE_MAX", RagSettings.ingest_queue_max),
+            dedup=_env_bool("CE_DEDUP", RagSettings.dedup),
+            dedup_threshold=_env_float("CE_DEDUP_THRESHOLD", RagSettings.dedup_threshold),
             chunk_tokens=_env_int("CE_CHUNK_TOKENS", RagSettings.chunk_tokens),
             overlap_tokens=_env_int("CE_OVERLAP_TOKENS", RagSettings.overlap_tokens),
+            ivf_nlist=_env_int("CE_IVF_NLIST", RagSettings.ivf_nlist),
+            ivf_nprobe=_env_int("CE_IVF_NPROBE", RagSettings.ivf_nprobe),
+            quantization=_env_choice("CE_QUANTIZATION", RagSettings.quantization, {"none", "int8", "pq"}),
+            pq_m=_env_int("CE_PQ_M", RagSettings.pq_m),
+            rerank_k=_env_int("CE_RERANK_K", RagSettings.rerank_k),
+            hnsw_m=_env_int("CE_HNSW_M", RagSettings.hnsw_m),
+            hnsw_ef_construction=_env_int("CE_HNSW_EF_CONSTRUCTION", RagSettings.hnsw_ef_construction),
+            hnsw_ef_search=_env_int("CE_HNSW_EF_SEARCH", RagSettings.hnsw_ef_search),
             sbert_model=_env_str("CE_SBERT_MODEL", RagSettings.sbert_model),
         )
 
@@ -1,12 +1,18 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from pathlib import Path
 from threading import Lock
 from typing import Optional, Tuple, Dict, Any
 
 from chat_engine.app.settings import AppSettings
 
+from chat_engine.domain.rag_models import SearchFilter
+from chat_engine.ports.embeddings import Embedder
+from chat_engine.ports.lexical_index import LexicalIndex
+from chat_engine.ports.near_duplicates import NearDuplicateIndex
 from chat_engine.ports.tokens import TokenCounter
+from chat_engine.ports.vector_store import VectorStore
 
 from chat_engine.adapters.repo_json import JsonFileConversationRepo
 from chat_engine.adapters.trunc_recency import RecencyTruncation
@@ -15,7 +21,10 @@ from chat_engine.adapters.vector_store_json import JsonVectorStore
 from chat_engine.adapters.chunker_token import TokenChunker
 from chat_engine.adapters.loader_txt import TxtLoader
 from chat_engine.adapters.loader_pdf_pypdf import PdfLoaderPyPDF
+from chat_engine.adapters.ingest_state_jsonl import JsonlIngestStateStore
 from chat_engine.adapters.rag_augmentor import RagAugmentor
+from chat_engine.adapters.rag_cache import QueryEmbeddingCache, RetrievalCache
+from chat_engine.adapters.vector_store_namespaced import NamespaceRegistry, namespace_slug
 
 from chat_engine.adapters.memory_store_json import JsonUserMemoryStore
 from chat_engine.adapters.memory_extractor_rules import RuleBasedMemoryExtractor
@@ -31,7 +40,7 @@ from chat_engine.use_cases.rag_indexer import RagIndexer
 class EngineBundle:
     engine: ChatEngine
     indexer: RagIndexer
-    rag_store: JsonVectorStore
+    rag_store: VectorStore
     memory_store: JsonUserMemoryStore
     counter: TokenCounter
 
@@ -53,6 +62,7 @@ def _settings_key(s: AppSettings) -> Tuple[Any, ...]:
         r.rag_store_path,
         e.tokenizer_backend,
         e.embedder_backend,
+        e.vector_store_backend,
         e.llm_backend,
         e.summarizer_backend,
         e.enable_summary,
@@ -63,8 +73,36 @@ def _settings_key(s: AppSettings) -> Tuple[Any, ...]:
         r.sbert_model,
         r.chunk_tokens,
         r.overlap_tokens,
+        r.ivf_nlist,
+        r.ivf_nprobe,
+        r.quantization,
+        r.pq_m,
+        r.rerank_k,
+        r.hnsw_m,
+        r.hnsw_ef_construction,
+        r.hnsw_ef_search,
         r.rag_top_k,
         r.rag_max_tokens,
+        r.retrieval,
+        r.namespaces,
+        r.namespace_max_mb,
+        r.query_cache_size,
+        r.retrieval_cache_size,
+        r.mmr,
+        r.mmr_lambda,
+        r.merge_adjacent,
+        r.embed_cache,
+        r.embed_cache_max_mb,
+        r.embed_batch_size,
+        r.embed_batch_wait_ms,
+        r.embed_socket,
+        r.hash_dim,
+        r.sparse_vectors,
+        r.ingest_batch,
+        r.ingest_workers,
+        r.ingest_pages_per_task,
+        r.dedup,
+        r.dedup_threshold,
         e.system_prompt,
         e.max_context_tokens,
         e.reserve_output_tokens,
@@ -73,6 +111,113 @@ def _settings_key(s: AppSettings) -> Tuple[Any, ...]:
     )
 
 
+def _build_vector_store(settings: AppSettings, path: Optional[str] = None) -> VectorStore:
+    path = path or settings.rag.rag_store_path
+    if settings.engine.vector_store_backend == "numpy":
+        from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+        return NumpyVectorStore(path)
+    if settings.engine.vector_store_backend == "mmap":
+        from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+        return MmapVectorStore(
+            str(Path(path).with_suffix(".segments")),
+            quantization=settings.rag.quantization,
+            pq_m=settings.rag.pq_m,
+            rerank=settings.rag.rerank_k,
+        )
+    if settings.engine.vector_store_backend == "ivf":
+        from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+        return IvfVectorStore(
+            path,
+            nlist=settings.rag.ivf_nlist,
+            nprobe=settings.rag.ivf_nprobe,
+        )
+    if settings.engine.vector_store_backend == "hnsw":
+        from chat_engine.adapters.vector_store_hnsw import HnswVectorStore
+        return HnswVectorStore(
+            path,
+            m=settings.rag.hnsw_m,
+            ef_construction=settings.rag.hnsw_ef_construction,
+            ef_search=settings.rag.hnsw_ef_search,
+        )
+    return JsonVectorStore(path, sparse=settings.rag.sparse_vectors)
+
+
+def _build_lexical(settings: AppSettings, path: Optional[str] = None) -> Optional[LexicalIndex]:
+    if settings.rag.retrieval == "vector":
+        return None
+    from chat_engine.adapters.lexical_bm25 import Bm25Index
+    return Bm25Index(str(Path(path or settings.rag.rag_store_path).with_suffix(".bm25.json")))
+
+
+def _namespace_path(settings: AppSettings, namespace: str) -> str:
+    return str(Path(settings.rag.rag_store_path).with_suffix(".tenants") / f"{namespace_slug(namespace)}.json")
+
+
+_ingest_states: Dict[str, JsonlIngestStateStore] = {}
+_ingest_states_lock = Lock()
+
+
+def _ingest_state(store_path: str, kind: str) -> JsonlIngestStateStore:
+    """<store>.ingest.jsonl (checkpoints) / <store>.manifest.jsonl; один объект на файл, чтобы журнал вёл один писатель."""
+    path = f"{store_path}.{kind}.jsonl"
+    with _ingest_states_lock:
+        st = _ingest_states.get(path)
+        if st is None:
+            st = _ingest_states[path] = JsonlIngestStateStore(path)
+        return st
+
+
+_dedup_indexes: Dict[str, NearDuplicateIndex] = {}
+_dedup_lock = Lock()
+
+
+def _dedup_index(settings: AppSettings, store_path: str) -> Optional[NearDuplicateIndex]:
+    """<store>.dedup.sqlite — группы почти-дубликатов своего хранилища (у namespace — свои)."""
+    if not settings.rag.dedup:
+        return None
+    path = f"{store_path}.dedup.sqlite"
+    with _dedup_lock:
+        idx = _dedup_indexes.get(path)
+        if idx is None:
+            from chat_engine.adapters.dedup_minhash import MinHashLshIndex
+            idx = _dedup_indexes[path] = MinHashLshIndex(path, threshold=settings.rag.dedup_threshold)
+        return idx
+
+
+def _build_namespaces(settings: AppSettings) -> NamespaceRegistry:
+    """Коллекции по user_id в <CE_RAG_STORE без расширения>.tenants/<user_id>.json (+ файлы бэкенда рядом)."""
+
+    def open_namespace(ns: str) -> Tuple[VectorStore, Optional[LexicalIndex]]:
+        path = _namespace_path(settings, ns)
+        return _build_vector_store(settings, path), _build_lexical(settings, path)
+
+    return NamespaceRegistry(
+        open_namespace,
+        max_bytes=settings.rag.namespace_max_mb * 1024 * 1024,
+        with_lexical=settings.rag.retrieval != "vector",
+    )
+
+
+def build_embedder(settings: AppSettings) -> Embedder:
+    """Эмбеддер по CE_EMBEDDER; общий для приложения и embedding-сервера (app.embed_server)."""
+    if settings.engine.embedder_backend == "remote":
+        from chat_engine.adapters.embed_remote import RemoteEmbedder
+        return RemoteEmbedder(settings.rag.embed_socket)
+    if settings.engine.embedder_backend == "sbert":
+        from chat_engine.adapters.embed_sbert import SentenceTransformerEmbedder
+        embedder: Embedder = SentenceTransformerEmbedder(model_name=settings.rag.sbert_model)
+        if settings.rag.embed_batch_size > 1:
+            from chat_engine.adapters.embed_batching import BatchingEmbedder
+            embedder = BatchingEmbedder(
+                embedder,
+                max_batch=settings.rag.embed_batch_size,
+                max_wait_ms=settings.rag.embed_batch_wait_ms,
+            )
+        return embedder
+    from chat_engine.adapters.embed_hash import HashingEmbedder
+    return HashingEmbedder(_dim=settings.rag.hash_dim)
+
+
 def _build_shared(settings: AppSettings) -> Dict[str, Any]:
     if settings.engine.tokenizer_backend == "tiktoken":
         from chat_engine.adapters.tokens_tiktoken import TiktokenTokenCounter
@@ -112,14 +257,16 @@ def _build_shared(settings: AppSettings) -> Dict[str, Any]:
     memory_store = JsonUserMemoryStore(settings.memory.memory_store_path)
     memory_extractor = RuleBasedMemoryExtractor()
 
-    if settings.engine.embedder_backend == "sbert":
-        from chat_engine.adapters.embed_sbert import SentenceTransformerEmbedder
-        embedder = SentenceTransformerEmbedder(model_name=settings.rag.sbert_model)
-    else:
-        from chat_engine.adapters.embed_hash import HashingEmbedder
-        embedder = HashingEmbedder()
+    embedder = build_embedder(settings)
 
-    rag_store = JsonVectorStore(settings.rag.rag_store_path)
+    registry: Optional[NamespaceRegistry] = None
+    if settings.rag.namespaces:
+        registry = _build_namespaces(settings)
+        rag_store: VectorStore = registry.store("default")
+        lexical = registry.lexical_index("default")
+    else:
+        rag_store = _build_vector_store(settings)
+        lexical = _build_lexical(settings)
     chunker = TokenChunker(
         counter=counter,
         chunk_tokens=settings.rag.chunk_tokens,
@@ -132,10 +279,37 @@ def _build_shared(settings: AppSettings) -> Dict[str, Any]:
         "pdf": PdfLoaderPyPDF(),
     }
 
-    indexer = RagIndexer(loaders=loaders, chunker=chunker, embedder=embedder, store=rag_store)
+    embedding_cache = None
+    use_embed_cache = settings.rag.embed_cache
+    if use_embed_cache is None:
+        use_embed_cache = settings.engine.embedder_backend in {"sbert", "remote"}
+    if use_embed_cache:
+        from chat_engine.adapters.embed_cache_sqlite import SqliteEmbeddingCache
+        # один файл на все namespace: ключ — содержимое чанка, а не его владелец
+        embedding_cache = SqliteEmbeddingCache(
+            str(Path(settings.rag.rag_store_path).with_suffix(".embcache.sqlite")),
+            max_bytes=settings.rag.embed_cache_max_mb * 1024 * 1024,
+        )
+
+    indexer = RagIndexer(
+        loaders=loaders,
+        chunker=chunker,
+        embedder=embedder,
+        store=rag_store,
+        lexical=lexical,
+        embedding_cache=embedding_cache,
+        batch_size=settings.rag.ingest_batch,
+        workers=settings.rag.ingest_workers,
+        pages_per_task=settings.rag.ingest_pages_per_task,
+        checkpoints=_ingest_state(settings.rag.rag_store_path, "ingest"),
+        manifest=_ingest_state(settings.rag.rag_store_path, "manifest"),
+        dedup=_dedup_index(settings, settings.rag.rag_store_path),
+    )
 
     rag_aug: Optional[RagAugmentor] = None
-    if settings.engine.enable_rag and settings.engine.rag_mode != "off" and rag_store.count() > 0:
+    # пустоту хранилища RagAugmentor проверяет на каждом запросе: документы, загруженные после старта,
+    # сразу видны в чате, а коллекции namespace не приходится открывать заранее
+    if settings.engine.enable_rag and settings.engine.rag_mode != "off":
         rag_aug = RagAugmentor(
             mode=settings.engine.rag_mode,  
             store=rag_store,
@@ -143,6 +317,13 @@ def _build_shared(settings: AppSettings) -> Dict[str, Any]:
             counter=counter,
             top_k=settings.rag.rag_top_k,
             max_rag_tokens=settings.rag.rag_max_tokens,
+            lexical=lexical,
+            retrieval=settings.rag.retrieval,
+            query_cache=QueryEmbeddingCache(settings.rag.query_cache_size) if settings.rag.query_cache_size > 0 else None,
+            retrieval_cache=RetrievalCache(settings.rag.retrieval_cache_size) if settings.rag.retrieval_cache_size > 0 else None,
+            mmr=settings.rag.mmr,
+            mmr_lambda=settings.rag.mmr_lambda,
+            merge_chunks=settings.rag.merge_adjacent,
         )
 
     return {
@@ -156,10 +337,16 @@ def _build_shared(settings: AppSettings) -> Dict[str, Any]:
         "rag_store": rag_store,
         "indexer": indexer,
         "rag_aug": rag_aug,
+        "rag_registry": registry,
     }
 
 
-def build_bundle(settings: AppSettings, *, user_id: str) -> EngineBundle:
+def build_bundle(
+    settings: AppSettings,
+    *,
+    user_id: str,
+    rag_filter: Optional[SearchFilter] = None,
+) -> EngineBundle:
     key = _settings_key(settings)
 
     with _cache_lock:
@@ -175,9 +362,25 @@ def build_bundle(settings: AppSettings, *, user_id: str) -> EngineBundle:
     summary_policy = shared["summary_policy"]
     memory_store: JsonUserMemoryStore = shared["memory_store"]
     memory_extractor = shared["memory_extractor"]
-    rag_store: JsonVectorStore = shared["rag_store"]
+    rag_store: VectorStore = shared["rag_store"]
     indexer: RagIndexer = shared["indexer"]
     rag_aug: Optional[RagAugmentor] = shared["rag_aug"]
+    registry: Optional[NamespaceRegistry] = shared["rag_registry"]
+    if registry is not None:
+        rag_store = registry.store(user_id)
+        lexical = registry.lexical_index(user_id)
+        indexer = replace(
+            indexer,
+            store=rag_store,
+            lexical=lexical,
+            checkpoints=_ingest_state(_namespace_path(settings, user_id), "ingest"),
+            manifest=_ingest_state(_namespace_path(settings, user_id), "manifest"),
+            dedup=_dedup_index(settings, _namespace_path(settings, user_id)),
+        )
+        if rag_aug is not None:
+            rag_aug = replace(rag_aug, store=rag_store, lexical=lexical)
+    if rag_aug is not None and rag_filter is not None:
+        rag_aug = replace(rag_aug, where=rag_filter)
 
     mem_aug: Optional[MemoryAugmentor] = None
     if settings.engine.enable_memory:
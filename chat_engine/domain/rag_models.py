@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from typing import Any, Dict, Optional
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, Optional, Sequence, Tuple
 
 
 @dataclass(frozen=True)
@@ -19,3 +19,85 @@ class DocumentChunk:
     page: Optional[int] = None
     tokens: int = 0
     meta: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class SparseVector:
+    """Разреженный вектор: ненулевые координаты по возрастанию индекса + полная размерность."""
+    dim: int
+    indices: Tuple[int, ...] = ()
+    values: Tuple[float, ...] = ()
+
+    @staticmethod
+    def from_dense(vec: Sequence[float]) -> "SparseVector":
+        nz = [(i, float(v)) for i, v in enumerate(vec) if v != 0.0]
+        return SparseVector(dim=len(vec), indices=tuple(i for i, _ in nz), values=tuple(v for _, v in nz))
+
+    def to_dense(self) -> List[float]:
+        out = [0.0] * self.dim
+        for i, v in zip(self.indices, self.values):
+            out[i] = v
+        return out
+
+    def dot(self, dense: Sequence[float]) -> float:
+        """Скалярное произведение с плотным вектором за O(ненулевых)."""
+        n = len(dense)
+        return sum(dense[i] * v for i, v in zip(self.indices, self.values) if i < n)
+
+
+def chunk_locations(source: str, page: Optional[int], meta: Mapping[str, Any]) -> List[Tuple[str, Optional[int]]]:
+    """
+    Где встречается текст чанка: его source/page, а у канонического чанка группы почти-дубликатов —
+    все места из meta["sources"] (RagIndexer кладёт туда и его самого).
+    """
+    locs = meta.get("sources")
+    if isinstance(locs, list) and locs:
+        return [(str(loc.get("source", "") or ""), loc.get("page")) for loc in locs if isinstance(loc, dict)]
+    return [(source, page)]
+
+
+def is_grouped(meta: Mapping[str, Any]) -> bool:
+    """Канонический чанк группы почти-дубликатов: под фильтр может попасть по чужому source/page."""
+    return isinstance(meta.get("sources"), list)
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    """
+    Ограничение поиска: чанк подходит, если совпал по всем заданным полям.
+    sources сравниваются без учёта регистра (как в delete_by_source), meta — пары key=value из chunk.meta.
+    sources и pages проверяются по каждому месту чанка (chunk_locations): подходит, если совпало хоть одно.
+    Хэшируемый, чтобы его можно было класть в ключи кэшей.
+    """
+    sources: Optional[FrozenSet[str]] = None
+    pages: Optional[FrozenSet[int]] = None
+    meta: Tuple[Tuple[str, Any], ...] = ()
+
+    @staticmethod
+    def build(
+        sources: Optional[Iterable[str]] = None,
+        pages: Optional[Iterable[int]] = None,
+        meta: Optional[Mapping[str, Any]] = None,
+    ) -> "SearchFilter":
+        return SearchFilter(
+            sources=frozenset(s.lower() for s in sources) if sources is not None else None,
+            pages=frozenset(int(p) for p in pages) if pages is not None else None,
+            meta=tuple(sorted((meta or {}).items())),
+        )
+
+    @property
+    def locates(self) -> bool:
+        """Ограничены ли source/page — только тогда важны места схлопнутых почти-дубликатов."""
+        return self.sources is not None or self.pages is not None
+
+    def matches(self, source: str, page: Optional[int], meta: Mapping[str, Any]) -> bool:
+        if not all(meta.get(k) == v for k, v in self.meta):
+            return False
+        return any(
+            (self.sources is None or (src or "").lower() in self.sources)
+            and (self.pages is None or pg in self.pages)
+            for src, pg in chunk_locations(source, page, meta)
+        )
+
+    def matches_chunk(self, ch: DocumentChunk) -> bool:
+        return self.matches(ch.source, ch.page, ch.meta)
@@ -1,30 +1,41 @@
 from .augment import ContextAugmentor
 from .chunker import Chunker
-from .embeddings import Embedder
+from .embedding_cache import EmbeddingCache
+from .embeddings import Embedder, SparseEmbedder
+from .ingest_state import IngestStateStore
+from .lexical_index import LexicalIndex
 from .llm import LLMClient, LLMResponse, LLMUsage
-from .loaders import DocumentLoader
+from .loaders import DocumentLoader, PagedDocumentLoader
 from .memory_extractor import MemoryCandidate, MemoryExtractor
 from .memory_store import UserMemoryStore
+from .near_duplicates import NearDuplicateIndex
 from .repo import ConversationRepo
 from .summarizer import Summarizer
-from .tokens import TokenCounter
+from .tokens import TokenCounter, TokenOffsets
 from .truncation import TruncationStrategy
 from .vector_store import VectorStore
 
 __all__ = [
     "ContextAugmentor",
     "Chunker",
+    "EmbeddingCache",
     "Embedder",
+    "SparseEmbedder",
+    "IngestStateStore",
+    "LexicalIndex",
     "LLMClient",
     "LLMResponse",
     "LLMUsage",
     "DocumentLoader",
+    "PagedDocumentLoader",
     "MemoryCandidate",
     "MemoryExtractor",
     "UserMemoryStore",
+    "NearDuplicateIndex",
     "ConversationRepo",
     "Summarizer",
     "TokenCounter",
+    "TokenOffsets",
     "TruncationStrategy",
     "VectorStore",
 ]
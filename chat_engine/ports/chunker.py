@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from collections.abc import Sequence
+from collections.abc import Iterable
 from typing import Protocol, runtime_checkable
 
 from chat_engine.domain.rag_models import LoadedPage, DocumentChunk
@@ -8,7 +8,7 @@ from chat_engine.domain.rag_models import LoadedPage, DocumentChunk
 
 @runtime_checkable
 class Chunker(Protocol):
-    """Режет страницы на чанки для индексации."""
+    """Режет страницы на чанки для индексации; порядок чанков детерминирован (на нём держится докачка ingest)."""
 
-    def chunk(self, pages: Sequence[LoadedPage]) -> Sequence[DocumentChunk]:
+    def chunk(self, pages: Iterable[LoadedPage]) -> Iterable[DocumentChunk]:
         ...
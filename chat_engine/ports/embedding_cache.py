@@ -0,0 +1,18 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Optional, Protocol, runtime_checkable
+
+from chat_engine.ports.embeddings import Embedder
+
+
+@runtime_checkable
+class EmbeddingCache(Protocol):
+    """Постоянный кэш эмбеддингов чанков: (эмбеддер, текст) -> вектор."""
+
+    def get_many(self, embedder: Embedder, texts: Sequence[str]) -> list[Optional[list[float]]]:
+        """Векторы в порядке texts; None — промах."""
+        ...
+
+    def put_many(self, embedder: Embedder, texts: Sequence[str], vectors: Sequence[list[float]]) -> None:
+        ...
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 from collections.abc import Sequence
-from typing import Protocol, runtime_checkable
+from typing import Hashable, Protocol, runtime_checkable
+
+from chat_engine.domain.rag_models import SparseVector
 
 
 @runtime_checkable
@@ -14,3 +16,26 @@ class Embedder(Protocol):
     @property
     def dim(self) -> int:
         ...
+
+
+@runtime_checkable
+class SparseEmbedder(Embedder, Protocol):
+    """Эмбеддер, который умеет отдавать векторы сразу в разреженном виде (без плотного промежуточного)."""
+
+    def embed_sparse(self, texts: Sequence[str]) -> list[SparseVector]:
+        ...
+
+
+def embedder_key(embedder: Embedder) -> tuple[Hashable, ...]:
+    """Идентичность эмбеддера для ключей кэшей и манифеста ingest: класс + модель + размерность, а не id() объекта.
+    Обёртки (батчинг) разворачиваются, удалённый клиент отдаёт ключ модели на сервере — векторы у них те же."""
+    while getattr(embedder, "inner", None) is not None:
+        embedder = embedder.inner
+    remote = getattr(embedder, "remote_key", None)
+    if remote is not None:
+        return tuple(remote)
+    return (
+        type(embedder).__qualname__,
+        getattr(embedder, "model_name", None),
+        getattr(embedder, "dim", None),
+    )
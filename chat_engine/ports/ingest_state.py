@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+from typing import Any, Optional, Protocol, runtime_checkable
+
+
+@runtime_checkable
+class IngestStateStore(Protocol):
+    """
+    Состояние ingest по source: манифест проиндексированных файлов (размер, mtime, хэш, id чанков)
+    и checkpoints незавершённых загрузок (после падения загрузка продолжается с последнего коммита).
+    """
+
+    def get(self, source: str) -> Optional[dict[str, Any]]:
+        ...
+
+    def put(self, source: str, state: dict[str, Any]) -> None:
+        ...
+
+    def clear(self, source: str) -> None:
+        ...
@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Optional, Protocol, runtime_checkable
+
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter
+
+
+@runtime_checkable
+class LexicalIndex(Protocol):
+    """Полнотекстовый (лексический) индекс чанков документов."""
+
+    def add(self, chunks: Sequence[DocumentChunk]) -> None:
+        ...
+
+    def search(self, query: str, top_k: int, *, where: Optional[SearchFilter] = None) -> list[DocumentChunk]:
+        ...
+
+    def count(self) -> int:
+        ...
+
+    @property
+    def generation(self) -> int:
+        """См. VectorStore.generation."""
+        return 0
+
+    def delete_by_source(self, source: str) -> int:
+        ...
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        ...
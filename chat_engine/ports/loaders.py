@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from collections.abc import Sequence
+from collections.abc import Iterable
 from typing import Protocol, runtime_checkable
 
 from chat_engine.domain.rag_models import LoadedPage
@@ -8,7 +8,19 @@ from chat_engine.domain.rag_models import LoadedPage
 
 @runtime_checkable
 class DocumentLoader(Protocol):
-    """Загрузка документа в набор страниц (или 1 страницу для txt)."""
+    """Загрузка документа в набор страниц (или 1 страницу для txt). Страницы можно отдавать лениво."""
 
-    def load(self, path: str) -> Sequence[LoadedPage]:
+    def load(self, path: str) -> Iterable[LoadedPage]:
+        ...
+
+
+@runtime_checkable
+class PagedDocumentLoader(DocumentLoader, Protocol):
+    """Загрузчик, умеющий читать диапазон страниц: параллельный ingest режет по ним большие документы."""
+
+    def page_count(self, path: str) -> int:
+        ...
+
+    def load_pages(self, path: str, start: int, stop: int) -> Iterable[LoadedPage]:
+        """Страницы [start, stop) (с нуля); LoadedPage.page — сквозной номер с единицы, как в load."""
         ...
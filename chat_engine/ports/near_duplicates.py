@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Optional, Protocol, runtime_checkable
+
+from chat_engine.domain.rag_models import DocumentChunk
+
+
+@runtime_checkable
+class NearDuplicateIndex(Protocol):
+    """
+    Группы почти одинаковых чанков (колонтитулы, юридический текст, повторённые главы).
+    В хранилище лежит только канонический чанк группы; остальные хранятся здесь целиком,
+    чтобы при удалении канонического его место занял следующий.
+    """
+
+    def find(self, text: str) -> Optional[str]:
+        """id канонического чанка, похожего на text не меньше порога; None — такого нет."""
+        ...
+
+    def add(self, chunk: DocumentChunk, canonical_id: Optional[str] = None) -> None:
+        """
+        canonical_id=None — chunk сам канонический (его пишут в хранилище), иначе — дубликат этого чанка;
+        группа canonical_id тогда помечается устаревшей (см. stale).
+        """
+        ...
+
+    def stale(self) -> list[str]:
+        """Канонические чанки, чьи группы выросли после последней перезаписи в хранилище."""
+        ...
+
+    def rewritten(self, canonical_ids: Sequence[str]) -> None:
+        """Снимает отметку stale: чанки перезаписаны с актуальным списком мест."""
+        ...
+
+    def group(self, canonical_id: str) -> list[DocumentChunk]:
+        """Канонический чанк первым, затем дубликаты в порядке добавления; [] — такой группы нет."""
+        ...
+
+    def remove(self, chunk_ids: Sequence[str]) -> list[str]:
+        """
+        Удаляет чанки из групп. Возвращает id канонических чанков, чьи группы изменились
+        (в том числе выбранных вместо удалённых) — их надо перезаписать в хранилище.
+        """
+        ...
+
+    def remove_source(self, source: str) -> list[str]:
+        """remove для всех чанков документа."""
+        ...
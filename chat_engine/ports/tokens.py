@@ -19,3 +19,12 @@ class TokenCounter(Protocol):
 
     def count_messages(self, messages: Sequence[Message]) -> int:
         ...
+
+
+@runtime_checkable
+class TokenOffsets(TokenCounter, Protocol):
+    """Счётчик, который умеет за один проход разметить текст: начало каждого токена в символах."""
+
+    def token_offsets(self, text: str) -> list[int]:
+        """offsets[i] — индекс символа, с которого начинается i-й токен; len(offsets) == число токенов."""
+        ...
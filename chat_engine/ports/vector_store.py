@@ -1,9 +1,9 @@
 from __future__ import annotations
 
 from collections.abc import Sequence
-from typing import Protocol, runtime_checkable
+from typing import Optional, Protocol, runtime_checkable
 
-from chat_engine.domain.rag_models import DocumentChunk
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter, SparseVector
 
 
 @runtime_checkable
@@ -13,11 +13,53 @@ class VectorStore(Protocol):
     def upsert(self, chunks: Sequence[DocumentChunk], vectors: Sequence[list[float]]) -> None:
         ...
 
-    def search(self, query_vector: list[float], top_k: int) -> list[DocumentChunk]:
+    def upsert_sparse(self, chunks: Sequence[DocumentChunk], vectors: Sequence[SparseVector]) -> None:
+        """По умолчанию векторы разворачиваются в плотные."""
+        self.upsert(chunks, [v.to_dense() for v in vectors])
+
+    @property
+    def sparse(self) -> bool:
+        """Хранит ли бэкенд векторы разреженно (тогда индексатору выгодно звать upsert_sparse)."""
+        return False
+
+    def search(
+        self,
+        query_vector: list[float],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> list[DocumentChunk]:
+        """where ограничивает кандидатов до скоринга (а не фильтрует готовый top_k)."""
         ...
 
+    def search_many(
+        self,
+        query_matrix: Sequence[list[float]],
+        top_k: int,
+        *,
+        where: Optional[SearchFilter] = None,
+    ) -> list[list[DocumentChunk]]:
+        """Пакет запросов -> top_k на каждый. По умолчанию — search по одному запросу."""
+        return [self.search(q, top_k, where=where) for q in query_matrix]
+
     def count(self) -> int:
         ...
 
+    def vectors(self, chunk_ids: Sequence[str]) -> list[Optional[list[float]]]:
+        """Сохранённые векторы чанков по id; None — такого нет (по умолчанию хранилище их не отдаёт)."""
+        return [None for _ in chunk_ids]
+
+    @property
+    def generation(self) -> int:
+        """
+        Номер состояния хранилища: меняется при каждом изменении, уникален в пределах процесса.
+        По нему инвалидируются кэши результатов поиска; 0 — хранилище поколения не ведёт.
+        """
+        return 0
+
     def delete_by_source(self, source: str) -> int:
         ...
+
+    def delete_ids(self, chunk_ids: Sequence[str]) -> int:
+        """Точечное удаление чанков по id (инкрементальный re-ingest); возвращает число удалённых."""
+        ...
@@ -0,0 +1,483 @@
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from chat_engine.adapters.chunker_token import TokenChunker
+from chat_engine.adapters.embed_hash import HashingEmbedder
+from chat_engine.adapters.loader_txt import TxtLoader
+from chat_engine.adapters.tokens_approx import ApproxTokenCounter
+from chat_engine.adapters.vector_store_json import JsonVectorStore
+from chat_engine.domain.rag_models import LoadedPage, SearchFilter
+from chat_engine.use_cases.rag_indexer import RagIndexer
+
+
+class CountingEmbedder(HashingEmbedder):
+    """Запоминает тексты каждого батча embed; fail_after=N — батчи после N-го падают (обрыв ingest)."""
+
+    fail_after = None
+
+    def embed(self, texts):
+        self.batches = getattr(self, "batches", []) + [list(texts)]
+        if self.fail_after is not None and len(self.batches) > self.fail_after:
+            raise RuntimeError("boom")
+        return super().embed(texts)
+
+    @property
+    def texts(self):
+        return [t for batch in getattr(self, "batches", []) for t in batch]
+
+    @property
+    def calls(self):
+        return len(self.texts)
+
+    def reset(self):
+        self.batches = []
+
+
+class _PagedTxtLoader:
+    """Страницы — строки файла, разделённые \\f (на уровне модуля: экземпляр уходит в процессы пула)."""
+
+    def load(self, path):
+        return self.load_pages(path, 0, 10**9)
+
+    def page_count(self, path):
+        return len(Path(path).read_text(encoding="utf-8").split("\f"))
+
+    def load_pages(self, path, start, stop):
+        pages = Path(path).read_text(encoding="utf-8").split("\f")
+        return [LoadedPage(source=str(Path(path)), text=t, page=i + 1) for i, t in enumerate(pages) if start <= i < stop]
+
+
+def make_indexer(store, embedder=None, *, loaders=None, chunk_tokens=60, overlap_tokens=0, **kw):
+    return RagIndexer(
+        loaders=loaders or {"txt": TxtLoader()},
+        chunker=TokenChunker(counter=ApproxTokenCounter(), chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens),
+        embedder=embedder or HashingEmbedder(_dim=32),
+        store=store,
+        **kw,
+    )
+
+
+@pytest.fixture
+def new_store(tmp_path):
+    """Фабрика JsonVectorStore в tmp_path; после теста дожидается фоновой компакции созданных хранилищ."""
+    made = []
+
+    def make(name="store.json", cls=JsonVectorStore):
+        store = cls(str(tmp_path / name))
+        made.append(store)
+        return store
+
+    yield make
+    for store in made:
+        store.wait_for_compaction()
+
+
+def test_embedding_cache_skips_unchanged_chunks_on_reingest(tmp_path, new_store):
+    from chat_engine.adapters.embed_cache_sqlite import SqliteEmbeddingCache
+
+    doc = tmp_path / "a.txt"
+    doc.write_text(" ".join(f"слово{i}" for i in range(150)), encoding="utf-8")
+    emb = CountingEmbedder(_dim=32)
+    indexer = make_indexer(new_store(), emb, embedding_cache=SqliteEmbeddingCache(str(tmp_path / "emb.sqlite")))
+    n = indexer.ingest_paths([str(doc)])
+    first = emb.calls
+    assert n > 2 and first == n
+
+    indexer.delete_by_source(str(doc))
+    indexer.embedding_cache = SqliteEmbeddingCache(str(tmp_path / "emb.sqlite"))
+    assert indexer.ingest_paths([str(doc)]) == n
+    assert emb.calls == first
+
+    doc.write_text(doc.read_text(encoding="utf-8") + " и новый хвост", encoding="utf-8")
+    indexer.delete_by_source(str(doc))
+    indexer.ingest_paths([str(doc)])
+    assert emb.calls == first + 1
+
+
+def test_embedding_cache_evicts_least_recently_used_over_max_bytes(tmp_path):
+    from chat_engine.adapters.embed_cache_sqlite import SqliteEmbeddingCache
+
+    emb = HashingEmbedder(_dim=8)  # 64 байта на вектор
+    path = str(tmp_path / "emb.sqlite")
+    cache = SqliteEmbeddingCache(path, max_bytes=64 * 10)
+    first = [f"text {i}" for i in range(6)]
+    cache.put_many(emb, first, emb.embed(first))
+    time.sleep(0.002)
+    assert cache.get_many(emb, first[:2]) == emb.embed(first[:2])  # свежие — не вытесняются
+    time.sleep(0.002)
+    more = [f"more {i}" for i in range(6)]
+    cache.put_many(emb, more, emb.embed(more))
+
+    assert cache.count() <= 8 and cache.stats()["bytes"] <= 64 * 8
+    assert cache.get_many(emb, first[2:4]) == [None, None]
+    assert None not in cache.get_many(emb, first[:2] + more)
+    assert SqliteEmbeddingCache(path, max_bytes=64 * 10).stats()["bytes"] == cache.stats()["bytes"]
+
+
+def test_streaming_ingest_commits_batches_and_resumes_after_failure(tmp_path, new_store):
+    from chat_engine.adapters.ingest_state_jsonl import JsonlIngestStateStore
+
+    doc = tmp_path / "a.txt"
+    doc.write_text(" ".join(f"слово{i}" for i in range(400)), encoding="utf-8")
+    emb = CountingEmbedder(_dim=32)
+    emb.fail_after = 2
+    store = new_store()
+    indexer = make_indexer(
+        store, emb, batch_size=3, checkpoints=JsonlIngestStateStore(str(tmp_path / "store.json.ingest.jsonl"))
+    )
+    with pytest.raises(RuntimeError):
+        indexer.ingest_paths([str(doc)], replace=True)
+    assert store.count() == 6
+    assert indexer.checkpoints.get(str(doc))["done"] == 6
+
+    emb.fail_after = None
+    emb.reset()
+    n = indexer.ingest_paths([str(doc)], replace=True)
+    total = store.count()
+    sizes = [len(b) for b in emb.batches]
+    assert n == total - 6 and sum(sizes) == n and max(sizes) <= 3
+    assert indexer.checkpoints.get(str(doc)) is None
+    assert len({c.meta["start"] for c in store.search(emb.embed(["слово1"])[0], total)}) == total
+
+    assert indexer.ingest_paths([str(doc)], replace=True) == total
+    assert store.count() == total
+
+
+def test_parallel_ingest_keeps_serial_chunk_order(tmp_path):
+    from chat_engine.ports.vector_store import VectorStore
+
+    class RecordingStore(VectorStore):
+        def __init__(self):
+            self.chunks = []
+
+        def upsert(self, chunks, vectors):
+            self.chunks.extend(chunks)
+
+        def delete_by_source(self, source):
+            return 0
+
+        def count(self):
+            return len(self.chunks)
+
+    paths = []
+    for f in range(3):
+        p = tmp_path / f"doc{f}.pg"
+        p.write_text("\f".join(" ".join(f"f{f}p{pg}w{i}" for i in range(120)) for pg in range(7)), encoding="utf-8")
+        paths.append(str(p))
+
+    def run(workers):
+        store = RecordingStore()
+        indexer = make_indexer(
+            store,
+            HashingEmbedder(_dim=16),
+            loaders={"pg": _PagedTxtLoader()},
+            chunk_tokens=80,
+            overlap_tokens=10,
+            batch_size=5,
+            pages_per_task=2,
+        )
+        n = indexer.ingest_paths(paths, workers=workers)
+        assert n == len(store.chunks)
+        return [(c.source, c.page, c.text, c.meta["start"]) for c in store.chunks]
+
+    serial = run(0)
+    assert len({(s, p) for s, p, _, _ in serial}) == 21
+    assert run(3) == serial
+
+
+def test_manifest_reingest_skips_unchanged_files_and_diffs_changed_ones(tmp_path, new_store):
+    from chat_engine.adapters.ingest_state_jsonl import JsonlIngestStateStore
+
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    a, b = docs / "a.txt", docs / "b.md"
+    a.write_text(" ".join(f"альфа{i}" for i in range(200)), encoding="utf-8")
+    b.write_text(" ".join(f"бета{i}" for i in range(200)), encoding="utf-8")
+    (docs / "skip.bin").write_bytes(b"\0")
+    emb = CountingEmbedder(_dim=32)
+    store = new_store()
+
+    def indexer():
+        return make_indexer(
+            store,
+            emb,
+            loaders={"txt": TxtLoader(), "md": TxtLoader()},
+            manifest=JsonlIngestStateStore(str(tmp_path / "store.json.manifest.jsonl")),
+        )
+
+    total = indexer().ingest_paths([str(docs)])
+    assert total == store.count() and emb.calls == total
+
+    assert indexer().ingest_paths([str(docs)]) == 0
+    assert emb.calls == total and store.count() == total
+
+    q = emb.embed(["бета1"])[0]
+    before = {c.id for c in store.search(q, total)}
+    emb.reset()
+    text = b.read_text(encoding="utf-8")
+    b.write_text(text[: len(text) // 2], encoding="utf-8")
+    n = indexer().ingest_paths([str(docs)])
+    after = {c.id for c in store.search(q, total)}
+    # новые чанки эмбеддятся, старые префиксные остаются, хвост удалён
+    assert emb.calls == n and n <= 1
+    assert len(after - before) == n and len(after) == store.count() < total
+
+    a.touch()
+    assert indexer().ingest_paths([str(a)]) == 0
+
+
+def test_manifest_reindexes_files_after_embedder_or_index_change_and_on_replace(tmp_path):
+    pytest.importorskip("numpy")
+    from chat_engine.adapters.ingest_state_jsonl import JsonlIngestStateStore
+    from chat_engine.adapters.lexical_bm25 import Bm25Index
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    for name in ("a", "b"):
+        (docs / f"{name}.txt").write_text(" ".join(f"{name}слово{i}" for i in range(150)), encoding="utf-8")
+    store = NumpyVectorStore(str(tmp_path / "store.json"))
+    manifest = JsonlIngestStateStore(str(tmp_path / "store.json.manifest.jsonl"))
+
+    def indexer(emb, **kw):
+        return make_indexer(store, emb, manifest=manifest, **kw)
+
+    total = indexer(HashingEmbedder(_dim=32)).ingest_paths([str(docs)])
+    assert indexer(HashingEmbedder(_dim=32)).ingest_paths([str(docs)]) == 0
+
+    # другая размерность: все файлы удаляются до первой записи, векторы разной длины не встречаются
+    emb = CountingEmbedder(_dim=48)
+    assert indexer(emb).ingest_paths([str(docs)]) == total
+    assert emb.calls == total and store.count() == total and store.dim == 48
+    assert indexer(emb).ingest_paths([str(docs)]) == 0
+
+    # включили BM25: пропущенные файлы оставили бы индекс пустым
+    bm25 = Bm25Index(str(tmp_path / "bm25.json"))
+    assert indexer(emb, lexical=bm25).ingest_paths([str(docs)]) == total
+    assert bm25.count() == total
+    assert indexer(emb, lexical=bm25).ingest_paths([str(docs)]) == 0
+
+    # --ingest-replace: манифест не учитывается, чанки файла пишутся заново
+    emb.reset()
+    assert indexer(emb, lexical=bm25).ingest_paths([str(docs / "a.txt")], replace=True) > 0
+    assert emb.calls > 0 and store.count() == total and bm25.count() == total
+
+
+def test_manifest_does_not_pair_old_chunks_with_replaced_file_hash(tmp_path, new_store):
+    from chat_engine.adapters.ingest_state_jsonl import JsonlIngestStateStore
+
+    doc = tmp_path / "doc.txt"
+    old, new = "старая " * 60, "свежая " * 60  # одинаковый размер в байтах
+    assert len(old.encode()) == len(new.encode())
+    doc.write_text(old, encoding="utf-8")
+
+    class ReplacingLoader(TxtLoader):
+        """Пока документ читается, загрузка новой версии подменяет файл (как os.replace в /documents/upload)."""
+
+        def load(self, path):
+            pages = super().load(path)
+            tmp = tmp_path / "upload.part"
+            tmp.write_text(new, encoding="utf-8")
+            os.replace(tmp, path)
+            return pages
+
+    store = new_store()
+    manifest = JsonlIngestStateStore(str(tmp_path / "store.json.manifest.jsonl"))
+
+    def indexer(loader):
+        return make_indexer(store, loaders={"txt": loader}, manifest=manifest)
+
+    assert indexer(ReplacingLoader()).ingest_paths([str(doc)]) > 0
+    assert indexer(TxtLoader()).ingest_paths([str(doc)]) > 0  # новая версия не пропущена
+    q = HashingEmbedder(_dim=32).embed(["свежая"])[0]
+    assert all("свежая" in c.text for c in store.search(q, 50))
+
+
+def test_ingest_job_queue_close_waits_for_running_jobs_and_fails_waiting_ones():
+    from chat_engine.use_cases.ingest_jobs import IngestJobQueue
+
+    jobs = IngestJobQueue(workers=1)
+    started, gate = threading.Event(), threading.Event()
+
+    def slow(paths, progress):
+        started.set()
+        gate.wait(5)
+        return 7
+
+    running = jobs.submit("default", [], slow)
+    waiting = jobs.submit("default", [], lambda p, pr: 1)
+    started.wait(5)
+    threading.Timer(0.1, gate.set).start()
+    jobs.close()
+    assert running.status == "done" and running.chunks_written == 7
+    assert waiting.status == "failed" and waiting.error == "Ingest queue closed"
+
+
+def test_ingest_job_queue_reports_progress_and_failures(tmp_path, new_store):
+    from chat_engine.use_cases.ingest_jobs import IngestJobQueue, IngestQueueFull
+
+    doc = tmp_path / "doc.txt"
+    doc.write_text(" ".join(f"слово{i}" for i in range(400)), encoding="utf-8")
+    store = new_store()
+    indexer = make_indexer(store, batch_size=4)
+    jobs = IngestJobQueue(workers=2, max_pending=3, keep_finished=2)
+    gate = threading.Event()
+
+    def blocked(paths, progress):
+        gate.wait(5)
+        return indexer.ingest_paths(paths, progress=progress)
+
+    def wait_for(*js):
+        deadline = time.monotonic() + 5
+        while not all(j.finished for j in js) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    ok = jobs.submit("default", [str(doc)], blocked)
+    bad = jobs.submit("default", [str(tmp_path / "missing.txt")], lambda p, pr: indexer.ingest_paths(p, progress=pr))
+    other_gate = threading.Event()
+    other = jobs.submit("other", [], lambda p, pr: int(not other_gate.wait(5)))
+    with pytest.raises(IngestQueueFull):
+        jobs.submit("other", [str(doc)], blocked)
+    # bad ждёт ok (тот же key), но воркер не занимает: задача другого хранилища идёт параллельно с ok
+    other_gate.set()
+    wait_for(other)
+    assert other.status == "done" and bad.status == "queued"
+    gate.set()
+    wait_for(ok, bad)
+    jobs.close()
+    with pytest.raises(IngestQueueFull):
+        jobs.submit("default", [str(doc)], blocked)
+
+    info = ok.to_dict()
+    assert info["status"] == "done" and info["chunks_written"] == store.count() > 1
+    p = info["progress"]
+    assert p["files_done"] == 1 and p["pages"] == 1
+    assert p["chunks"] == p["embedded"] == store.count() and p["embeddings_per_sec"] > 0
+    assert bad.status == "failed" and bad.error
+    assert jobs.get(bad.job_id) is bad and jobs.get(ok.job_id) is None  # keep_finished=2, по порядку постановки
+    assert not jobs._waiting
+
+
+def test_near_duplicate_chunks_collapse_into_one_with_sources(tmp_path, new_store):
+    from chat_engine.adapters.dedup_minhash import MinHashLshIndex
+    from chat_engine.adapters.lexical_bm25 import Bm25Index
+
+    legal = [f"пункт{i}" for i in range(80)]
+    edited = legal[:40] + ["изменён"] + legal[41:]
+    files = {
+        "a.txt": [" ".join(f"альфа{i}" for i in range(60)), " ".join(legal)],
+        "b.txt": [" ".join(f"бета{i}" for i in range(60)), " ".join(edited)],
+        "c.txt": [" ".join(legal)],
+    }
+    for name, pages in files.items():
+        (tmp_path / name).write_text("\f".join(pages), encoding="utf-8")
+
+    dedup = MinHashLshIndex(str(tmp_path / "store.json.dedup.sqlite"), threshold=0.85)
+    assert dedup.similarity(" ".join(legal), " ".join(edited)) > 0.85
+    assert dedup.similarity(files["a.txt"][0], files["b.txt"][0]) < 0.2
+
+    store = new_store()
+    lexical = Bm25Index(str(tmp_path / "store.bm25.json"))
+    emb = HashingEmbedder(_dim=64)
+    indexer = make_indexer(
+        store, emb, loaders={"txt": _PagedTxtLoader()}, chunk_tokens=200, lexical=lexical, dedup=dedup
+    )
+    assert indexer.ingest_paths([str(tmp_path / n) for n in files]) == 3
+    assert store.count() == 3 and dedup.count() == 5
+
+    def legal_hits():
+        hits = [c for c in store.search(emb.embed([" ".join(legal)])[0], 10) if "пункт1 " in c.text]
+        assert [c.id for c in lexical.search("пункт7 пункт8", 10)] == [c.id for c in hits]
+        return hits
+
+    (hit,) = legal_hits()
+    assert [s["source"] for s in hit.meta["sources"]] == [str(tmp_path / n) for n in files]
+    assert hit.source == str(tmp_path / "a.txt") and hit.meta["sources"][-1]["page"] == 1
+    # фильтр по источнику дубликата находит канонический чанк
+    only_c = SearchFilter.build(sources=[str(tmp_path / "c.txt")])
+    assert [c.id for c in store.search(emb.embed([" ".join(legal)])[0], 5, where=only_c)] == [hit.id]
+    assert [c.id for c in lexical.search("пункт7", 5, where=only_c)] == [hit.id]
+
+    # канонический чанк ушёл вместе с документом — его место занимает дубликат из b.txt
+    indexer.delete_by_source(str(tmp_path / "a.txt"))
+    assert store.count() == 2
+    (hit,) = legal_hits()
+    assert hit.source == str(tmp_path / "b.txt") and "изменён" in hit.text
+    assert [s["source"] for s in hit.meta["sources"]] == [str(tmp_path / "b.txt"), str(tmp_path / "c.txt")]
+
+    indexer.delete_by_source(str(tmp_path / "c.txt"))
+    (hit,) = legal_hits()
+    assert "sources" not in hit.meta
+
+
+def test_duplicate_groups_are_rewritten_once_per_file_from_stored_vectors(tmp_path, new_store):
+    from chat_engine.adapters.dedup_minhash import MinHashLshIndex
+    from chat_engine.adapters.ingest_state_jsonl import JsonlIngestStateStore
+
+    boiler = " ".join(f"условие{i}" for i in range(60))
+
+    class CountingStore(JsonVectorStore):
+        def upsert(self, chunks, vectors):
+            self.writes = getattr(self, "writes", []) + [c.id for c in chunks]
+            super().upsert(chunks, vectors)
+
+    class FailingLoader(_PagedTxtLoader):
+        fail = True
+
+        def load_pages(self, path, start, stop):
+            pages = super().load_pages(path, start, stop)
+            if self.fail and Path(path).name == "c.txt":
+                yield from pages[:2]
+                raise RuntimeError("loader died")
+            yield from pages
+
+    (tmp_path / "a.txt").write_text(boiler, encoding="utf-8")
+    (tmp_path / "b.txt").write_text("\f".join([boiler] * 5), encoding="utf-8")
+    (tmp_path / "c.txt").write_text("\f".join([boiler] * 3), encoding="utf-8")
+    store = new_store(cls=CountingStore)
+    dedup = MinHashLshIndex(str(tmp_path / "store.json.dedup.sqlite"))
+    loader = FailingLoader()
+    emb = CountingEmbedder(_dim=64)
+    indexer = make_indexer(
+        store,
+        emb,
+        loaders={"txt": loader},
+        chunk_tokens=400,
+        dedup=dedup,
+        batch_size=1,
+        checkpoints=JsonlIngestStateStore(str(tmp_path / "store.json.ingest.jsonl")),
+    )
+    indexer.ingest_paths([str(tmp_path / "a.txt"), str(tmp_path / "b.txt")])
+    (canonical,) = store.search(HashingEmbedder(_dim=64).embed([boiler])[0], 5)
+    assert len(canonical.meta["sources"]) == 6
+    # канонический чанк: запись при появлении + одна перезапись за b.txt (а не после каждого из 5 батчей)
+    assert store.writes.count(canonical.id) == 2
+    assert emb.texts == [boiler]
+    assert dedup.stale() == []
+
+    # загрузка упала после двух дубликатов: отметка о росте группы переживает падение
+    with pytest.raises(RuntimeError):
+        indexer.ingest_paths([str(tmp_path / "c.txt")])
+    assert dedup.stale() == [canonical.id]
+    loader.fail = False
+    indexer.ingest_paths([str(tmp_path / "c.txt")])
+    (hit,) = store.search(HashingEmbedder(_dim=64).embed([boiler])[0], 5)
+    assert len(hit.meta["sources"]) == 9 and dedup.stale() == []
+    assert emb.texts == [boiler]
+
+
+def test_minhash_signature_without_numpy_matches(tmp_path, monkeypatch):
+    from chat_engine.adapters.dedup_minhash import MinHashLshIndex
+
+    idx = MinHashLshIndex(str(tmp_path / "dedup.sqlite"))
+    text = "Настоящий договор вступает в силу с момента подписания сторонами"
+    fast = idx.signature(text)
+    monkeypatch.setitem(sys.modules, "numpy", None)  # import numpy -> ImportError
+    assert idx.signature(text) == fast
+    assert idx.similarity(text, text + " и действует один год") > 0.5
+    idx.close()
@@ -1,6 +1,10 @@
 import tempfile
+import threading
+import time
 from pathlib import Path
 
+import pytest
+
 from chat_engine.adapters.tokens_approx import ApproxTokenCounter
 from chat_engine.adapters.loader_txt import TxtLoader
 from chat_engine.adapters.chunker_token import TokenChunker
@@ -9,6 +13,7 @@ from chat_engine.adapters.vector_store_json import JsonVectorStore
 from chat_engine.adapters.rag_augmentor import RagAugmentor
 from chat_engine.use_cases.rag_indexer import RagIndexer
 from chat_engine.domain.models import Message, Conversation
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter
 from datetime import datetime, timezone
 
 def test_rag_index_and_retrieve_topk_and_budget():
@@ -54,3 +59,593 @@ def test_rag_index_and_retrieve_topk_and_budget():
         assert len(rc) == 1
 
         assert counter.count_messages([rc[0]]) <= aug.max_rag_tokens
+
+
+def test_bm25_hybrid_retrieval_and_delete_sync():
+    from chat_engine.adapters.lexical_bm25 import Bm25Index
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        a = d / "a.txt"
+        b = d / "b.txt"
+        a.write_text("Paris is the capital of France.", encoding="utf-8")
+        b.write_text("Berlin is the capital of Germany.", encoding="utf-8")
+
+        counter = ApproxTokenCounter()
+        store = JsonVectorStore(str(d / "rag.json"))
+        lexical = Bm25Index(str(d / "rag.bm25.json"))
+        embedder = HashingEmbedder()
+        indexer = RagIndexer(
+            loaders={"txt": TxtLoader()},
+            chunker=TokenChunker(counter=counter, chunk_tokens=80, overlap_tokens=10),
+            embedder=embedder,
+            store=store,
+            lexical=lexical,
+        )
+        indexer.ingest_paths([str(a), str(b)])
+        assert lexical.count() == 2
+        assert lexical.search("germany", top_k=1)[0].source == str(b)
+
+        aug = RagAugmentor(
+            store=store, embedder=embedder, counter=counter, top_k=1, max_rag_tokens=200,
+            mode="always", lexical=lexical, retrieval="hybrid",
+        )
+        convo = Conversation(conversation_id="c1", messages=[
+            Message(id="u1", role="user", content="Which country has Berlin?", created_at=datetime.now(timezone.utc), meta={}),
+        ])
+        out = aug.augment(convo, list(convo.messages))
+        rc = [m for m in out if m.meta.get("type") == "retrieved_context"]
+        assert rc and rc[0].meta["sources"] == [str(b)]
+
+        assert indexer.delete_by_source(str(b)) == 1
+        assert lexical.count() == 1
+        assert Bm25Index(str(d / "rag.bm25.json")).search("berlin", top_k=3) == []
+        store.wait_for_compaction()
+
+
+def test_namespaced_stores_load_lazily_and_evict_lru():
+    from chat_engine.adapters.vector_store_namespaced import NamespaceRegistry, namespace_slug
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        opened = []
+
+        def open_ns(ns):
+            opened.append(ns)
+            return JsonVectorStore(str(d / f"{namespace_slug(ns)}.json")), None
+
+        reg = NamespaceRegistry(open_ns, max_bytes=2 * (1024 + 32 * 3))  # JsonVectorStore.nbytes двух чанков
+        alice, bob, carol = reg.store("alice"), reg.store("bob"), reg.store("../carol")
+        assert opened == []
+
+        chunk = lambda cid: DocumentChunk(id=cid, text=cid, source="a.txt")
+        alice.upsert([chunk("a1")], [[1.0, 0.0, 0.0]])
+        bob.upsert([chunk("b1")], [[0.0, 1.0, 0.0]])
+        assert [c.id for c in alice.search([0.0, 1.0, 0.0], top_k=5)] == ["a1"]
+        assert reg.loaded() == ["bob", "alice"]
+
+        carol.upsert([chunk("c1")], [[0.0, 0.0, 1.0]])
+        assert reg.loaded() == ["alice", "../carol"]
+        assert reg.evictions == 1
+        assert JsonVectorStore(str(d / f"{namespace_slug('../carol')}.json")).count() == 1
+        assert "/" not in namespace_slug("../carol")
+        assert sorted(reg._ns_locks) == sorted(reg.loaded())  # лок выгруженного bob удалён
+
+        assert [c.id for c in bob.search([0.0, 1.0, 0.0], top_k=5)] == ["b1"]
+        assert opened.count("bob") == 2
+
+
+def test_namespace_registry_sizes_sparse_tenants_by_store_footprint():
+    from chat_engine.adapters.vector_store_namespaced import NamespaceRegistry
+
+    emb = HashingEmbedder(_dim=2**18)
+    with tempfile.TemporaryDirectory() as d:
+
+        def open_ns(ns):
+            return JsonVectorStore(str(Path(d) / f"{ns}.json"), sparse=True), None
+
+        reg = NamespaceRegistry(open_ns, max_bytes=256 * 1024)
+        texts = [f"документ {i} про разреженные векторы" for i in range(20)]
+        for u in range(5):
+            chunks = [DocumentChunk(id=f"{u}-{i}", text=t, source="a.txt") for i, t in enumerate(texts)]
+            reg.store(f"u{u}").upsert_sparse(chunks, emb.embed_sparse(texts))
+        # count x 4*dim сочло бы каждого по 20 МБ и держало бы открытым одного
+        assert reg.evictions == 0 and len(reg.loaded()) == 5
+        assert reg.loaded_bytes() < 5 * 20 * 2048
+
+        reg.max_bytes = 1
+        for u in range(5, 40):
+            reg.store(f"u{u}").upsert_sparse([DocumentChunk(id="x", text="x", source="a.txt")], emb.embed_sparse(["x"]))
+        assert reg.loaded() == ["u39"] and list(reg._ns_locks) == ["u39"]
+
+
+def test_query_embedding_cache_hits_on_repeated_query():
+    from chat_engine.adapters.rag_cache import QueryEmbeddingCache
+
+    class CountingEmbedder(HashingEmbedder):
+        calls = 0
+
+        def embed(self, texts):
+            CountingEmbedder.calls += len(texts)
+            return super().embed(texts)
+
+        def embed_sparse(self, texts):
+            CountingEmbedder.calls += len(texts)
+            return super().embed_sparse(texts)
+
+    with tempfile.TemporaryDirectory() as d:
+        store = JsonVectorStore(str(Path(d) / "rag.json"))
+        embedder = CountingEmbedder()
+        store.upsert(
+            [DocumentChunk(id="a", text="Paris is the capital of France", source="a.txt")],
+            embedder.embed(["Paris is the capital of France"]),
+        )
+        calls_after_ingest = CountingEmbedder.calls
+        aug = RagAugmentor(
+            store=store,
+            embedder=embedder,
+            counter=ApproxTokenCounter(),
+            mode="always",
+            query_cache=QueryEmbeddingCache(8),
+        )
+
+        def ask(text):
+            convo = Conversation(conversation_id="c", messages=[
+                Message(id="u", role="user", content=text, created_at=datetime.now(timezone.utc), meta={}),
+            ])
+            out = aug.augment(convo, list(convo.messages))
+            return next(m for m in out if m.meta.get("type") == "retrieved_context").meta["cache"]["embedding"]
+
+        assert ask("capital of France?")["hit"] is False
+        info = ask("  capital   of France? ")
+        assert info["hit"] is True and info["hits"] == 1 and info["misses"] == 1
+        assert CountingEmbedder.calls - calls_after_ingest == 1
+
+
+def test_retrieval_cache_is_invalidated_by_store_generation():
+    from chat_engine.adapters.rag_cache import QueryEmbeddingCache, RetrievalCache
+
+    class CountingStore(JsonVectorStore):
+        searches = 0
+
+        def search(self, *args, **kwargs):
+            CountingStore.searches += 1
+            return super().search(*args, **kwargs)
+
+    with tempfile.TemporaryDirectory() as d:
+        store = CountingStore(str(Path(d) / "rag.json"))
+        embedder = HashingEmbedder()
+        texts = {"a": "Paris is the capital of France", "b": "France capital city facts"}
+        store.upsert([DocumentChunk(id="a", text=texts["a"], source="a.txt")], embedder.embed([texts["a"]]))
+        aug = RagAugmentor(
+            store=store,
+            embedder=embedder,
+            counter=ApproxTokenCounter(),
+            mode="always",
+            query_cache=QueryEmbeddingCache(8),
+            retrieval_cache=RetrievalCache(8),
+        )
+
+        def ask():
+            convo = Conversation(conversation_id="c", messages=[
+                Message(id="u", role="user", content="capital of France", created_at=datetime.now(timezone.utc), meta={}),
+            ])
+            return next(m for m in aug.augment(convo, list(convo.messages)) if m.meta.get("type") == "retrieved_context")
+
+        first, second = ask(), ask()
+        assert second.meta["cache"]["retrieval"]["hit"] is True
+        assert second.content == first.content and second.id != first.id
+        assert CountingStore.searches == 1
+
+        gen = store.generation
+        store.upsert([DocumentChunk(id="b", text=texts["b"], source="b.txt")], embedder.embed([texts["b"]]))
+        assert store.generation > gen
+        third = ask()
+        assert third.meta["cache"]["retrieval"]["hit"] is False
+        assert CountingStore.searches == 2
+        assert third.meta["chosen"] == 2
+
+
+def test_hashed_queries_stay_sparse_in_cache_search_and_mmr():
+    from chat_engine.adapters.rag_cache import QueryEmbeddingCache
+    from chat_engine.adapters.rag_rerank import mmr_select, mmr_select_sparse
+    from chat_engine.domain.rag_models import SparseVector
+
+    embedder = HashingEmbedder(_dim=2**18)
+    texts = [
+        "paris is the capital of france",
+        "paris is the capital of france and its largest city",
+        "berlin is the capital of germany",
+        "the eiffel tower stands in paris",
+    ]
+    with tempfile.TemporaryDirectory() as d:
+        store = JsonVectorStore(str(Path(d) / "rag.json"), sparse=True)
+        chunks = [DocumentChunk(id=f"c{i}", text=t, source="a.txt") for i, t in enumerate(texts)]
+        store.upsert_sparse(chunks, embedder.embed_sparse(texts))
+
+        cache = QueryEmbeddingCache(8)
+        qv, _ = cache.embed(embedder, "capital of france paris")
+        assert isinstance(qv, SparseVector) and len(qv.indices) == 4
+
+        dense_q = qv.to_dense()
+        assert [c.id for c in store.search(qv, top_k=4)] == [c.id for c in store.search(dense_q, top_k=4)]
+
+        dense_c = embedder.embed(texts)
+        assert mmr_select_sparse(qv, embedder.embed_sparse(texts), 3, 0.5) == mmr_select(dense_q, dense_c, 3, 0.5)
+
+        aug = RagAugmentor(
+            store=store, embedder=embedder, counter=ApproxTokenCounter(), mode="always",
+            top_k=2, fetch_k=4, mmr=True, mmr_lambda=0.5, merge_chunks=False, query_cache=cache,
+        )
+        assert [c.id for c in aug._retrieve("capital of france paris", qv)] == [
+            chunks[i].id for i in mmr_select(dense_q, dense_c, 2, 0.5)
+        ]
+
+
+def test_json_store_journal_tombstones_and_compaction():
+    with tempfile.TemporaryDirectory() as d:
+        path = Path(d) / "rag.json"
+        journal = Path(d) / "rag.json.journal.jsonl"
+        store = JsonVectorStore(str(path), compact_ratio=0.9, max_journal_ops=100)
+        chunk = lambda cid, src: DocumentChunk(id=cid, text=cid, source=src)
+        store.upsert([chunk("a1", "A.txt"), chunk("a2", "A.txt"), chunk("b1", "b.txt")], [[1.0, 0.0], [0.9, 0.1], [0.0, 1.0]])
+        store.upsert([chunk("b1", "b.txt")], [[0.1, 0.9]])
+        assert store.delete_by_source("a.txt") == 2
+        assert store.count() == 1
+        assert journal.exists() and not path.exists()
+
+        reopened = JsonVectorStore(str(path))
+        assert [c.id for c in reopened.search([1.0, 0.0], top_k=5)] == ["b1"]
+        assert reopened.delete_by_source("missing.txt") == 0
+
+        stats = store.compact()
+        assert stats == {"rows_before": 4, "rows_after": 1}
+        assert path.exists() and not journal.exists()
+        assert [c.id for c in JsonVectorStore(str(path)).search([1.0, 0.0], top_k=5)] == ["b1"]
+
+
+def test_json_store_reload_waits_for_live_compaction_of_another_instance(monkeypatch):
+    from chat_engine.adapters import vector_store_json
+    from chat_engine.adapters.vector_store_namespaced import NamespaceRegistry
+
+    release = threading.Event()
+    write = vector_store_json._atomic_write
+
+    def slow_write(path, text):
+        release.wait(5)
+        write(path, text)
+
+    monkeypatch.setattr(vector_store_json, "_atomic_write", slow_write)
+    with tempfile.TemporaryDirectory() as d:
+        path = str(Path(d) / "rag.json")
+        chunk = lambda cid: DocumentChunk(id=cid, text=cid, source="a.txt")
+        store = JsonVectorStore(path, max_journal_ops=2)
+        store.upsert([chunk("c1"), chunk("c2")], [[1.0, 0.0], [0.0, 1.0]])  # компакция повисла на записи
+        store.upsert([chunk("c3")], [[1.0, 1.0]])  # уже в новый журнал
+
+        loaded = []
+        t = threading.Thread(target=lambda: loaded.append(JsonVectorStore(path).count()))
+        t.start()
+        t.join(0.2)
+        assert t.is_alive() and loaded == []
+        release.set()
+        t.join()
+        assert loaded == [3]
+        store.wait_for_compaction()
+        assert JsonVectorStore(path).count() == 3
+
+        # выгрузка из реестра дожидается фоновой компакции выгруженного хранилища
+        release.clear()
+        stores = {}
+
+        def open_ns(ns):
+            stores[ns] = JsonVectorStore(str(Path(d) / f"{ns}.json"), max_journal_ops=1)
+            return stores[ns], None
+
+        reg = NamespaceRegistry(open_ns, max_bytes=1)
+        reg.store("a").upsert([chunk("a1")], [[1.0, 0.0]])
+        threading.Timer(0.2, release.set).start()
+        reg.store("b").upsert([chunk("b1")], [[0.0, 1.0]])
+        assert reg.loaded() == ["b"]
+        assert not stores["a"]._compactor.is_alive()
+        stores["b"].wait_for_compaction()
+
+
+def test_json_store_search_sees_consistent_snapshots_during_ingest():
+    import threading
+
+    with tempfile.TemporaryDirectory() as d:
+        store = JsonVectorStore(str(Path(d) / "rag.json"), max_journal_ops=50)
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            while not done.is_set():
+                try:
+                    hits = store.search([1.0, 0.0], top_k=3)
+                    assert len({c.id for c in hits}) == len(hits)
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        t = threading.Thread(target=reader)
+        t.start()
+        for i in range(200):
+            store.upsert([DocumentChunk(id=f"c{i % 20}", text="x", source=f"s{i % 5}.txt")], [[1.0, float(i)]])
+            if i % 7 == 0:
+                store.delete_by_source(f"s{i % 5}.txt")
+        done.set()
+        t.join()
+        store.wait_for_compaction()
+        assert errors == []
+        assert store.count() == JsonVectorStore(str(Path(d) / "rag.json")).count()
+
+
+def test_json_store_writes_share_snapshot_structures_and_old_snapshots_stay_intact():
+    with tempfile.TemporaryDirectory() as d:
+        store = JsonVectorStore(str(Path(d) / "rag.json"), compact_ratio=10.0)
+        store.upsert([DocumentChunk(id=f"c{i}", text="x", source="a.txt") for i in range(3)], [[1.0, 0.0]] * 3)
+        old = store._snap
+
+        store.upsert([DocumentChunk(id="c0", text="y", source="b.txt")], [[0.0, 1.0]])
+        store.delete_ids(["c1"])
+        new = store._snap
+
+        # запись дописывает в общие списки, а не копирует их
+        assert new.items is old.items and new.died is old.died and new.rows is old.rows
+        assert [r for r in range(old.n) if old.alive(r)] == [0, 1, 2]
+        assert [new.items[r]["chunk"]["id"] for r in range(new.n) if new.alive(r)] == ["c2", "c0"]
+        assert (new.live, new.dead) == (2, 2)
+        assert [c.id for c in store.search([0.0, 1.0], top_k=5, where=SearchFilter(sources=["b.txt"]))] == ["c0"]
+
+
+def test_merge_adjacent_restores_page_text_and_mmr_skips_duplicates():
+    from chat_engine.adapters.rag_rerank import merge_adjacent, mmr_select
+    from chat_engine.domain.rag_models import LoadedPage
+
+    text = " ".join(f"word{i}" for i in range(400))
+    chunker = TokenChunker(counter=ApproxTokenCounter(), chunk_tokens=60, overlap_tokens=15)
+    chunks = list(chunker.chunk([LoadedPage(source="a.txt", text=text, page=1)]))
+    assert len(chunks) > 3
+    assert all(text[c.meta["start"]:c.meta["end"]] == c.text for c in chunks)
+
+    other = DocumentChunk(id="x", text="unrelated", source="b.txt", page=1)
+    merged = merge_adjacent([chunks[2], other, chunks[1], chunks[0], chunks[3]])
+    assert [c.id for c in merged] == [chunks[2].id, "x"]
+    assert merged[0].text == text[: chunks[3].meta["end"]]
+    assert len(merged[0].meta["merged"]) == 4
+
+    stripped = [DocumentChunk(id=c.id, text=c.text, source=c.source, page=c.page) for c in chunks[:2]]
+    assert merge_adjacent(stripped)[0].text == text[: chunks[1].meta["end"]]
+
+    q = [1.0, 0.0]
+    cands = [[0.99, 0.14], [0.98, 0.15], [0.7, -0.71]]
+    assert mmr_select(q, cands, 2, lambda_=1.0) == [0, 1]
+    assert mmr_select(q, cands, 2, lambda_=0.5) == [0, 2]
+
+
+def test_hashing_embedder_batch_matches_per_token_reference():
+    import hashlib
+    import math
+    import re
+
+    def reference(text, dim):
+        vec = [0.0] * dim
+        for t in re.findall(r"\w+", text.lower()):
+            h = hashlib.md5(t.encode("utf-8")).digest()
+            vec[int.from_bytes(h[:4], "little") % dim] += 1.0 if (h[4] & 1) == 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vec))
+        return vec if norm <= 0.0 else [v / norm for v in vec]
+
+    texts = ["Привет, мир! привет", "", "   ", "a b c a b a " * 50, "Страница 12: раздел 3.4"]
+    emb = HashingEmbedder(_dim=64)
+    assert emb.embed(texts) == [reference(t, 64) for t in texts]
+    assert emb.embed(texts[:1]) == [reference(texts[0], 64)]
+
+
+def test_batching_embedder_coalesces_concurrent_single_queries():
+    import threading
+    from chat_engine.adapters.embed_batching import BatchingEmbedder
+    from chat_engine.adapters.rag_cache import embedder_key
+
+    class SlowEmbedder(HashingEmbedder):
+        def embed(self, texts):
+            self.batches = getattr(self, "batches", []) + [len(texts)]
+            return super().embed(texts)
+
+    inner = SlowEmbedder(_dim=16)
+    emb = BatchingEmbedder(inner, max_batch=8, max_wait_ms=200)
+    texts = [f"запрос номер {i}" for i in range(16)]
+    out = [None] * len(texts)
+
+    def worker(i):
+        out[i] = emb.embed([texts[i]])[0]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(texts))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert out == HashingEmbedder(_dim=16).embed(texts)
+    assert max(inner.batches) > 1 and sum(inner.batches) == 16 and max(inner.batches) <= 8
+    st = emb.stats()
+    assert st["batch_size"]["count"] == len(inner.batches)
+    assert st["queue_depth"]["count"] == 16
+    assert embedder_key(emb) == embedder_key(inner)
+    emb.close()
+
+
+def test_remote_embedder_matches_local_model_over_unix_socket():
+    import threading
+    from chat_engine.adapters.embed_remote import RemoteEmbedder
+    from chat_engine.adapters.rag_cache import embedder_key
+    from chat_engine.app.embed_server import EmbeddingServer
+
+    with tempfile.TemporaryDirectory() as d:
+        local = HashingEmbedder(_dim=32)
+        server = EmbeddingServer(str(Path(d) / "e.sock"), local)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            remote = RemoteEmbedder(str(Path(d) / "e.sock"))
+            texts = ["Привет, мир", "", "документ про кэш"]
+            assert remote.embed(texts) == local.embed(texts)
+            assert remote.embed([]) == []
+            assert remote.dim == 32
+            assert embedder_key(remote) == embedder_key(local)
+
+            out = {}
+            threads = [threading.Thread(target=lambda i=i: out.__setitem__(i, remote.embed([f"q{i}"]))) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert [out[i][0] for i in range(8)] == local.embed([f"q{i}" for i in range(8)])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_remote_embedder_waits_for_full_server_backlog():
+    from chat_engine.adapters.embed_remote import RemoteEmbedder
+    from chat_engine.app.embed_server import EmbeddingServer
+
+    class TinyBacklogServer(EmbeddingServer):
+        request_queue_size = 1
+
+    with tempfile.TemporaryDirectory() as d:
+        local = HashingEmbedder(_dim=16)
+        server = TinyBacklogServer(str(Path(d) / "e.sock"), local)
+        remote = RemoteEmbedder(str(Path(d) / "e.sock"), timeout=10.0)
+        out, errors = {}, []
+
+        def call(i):
+            try:
+                out[i] = remote.embed([f"q{i}"])[0]
+            except Exception as e:  # pragma: no cover - сообщение для упавшего assert
+                errors.append(e)
+
+        # все клиенты подключаются раньше, чем сервер начинает accept: backlog переполнен
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(32)]
+        for t in threads:
+            t.start()
+        time.sleep(0.2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for t in threads:
+                t.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert not errors
+        assert [out[i] for i in range(32)] == local.embed([f"q{i}" for i in range(32)])
+
+
+def test_remote_embedder_does_not_retry_on_timeout():
+    import socket
+
+    from chat_engine.adapters.embed_remote import RemoteEmbedder
+    from chat_engine.app.embed_server import EmbeddingServer
+
+    class SlowEmbedder(HashingEmbedder):
+        calls = 0
+
+        def embed(self, texts):
+            SlowEmbedder.calls += 1
+            time.sleep(0.6)
+            return super().embed(texts)
+
+    with tempfile.TemporaryDirectory() as d:
+        server = EmbeddingServer(str(Path(d) / "e.sock"), SlowEmbedder(_dim=8))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            remote = RemoteEmbedder(str(Path(d) / "e.sock"), timeout=0.2)
+            started = time.monotonic()
+            with pytest.raises(socket.timeout):
+                remote.embed(["медленно"])
+            assert time.monotonic() - started < 0.5 and SlowEmbedder.calls == 1
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_sparse_json_store_matches_dense_scores_and_is_smaller():
+    from chat_engine.domain.rag_models import SearchFilter
+
+    emb = HashingEmbedder(_dim=4096)
+    texts = [f"документ {i} про тему {i % 3} и слово{i}" for i in range(30)]
+    chunks = [DocumentChunk(id=f"c{i}", text=t, source=f"s{i % 2}.txt", page=1) for i, t in enumerate(texts)]
+
+    with tempfile.TemporaryDirectory() as d:
+        dense = JsonVectorStore(str(Path(d) / "dense.json"))
+        sparse = JsonVectorStore(str(Path(d) / "sparse.json"), sparse=True)
+        dense.upsert(chunks, emb.embed(texts))
+        sparse.upsert_sparse(chunks, emb.embed_sparse(texts))
+
+        q = emb.embed(["тема 1 слово7"])[0]
+        for where in (None, SearchFilter.build(sources=["s1.txt"])):
+            assert [c.id for c in sparse.search(q, 5, where=where)] == [c.id for c in dense.search(q, 5, where=where)]
+        assert sparse.dim == dense.dim == 4096
+        assert sparse.vectors(["c3"]) == dense.vectors(["c3"])
+
+        dense.compact()
+        sparse.compact()
+        assert (Path(d) / "sparse.json").stat().st_size * 10 < (Path(d) / "dense.json").stat().st_size
+
+
+def test_token_chunker_slices_on_counter_offsets_in_one_pass():
+    import re
+
+    from chat_engine.domain.rag_models import LoadedPage
+
+    class WordCounter(ApproxTokenCounter):
+        """Токен — слово вместе с пробелами перед ним (как у BPE)."""
+        offsets_calls = 0
+
+        def token_offsets(self, text):
+            self.offsets_calls += 1
+            return [m.start() for m in re.finditer(r"\s*\S+", text)]
+
+        def count_text(self, text):
+            raise AssertionError("count_text must not be called by the chunker")
+
+    counter = WordCounter()
+    sentences = [" ".join(f"слово{i}_{j}" for j in range(7)) + "." for i in range(40)]
+    pages = [LoadedPage(source="doc.txt", text=" ".join(sentences), page=p) for p in (1, 2)]
+    chunks = list(TokenChunker(counter=counter, chunk_tokens=30, overlap_tokens=5).chunk(pages))
+
+    assert counter.offsets_calls == 2
+    for ch in chunks:
+        words = ch.text.split()
+        assert ch.tokens == len(words) <= 30
+        assert ch.text.endswith(".") or ch is chunks[-1] or chunks[chunks.index(ch) + 1].page != ch.page
+        assert pages[0].text[ch.meta["start"]:ch.meta["end"]] == ch.text
+    page1 = [ch for ch in chunks if ch.page == 1]
+    assert page1[0].meta["start"] == 0 and page1[-1].meta["end"] == len(pages[0].text)
+    assert all(b.meta["start"] < a.meta["end"] for a, b in zip(page1, page1[1:]))  # перекрытие
+
+
+def test_context_label_of_widely_duplicated_chunk_stays_within_budget():
+    # колонтитул на каждой странице a.pdf и в 150 других документах
+    sources = [{"source": "a.pdf", "page": p} for p in range(1, 51)] + [{"source": "a.pdf", "page": 50}]
+    sources += [{"source": f"doc{i}.txt", "page": None} for i in range(150)]
+    text = "Конфиденциально. Не для распространения."
+
+    with tempfile.TemporaryDirectory() as d:
+        store = JsonVectorStore(str(Path(d) / "rag.json"))
+        embedder = HashingEmbedder()
+        store.upsert(
+            [DocumentChunk(id="f", text=text, source="a.pdf", page=1, meta={"sources": sources})],
+            embedder.embed([text]),
+        )
+        aug = RagAugmentor(
+            store=store, embedder=embedder, counter=ApproxTokenCounter(), top_k=1, max_rag_tokens=250, mode="always",
+        )
+        convo = Conversation(conversation_id="c", messages=[
+            Message(id="u", role="user", content=text, created_at=datetime.now(timezone.utc), meta={}),
+        ])
+        (rc,) = [m for m in aug.augment(convo, list(convo.messages)) if m.meta.get("type") == "retrieved_context"]
+
+        assert text in rc.content and rc.meta["tokens"] <= 250
+        assert "[a.pdf:p1-50, doc0.txt, doc1.txt, ещё 148]" in rc.content
+        assert rc.meta["sources"] == ["a.pdf:p1-50"] + [f"doc{i}.txt" for i in range(150)]
@@ -0,0 +1,542 @@
+import random
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from chat_engine.adapters.vector_store_json import JsonVectorStore
+from chat_engine.domain.rag_models import DocumentChunk, SearchFilter
+
+np = pytest.importorskip("numpy")
+
+
+def _random_corpus(n: int, dim: int, seed: int = 0):
+    rnd = random.Random(seed)
+    chunks = [
+        DocumentChunk(id=f"c{i}", text=f"text {i}", source=f"doc{i % 3}.txt", tokens=2)
+        for i in range(n)
+    ]
+    vectors = []
+    for _ in range(n):
+        v = [rnd.uniform(-1.0, 1.0) for _ in range(dim)]
+        norm = sum(x * x for x in v) ** 0.5
+        vectors.append([x / norm for x in v])
+    return chunks, vectors
+
+
+def test_numpy_store_matches_json_store_and_persists():
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(50, 16)
+        ref = JsonVectorStore(str(d / "ref.json"))
+        ref.upsert(chunks, vectors)
+        store = NumpyVectorStore(str(d / "np.json"))
+        store.upsert(chunks, vectors)
+
+        q = vectors[7]
+        assert [c.id for c in store.search(q, top_k=5)] == [c.id for c in ref.search(q, top_k=5)]
+
+        store.upsert([chunks[0]], [vectors[1]])
+        assert store.count() == 50
+
+        assert store.delete_by_source("DOC0.txt") == 17
+        reloaded = NumpyVectorStore(str(d / "np.json"))
+        assert reloaded.count() == 33
+        assert all(c.source != "doc0.txt" for c in reloaded.search(q, top_k=50))
+
+
+def test_mmap_store_segments_tombstones_and_compaction():
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(40, 8, seed=1)
+        ref = NumpyVectorStore(str(d / "ref.json"))
+        ref.upsert(chunks, vectors)
+
+        store = MmapVectorStore(str(d / "seg"))
+        store.upsert(chunks[:20], vectors[:20])
+        store.upsert(chunks[15:], vectors[15:])
+        assert store.count() == 40
+
+        q = vectors[3]
+        assert [c.id for c in store.search(q, top_k=6)] == [c.id for c in ref.search(q, top_k=6)]
+
+        assert store.delete_by_source("doc1.txt") == ref.delete_by_source("doc1.txt")
+        reopened = MmapVectorStore(str(d / "seg"))
+        assert reopened.count() == ref.count()
+        assert [c.id for c in reopened.search(q, top_k=6)] == [c.id for c in ref.search(q, top_k=6)]
+
+        stats = reopened.compact()
+        assert stats["segments_after"] == 1
+        assert MmapVectorStore(str(d / "seg")).count() == ref.count()
+
+
+def test_mmap_store_merges_segments_by_size_tier_and_tombstone_ratio():
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(400, 8, seed=5)
+        ref = NumpyVectorStore(str(d / "ref.json"))
+        store = MmapVectorStore(str(d / "seg"), merge_factor=4, max_dead_ratio=0.3)
+        for lo in range(0, 400, 4):  # 100 батчей
+            store.upsert(chunks[lo : lo + 4], vectors[lo : lo + 4])
+            ref.upsert(chunks[lo : lo + 4], vectors[lo : lo + 4])
+            # на каждом уровне меньше merge_factor сегментов
+            assert all(sum(store._tier(seg) == t for seg in store._segments) < 4 for t in range(6))
+        assert len(store._segments) <= 12
+        assert len(list((d / "seg").glob("*.vec"))) == len(store._segments)
+
+        store.delete_by_source("doc0.txt")
+        ref.delete_by_source("doc0.txt")
+        assert all(seg.rows - seg.live() <= 0.3 * seg.rows for seg in store._segments)
+        q = vectors[8]
+        assert [c.id for c in store.search(q, top_k=7)] == [c.id for c in ref.search(q, top_k=7)]
+        assert store.vectors(["c9", "c10"]) == [None, pytest.approx(vectors[10])]
+
+        reopened = MmapVectorStore(str(d / "seg"), merge_factor=4)
+        assert reopened.count() == ref.count() == 266
+        assert [c.id for c in reopened.search(q, top_k=7)] == [c.id for c in ref.search(q, top_k=7)]
+
+
+def test_ivf_store_trains_probes_and_reloads():
+    from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(200, 8, seed=2)
+        store = IvfVectorStore(str(d / "ivf.json"), nlist=4, nprobe=4, min_points_per_list=8)
+        store.upsert(chunks, vectors)
+        assert store._centroids is not None
+
+        ref = JsonVectorStore(str(d / "ref.json"))
+        ref.upsert(chunks, vectors)
+        q = vectors[11]
+        # nprobe == nlist -> сканируются все списки, результат точный
+        assert [c.id for c in store.search(q, top_k=5)] == [c.id for c in ref.search(q, top_k=5)]
+
+        store.nprobe = 1
+        assert store.search(q, top_k=1)[0].id == "c11"
+
+        store.delete_by_source("doc2.txt")
+        reloaded = IvfVectorStore(str(d / "ivf.json"), nlist=4, nprobe=4)
+        assert reloaded._centroids is not None
+        assert reloaded.count() == store.count()
+
+
+def test_ivf_batches_append_assignments_instead_of_rewriting_index():
+    from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(120, 8, seed=4)
+        store = IvfVectorStore(str(d / "ivf.json"), nlist=4, nprobe=4, min_points_per_list=8, retrain_growth=100.0)
+        store.upsert(chunks[:40], vectors[:40])
+        index, log = d / "ivf.json.ivf.npz", d / "ivf.json.ivf.log"
+        trained_at = index.stat().st_mtime_ns
+        for lo in range(40, 120, 20):
+            store.upsert(chunks[lo : lo + 20], vectors[lo : lo + 20])
+        store.delete_ids(["c5", "c50"])
+        store.upsert(chunks[7:8], [vectors[90]])  # тот же id, новый вектор -> новое назначение в логе
+        assert index.stat().st_mtime_ns == trained_at
+        assert len(log.read_text(encoding="utf-8").splitlines()) == 5
+
+        def lists(s):
+            return {ch.id: int(a) for ch, a in zip(s._chunks, s._assign)}
+
+        reloaded = IvfVectorStore(str(d / "ivf.json"), nlist=4, nprobe=4, min_points_per_list=8)
+        assert reloaded.count() == 118
+        assert lists(reloaded) == lists(store)
+
+        # оборванная последняя дельта: её строки назначаются по центроидам заново
+        log.write_text(log.read_text(encoding="utf-8")[:-10], encoding="utf-8")
+        assert lists(IvfVectorStore(str(d / "ivf.json"), nlist=4)) == lists(store)
+
+
+def test_ivf_retrains_skewed_data_only_after_growth(monkeypatch):
+    from chat_engine.adapters import vector_store_ivf
+    from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+
+    runs = []
+    train = vector_store_ivf.train_kmeans
+
+    def counting(data, k, **kw):
+        runs.append(len(data))
+        return train(data, k, **kw)
+
+    monkeypatch.setattr(vector_store_ivf, "train_kmeans", counting)
+    with tempfile.TemporaryDirectory() as d:
+        path = str(Path(d) / "ivf.json")
+        chunks, vectors = _random_corpus(40, 8, seed=7)
+        store = IvfVectorStore(path, nlist=4, min_points_per_list=4, imbalance=2.0, retrain_growth=1.5)
+        store.upsert(chunks[:16], vectors[:16])
+        # дальше — почти одинаковые векторы: один список всегда перекошен, k-means этого не исправит
+        base = vectors[0]
+        for lo in range(16, 40, 2):
+            store.upsert(chunks[lo : lo + 2], [[x + 1e-4 * i for x in base] for i in (lo, lo + 1)])
+            store.wait_for_retrain()
+        assert store._is_unbalanced()
+        assert runs == [16, 24, 36]
+
+        reloaded = IvfVectorStore(path, nlist=4, min_points_per_list=4, imbalance=2.0, retrain_growth=1.5)
+        assert reloaded._trained_n == 36 and runs == [16, 24, 36]
+
+
+def test_hnsw_store_incremental_tombstones_and_persisted_graph():
+    from chat_engine.adapters.vector_store_hnsw import HnswVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(150, 8, seed=3)
+        store = HnswVectorStore(str(d / "hnsw.json"), m=8, ef_construction=64, ef_search=64)
+        store.upsert(chunks[:100], vectors[:100])
+        store.upsert(chunks[100:], vectors[100:])
+        ref = JsonVectorStore(str(d / "ref.json"))
+        ref.upsert(chunks, vectors)
+
+        for i in (0, 42, 123):
+            q = vectors[i]
+            got = {c.id for c in store.search(q, top_k=5)}
+            want = {c.id for c in ref.search(q, top_k=5)}
+            assert len(got & want) >= 4
+
+        removed = store.delete_by_source("doc0.txt")
+        assert removed == 50 and store.count() == 100
+        assert all(c.source != "doc0.txt" for c in store.search(vectors[0], top_k=10))
+
+        graph_mtime = Path(str(d / "hnsw.json") + ".hnsw.npz").stat().st_mtime_ns
+        reloaded = HnswVectorStore(str(d / "hnsw.json"), m=8)
+        assert reloaded.count() == 100
+        assert Path(str(d / "hnsw.json") + ".hnsw.npz").stat().st_mtime_ns == graph_mtime
+        assert reloaded.search(vectors[1], top_k=1)[0].id == "c1"
+
+
+def test_hnsw_batches_append_graph_deltas_and_reload_the_same_graph():
+    from chat_engine.adapters.vector_store_hnsw import HnswVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        path = str(Path(d) / "hnsw.json")
+        graph, log = Path(path + ".hnsw.npz"), Path(path + ".hnsw.log")
+        chunks, vectors = _random_corpus(120, 8, seed=5)
+        store = HnswVectorStore(path, m=6, ef_construction=32, rebuild_ratio=0.9)
+        store.upsert(chunks[:40], vectors[:40])
+        snapshot = graph.read_bytes()
+
+        for lo in range(40, 120, 20):
+            store.upsert(chunks[lo : lo + 20], vectors[lo : lo + 20])
+        store.upsert([chunks[3]], [vectors[7]])  # замена: tombstone + новый узел
+        store.delete_ids(["c50"])
+        assert graph.read_bytes() == snapshot
+        assert len(log.read_text(encoding="utf-8").splitlines()) == 6
+
+        reloaded = HnswVectorStore(path, m=6, ef_construction=32, rebuild_ratio=0.9)
+        assert graph.read_bytes() == snapshot  # граф собран из npz + дельт, без перестройки
+        assert reloaded._links == store._links and reloaded._entry == store._entry
+        assert reloaded._dead == store._dead and np.array_equal(reloaded._vecs[: reloaded._n], store._vecs[: store._n])
+        assert store._n_dead == reloaded._n_dead == 2
+        for i in (0, 77, 119):
+            assert [c.id for c in reloaded.search(vectors[i], top_k=5)] == [c.id for c in store.search(vectors[i], top_k=5)]
+
+        store.compact()
+        assert not log.exists() and HnswVectorStore(path, m=6).count() == 119
+
+
+@pytest.mark.parametrize("quantization", ["int8", "pq"])
+def test_mmap_store_quantized_search_with_rerank(quantization):
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(300, 16, seed=4)
+        store = MmapVectorStore(str(d / "seg"), quantization=quantization, pq_m=4, rerank=40)
+        store.upsert(chunks, vectors)
+        ref = JsonVectorStore(str(d / "ref.json"))
+        ref.upsert(chunks, vectors)
+
+        for i in (5, 77, 250):
+            got = [c.id for c in store.search(vectors[i], top_k=3)]
+            assert got[0] == f"c{i}"
+            assert len(set(got) & {c.id for c in ref.search(vectors[i], top_k=3)}) >= 2
+
+        reopened = MmapVectorStore(str(d / "seg"), quantization=quantization, pq_m=4, rerank=40)
+        assert reopened._quantizer is not None
+        assert reopened.search(vectors[5], top_k=1)[0].id == "c5"
+
+
+def test_mmap_quantizer_retrains_as_store_grows():
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        root = str(Path(d) / "seg")
+        chunks, vectors = _random_corpus(310, 16, seed=6)
+        # первый блок — узкий диапазон: квантователь на нём одном зажал бы остальные строки в края
+        store = MmapVectorStore(root, quantization="int8", rerank=0, retrain_growth=2.0)
+        store.upsert(chunks[:10], [[x * 0.05 for x in v] for v in vectors[:10]])
+        assert store._trained_rows == 10 and float(store._quantizer.scale.max()) < 0.001
+
+        trained = []
+        for lo in range(10, 310, 50):
+            store.upsert(chunks[lo : lo + 50], vectors[lo : lo + 50])
+            trained.append(store._trained_rows)
+        assert trained == [60, 60, 160, 160, 160, 160]
+        assert float(store._quantizer.lo.max()) < -0.3
+        hits = sum(store.search(vectors[i], top_k=1)[0].id == f"c{i}" for i in range(10, 310, 10))
+        assert hits >= 27
+
+        reopened = MmapVectorStore(root, quantization="int8", rerank=0, retrain_growth=2.0)
+        assert reopened._trained_rows == 160
+
+
+def test_search_many_matches_single_queries_across_backends():
+    from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(120, 8, seed=5)
+        stores = [
+            JsonVectorStore(str(d / "json.json")),
+            NumpyVectorStore(str(d / "np.json")),
+            IvfVectorStore(str(d / "ivf.json"), nlist=4, nprobe=2, min_points_per_list=4),
+            MmapVectorStore(str(d / "seg")),
+        ]
+        queries = [vectors[0], vectors[50], vectors[99]]
+        for store in stores:
+            store.upsert(chunks[:60], vectors[:60])
+            store.upsert(chunks[60:], vectors[60:])
+            batched = store.search_many(queries, top_k=4)
+            single = [store.search(q, top_k=4) for q in queries]
+            assert [[c.id for c in r] for r in batched] == [[c.id for c in r] for r in single]
+
+
+def test_filtered_search_matches_json_store_across_backends():
+    from chat_engine.adapters.vector_store_hnsw import HnswVectorStore
+    from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(90, 8, seed=9)
+        chunks = [
+            DocumentChunk(id=c.id, text=c.text, source=c.source, page=i % 4, meta={"lang": "ru" if i % 2 else "en"})
+            for i, c in enumerate(chunks)
+        ]
+        ref = JsonVectorStore(str(d / "ref.json"))
+        ref.upsert(chunks, vectors)
+        stores = [
+            NumpyVectorStore(str(d / "np.json")),
+            IvfVectorStore(str(d / "ivf.json"), nlist=4, nprobe=1, min_points_per_list=4),
+            HnswVectorStore(str(d / "hnsw.json"), m=4),
+            MmapVectorStore(str(d / "seg")),
+            MmapVectorStore(str(d / "seg8"), quantization="int8", rerank=90),
+        ]
+        filters = [
+            SearchFilter.build(sources=["DOC1.txt"]),
+            SearchFilter.build(sources=["doc0.txt", "doc2.txt"], pages=[1, 3]),
+            SearchFilter.build(meta={"lang": "ru"}, pages=[2]),
+            SearchFilter.build(sources=["missing.txt"]),
+        ]
+        for store in stores:
+            store.upsert(chunks[:45], vectors[:45])
+            store.upsert(chunks[45:], vectors[45:])
+            for where in filters:
+                for q in (vectors[3], vectors[60]):
+                    expected = [c.id for c in ref.search(q, top_k=5, where=where)]
+                    assert [c.id for c in store.search(q, top_k=5, where=where)] == expected
+                    assert [c.id for c in store.search_many([q], top_k=5, where=where)[0]] == expected
+
+
+def test_delete_ids_across_backends_survives_reload():
+    from chat_engine.adapters.vector_store_hnsw import HnswVectorStore
+    from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(60, 8, seed=11)
+        gone = {"c3", "c10", "c59", "missing"}
+        factories = [
+            lambda: JsonVectorStore(str(d / "json.json")),
+            lambda: NumpyVectorStore(str(d / "np.json")),
+            lambda: IvfVectorStore(str(d / "ivf.json"), nlist=4, nprobe=4, min_points_per_list=4),
+            lambda: HnswVectorStore(str(d / "hnsw.json"), m=4),
+            lambda: MmapVectorStore(str(d / "seg")),
+        ]
+        for make in factories:
+            store = make()
+            store.upsert(chunks, vectors)
+            assert store.delete_ids(sorted(gone)) == 3
+            assert store.delete_ids(["c3"]) == 0
+            for reopened in (store, make()):
+                assert reopened.count() == 57
+                hits = {c.id for c in reopened.search(vectors[3], top_k=60)}
+                assert not hits & gone and len(hits) == 57
+            if isinstance(store, JsonVectorStore):
+                store.wait_for_compaction()
+
+
+def test_searches_run_alongside_background_writes_across_backends():
+    import threading
+
+    from chat_engine.adapters.lexical_bm25 import Bm25Index
+    from chat_engine.adapters.vector_store_hnsw import HnswVectorStore
+    from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(240, 8, seed=13)
+        stores = [
+            NumpyVectorStore(str(d / "np.json")),
+            IvfVectorStore(str(d / "ivf.json"), nlist=4, nprobe=2, min_points_per_list=4),
+            HnswVectorStore(str(d / "hnsw.json"), m=4),
+            MmapVectorStore(str(d / "seg"), quantization="int8", rerank=8),
+        ]
+        bm25 = Bm25Index(str(d / "bm25.json"))
+        upload = [DocumentChunk(id=f"u{i}", text="upload", source="upload.txt", tokens=1) for i in range(3)]
+        where = SearchFilter.build(sources=["doc1.txt"])
+        for store in stores:
+            store.upsert(chunks[:20], vectors[:20])
+        bm25.add(chunks[:20])
+
+        done = threading.Event()
+        errors = []
+
+        def write() -> None:
+            try:
+                for i in range(20, 240, 20):
+                    for store in stores:
+                        store.upsert(chunks[i : i + 20], vectors[i : i + 20])
+                        store.delete_ids([f"c{i - 7}"])
+                        # как фоновая загрузка: старые чанки файла удаляются по source
+                        store.upsert(upload, vectors[:3])
+                        store.delete_by_source("upload.txt")
+                    bm25.add(chunks[i : i + 20])
+                    bm25.delete_ids([f"c{i - 7}"])
+            except Exception as e:  # pragma: no cover - падение и есть провал теста
+                errors.append(e)
+            finally:
+                done.set()
+
+        def read() -> None:
+            try:
+                while not done.is_set():
+                    for store in stores:
+                        for hit in store.search(vectors[3], top_k=5) + store.search_many([vectors[5]], top_k=3)[0]:
+                            assert hit.id.startswith(("c", "u"))
+                        for hit in store.search(vectors[4], top_k=5, where=where):
+                            assert hit.source == "doc1.txt"
+                        assert len(store.vectors(["c0", "missing"])) == 2
+                        store.count()
+                    bm25.search("text 3", top_k=5)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(60)
+        assert not errors
+        for store in stores:
+            assert store.count() == 240 - 11
+        assert bm25.count() == 240 - 11
+
+
+def test_filters_match_any_location_of_collapsed_duplicate_across_backends():
+    from chat_engine.adapters.lexical_bm25 import Bm25Index
+    from chat_engine.adapters.vector_store_hnsw import HnswVectorStore
+    from chat_engine.adapters.vector_store_ivf import IvfVectorStore
+    from chat_engine.adapters.vector_store_mmap import MmapVectorStore
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(30, 8, seed=17)
+        # c0 из doc0.txt — канонический чанк, тот же текст есть в doc1.txt (стр. 4) и dup.txt (стр. 2)
+        locs = [{"source": "doc0.txt", "page": None}, {"source": "doc1.txt", "page": 4}, {"source": "Dup.txt", "page": 2}]
+        chunks[0] = DocumentChunk(id="c0", text="общий текст", source="doc0.txt", meta={"sources": locs})
+        factories = [
+            lambda: JsonVectorStore(str(d / "json.json")),
+            lambda: NumpyVectorStore(str(d / "np.json")),
+            lambda: IvfVectorStore(str(d / "ivf.json"), nlist=2, nprobe=1, min_points_per_list=4),
+            lambda: HnswVectorStore(str(d / "hnsw.json"), m=4),
+            lambda: MmapVectorStore(str(d / "seg")),
+        ]
+        cases = [
+            (SearchFilter.build(sources=["dup.txt"]), ["c0"]),
+            (SearchFilter.build(sources=["doc1.txt"], pages=[4]), ["c0"]),
+            (SearchFilter.build(sources=["dup.txt"], pages=[4]), []),  # место должно совпасть целиком
+            (SearchFilter.build(pages=[2]), ["c0"]),
+        ]
+        for make in factories:
+            store = make()
+            store.upsert(chunks, vectors)
+            for reopened in (store, make()):
+                for where, expected in cases:
+                    hits = [c.id for c in reopened.search(vectors[0], top_k=3, where=where) if c.id == "c0"]
+                    assert hits == expected, (type(reopened).__name__, where)
+                    assert [c.id for c in reopened.search_many([vectors[0]], top_k=1, where=where)[0]][:1] == expected
+            store.delete_ids(["c0"])
+            assert store.search(vectors[0], top_k=3, where=cases[0][0]) == []
+            if isinstance(store, JsonVectorStore):
+                store.wait_for_compaction()
+
+        bm25 = Bm25Index(str(d / "bm25.json"))
+        bm25.add(chunks)
+        for where, expected in cases:
+            assert [c.id for c in bm25.search("общий текст", 3, where=where)] == expected
+
+
+def test_in_memory_backends_append_batches_to_journal_and_fold_it_when_it_outgrows_the_base():
+    from chat_engine.adapters.lexical_bm25 import Bm25Index
+    from chat_engine.adapters.vector_store_hnsw import HnswVectorStore
+    from chat_engine.adapters.vector_store_numpy import NumpyVectorStore
+
+    with tempfile.TemporaryDirectory() as d:
+        d = Path(d)
+        chunks, vectors = _random_corpus(60, 8, seed=19)
+        factories = [
+            lambda: NumpyVectorStore(str(d / "np.json")),
+            lambda: HnswVectorStore(str(d / "hnsw.json"), m=4),
+        ]
+        for make in factories:
+            store = make()
+            for i in range(0, 60, 5):
+                store.upsert(chunks[i : i + 5], vectors[i : i + 5])
+            store.delete_ids(["c1", "c2"])
+            store.delete_by_source("DOC2.txt")
+            # батчи только дописывались в журнал: базовый файл ни разу не переписан
+            assert not store.path.exists() and store._log.ops == 62
+            expected = [c.id for c in store.search(vectors[4], top_k=5)]
+            for reopened in (make(), JsonVectorStore(str(store.path))):
+                assert reopened.count() == 39
+                assert [c.id for c in reopened.search(vectors[4], top_k=5)] == expected
+
+            store._log.min_ops = 1
+            store.upsert(chunks[:3], vectors[:3])  # журнал (65 операций) перерос хранилище (41 чанк)
+            assert store.path.exists() and store._log.ops == 0 and not store._log.journal.exists()
+            assert make().count() == 41
+
+        bm25 = Bm25Index(str(d / "bm25.json"))
+        for i in range(0, 60, 5):
+            bm25.add(chunks[i : i + 5])
+        bm25.delete_ids(["c1", "c2", "missing"])
+        bm25.delete_by_source("doc2.txt")
+        assert not bm25.path.exists() and bm25._log.ops == 62
+        reopened = Bm25Index(str(d / "bm25.json"))
+        assert reopened.count() == 39 and reopened._total_len == bm25._total_len
+        assert [c.id for c in reopened.search("text 4", 5)] == [c.id for c in bm25.search("text 4", 5)]
+        bm25._log.min_ops = 1
+        bm25.add(chunks[1:2])
+        assert bm25.path.exists() and not bm25._log.journal.exists()
+        assert Bm25Index(str(d / "bm25.json")).count() == 40
@@ -154,6 +154,7 @@ class ChatEngine:
                 "chosen": m.meta.get("chosen", 0),
                 "sources": m.meta.get("sources", []),
                 "tokens": m.meta.get("tokens"),
+                "cache": m.meta.get("cache", {}),
             }
 
         resp = self.llm.generate(fitted, max_output_tokens=self.budget.reserve_output_tokens)
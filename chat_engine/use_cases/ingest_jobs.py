@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from chat_engine.use_cases.rag_indexer import IngestProgress
+
+log = logging.getLogger("chat_engine")
+
+# (пути, счётчики) -> число записанных чанков; обычно обёртка над RagIndexer.ingest_paths
+IngestRun = Callable[[List[str], IngestProgress], int]
+
+
+class IngestQueueFull(RuntimeError):
+    """В очереди уже max_pending задач (или она закрыта на остановке) — клиенту стоит повторить позже."""
+
+
+@dataclass
+class IngestJob:
+    job_id: str
+    key: str
+    paths: List[str]
+    status: str = "queued"  # queued | running | done | failed
+    progress: IngestProgress = field(default_factory=IngestProgress)
+    chunks_written: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "paths": list(self.paths),
+            "chunks_written": self.chunks_written,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress.snapshot() if self.status != "queued" else None,
+        }
+
+
+class IngestJobQueue:
+    """
+    Фоновая индексация: одновременно выполняется не больше workers задач, ждёт не больше max_pending.
+    Задачи с одним key (одно хранилище) идут строго по очереди — индексы не рассчитаны на параллельную запись:
+    следующая задача ключа отдаётся в пул, только когда завершилась предыдущая, так что ожидающие
+    не занимают воркеры и не задерживают задачи других хранилищ.
+    Из завершённых хранятся последние keep_finished (для опроса статуса).
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 64, keep_finished: int = 1000):
+        self.max_pending = max(1, int(max_pending))
+        self.keep_finished = max(0, int(keep_finished))
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="ingest")
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        # ключи, у которых задача в пуле, и очереди следующих за ней; пустая очередь удаляется вместе с ключом
+        self._waiting: Dict[str, Deque[Tuple[IngestJob, IngestRun]]] = {}
+        self._pending = 0
+        self._closed = False
+
+    def submit(self, key: str, paths: List[str], run: IngestRun) -> IngestJob:
+        with self._lock:
+            if self._closed:
+                raise IngestQueueFull("Ingest queue is closed")
+            if self._pending >= self.max_pending:
+                raise IngestQueueFull(f"Ingest queue is full ({self._pending} jobs pending)")
+            job = IngestJob(job_id=uuid.uuid4().hex, key=key, paths=list(paths))
+            self._jobs[job.job_id] = job
+            self._pending += 1
+            self._trim()
+            queue = self._waiting.get(key)
+            if queue is not None:
+                queue.append((job, run))
+                return job
+            self._waiting[key] = deque()
+        self._pool.submit(self._run, job, run)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def close(self, wait: bool = True) -> None:
+        """
+        Новые задачи больше не принимаются; ожидающие своей очереди помечаются failed,
+        запущенные дорабатывают (wait) или бросаются.
+        """
+        with self._lock:
+            self._closed = True
+            for queue in self._waiting.values():
+                while queue:
+                    job, _ = queue.popleft()
+                    job.error = "Ingest queue closed"
+                    job.finished_at = time.time()
+                    job.status = "failed"
+                    self._pending -= 1
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _run(self, job: IngestJob, run: IngestRun) -> None:
+        job.progress = IngestProgress()  # эмбеддинги/сек считаются от старта, а не от постановки в очередь
+        job.status = "running"
+        status = "failed"
+        try:
+            job.chunks_written = int(run(job.paths, job.progress))
+            status = "done"
+        except Exception as e:
+            log.exception("Ingest job %s failed", job.job_id)
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            job.status = status
+            with self._lock:
+                self._pending -= 1
+                self._trim()
+                queue = self._waiting[job.key]
+                nxt = queue.popleft() if queue else None
+                if nxt is None:
+                    del self._waiting[job.key]
+            if nxt is not None:
+                self._pool.submit(self._run, *nxt)
+
+    def _trim(self) -> None:
+        finished = [jid for jid, j in self._jobs.items() if j.finished]
+        for jid in finished[: max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[jid]
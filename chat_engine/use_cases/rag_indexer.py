@@ -1,15 +1,108 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field, replace as dc_replace
 from pathlib import Path
-from typing import Dict, List, Sequence
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 from chat_engine.domain.rag_models import DocumentChunk
 from chat_engine.ports.chunker import Chunker
-from chat_engine.ports.embeddings import Embedder
-from chat_engine.ports.loaders import DocumentLoader
+from chat_engine.ports.embedding_cache import EmbeddingCache
+from chat_engine.ports.embeddings import Embedder, SparseEmbedder, embedder_key
+from chat_engine.ports.ingest_state import IngestStateStore
+from chat_engine.ports.lexical_index import LexicalIndex
+from chat_engine.ports.loaders import DocumentLoader, PagedDocumentLoader
+from chat_engine.ports.near_duplicates import NearDuplicateIndex
 from chat_engine.ports.vector_store import VectorStore
 
+log = logging.getLogger("chat_engine")
+
+# задача пула: (путь, диапазон страниц [start, stop) или None — весь документ)
+_Task = Tuple[str, Optional[Tuple[int, int]]]
+_worker_state: Dict[str, Any] = {}
+
+
+@dataclass
+class IngestProgress:
+    """
+    Счётчики одного вызова ingest_paths; пишет поток индексации, читать можно из любого потока.
+    pages — страницы, давшие хотя бы один чанк; chunks — все чанки документов, embedded — из них посчитанные
+    (остальные уже были в хранилище
+    или схлопнуты в почти-дубликат сохранённого).
+    """
+    files_total: int = 0
+    files_done: int = 0
+    pages: int = 0
+    chunks: int = 0
+    embedded: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def snapshot(self) -> Dict[str, Any]:
+        elapsed = max(1e-9, time.monotonic() - self.started)
+        return {
+            "files_total": self.files_total,
+            "files_done": self.files_done,
+            "pages": self.pages,
+            "chunks": self.chunks,
+            "embedded": self.embedded,
+            "elapsed_s": round(elapsed, 3),
+            "embeddings_per_sec": round(self.embedded / elapsed, 1),
+        }
+
+
+def _file_state(path: str) -> Dict[str, Any]:
+    """
+    Размер, mtime и sha256 из одного открытого fd: хэш относится ровно к этому stat,
+    даже если файл по пути подменят (os.replace при повторной загрузке) посреди чтения.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": h.hexdigest()}
+
+
+def _init_worker(loaders: Dict[str, DocumentLoader], chunker: Chunker) -> None:
+    _worker_state["loaders"] = loaders
+    _worker_state["chunker"] = chunker
+
+
+def _load_and_chunk(task: _Task) -> List[DocumentChunk]:
+    """Выполняется в процессе пула: извлечение текста и чанкинг одного файла или диапазона страниц."""
+    path, pages = task
+    loader = _worker_state["loaders"][Path(path).suffix.lower().lstrip(".")]
+    if pages is None:
+        loaded = loader.load(path)
+    else:
+        loaded = loader.load_pages(path, *pages)
+    return list(_worker_state["chunker"].chunk(loaded))
+
+
+def _ordered_map(
+    submit: Callable[[_Task], "Future[List[DocumentChunk]]"],
+    tasks: Iterable[_Task],
+    window: int,
+) -> Iterator[List[DocumentChunk]]:
+    """Результаты в порядке задач; в работе не больше window задач (память ограничена окном, а не документом)."""
+    pending: Deque[Future] = deque()
+    it = iter(tasks)
+    for task in itertools.islice(it, window):
+        pending.append(submit(task))
+    while pending:
+        result = pending.popleft().result()
+        for task in itertools.islice(it, 1):
+            pending.append(submit(task))
+        yield result
+
 
 @dataclass
 class RagIndexer:
@@ -17,34 +110,363 @@ class RagIndexer:
     chunker: Chunker
     embedder: Embedder
     store: VectorStore
+    lexical: Optional[LexicalIndex] = None
+    embedding_cache: Optional[EmbeddingCache] = None
+    batch_size: int = 256  # чанков на один embed + upsert
+    checkpoints: Optional[IngestStateStore] = None
+    manifest: Optional[IngestStateStore] = None  # что уже проиндексировано: размер, mtime, sha256, id чанков, _index_key
+    workers: int = 0  # >1 — извлечение текста и чанкинг в пуле процессов
+    pages_per_task: int = 16  # размер диапазона страниц одной задачи пула (PagedDocumentLoader)
+    dedup: Optional[NearDuplicateIndex] = None  # почти-дубликаты схлопываются в один хранимый чанк
+
+    def delete_by_source(self, source: str) -> int:
+        removed = self._delete_source(source)
+        if self.manifest is not None:
+            self.manifest.clear(source)
+        return removed
+
+    def _delete_source(self, source: str) -> int:
+        removed = self.store.delete_by_source(source)
+        if self.lexical is not None:
+            self.lexical.delete_by_source(source)
+        if self.dedup is not None:
+            self._rewrite_groups(self.dedup.remove_source(source))
+        return removed
+
+    def _delete_ids(self, chunk_ids: Sequence[str]) -> None:
+        if not chunk_ids:
+            return
+        self.store.delete_ids(chunk_ids)
+        if self.lexical is not None:
+            self.lexical.delete_ids(chunk_ids)
+        if self.dedup is not None:
+            self._rewrite_groups(self.dedup.remove(chunk_ids))
+
+    def _grouped(self, canonical_id: str) -> Optional[DocumentChunk]:
+        """Канонический чанк группы; meta["sources"] — где ещё встречается тот же текст (включая его самого)."""
+        group = self.dedup.group(canonical_id) if self.dedup is not None else []
+        if not group:
+            return None
+        head = group[0]
+        meta = {k: v for k, v in head.meta.items() if k != "sources"}
+        if len(group) > 1:
+            meta["sources"] = [{"source": c.source, "page": c.page} for c in group]
+        return dc_replace(head, meta=meta)
 
-    def ingest_paths(self, paths: Sequence[str]) -> int:
-        all_chunks: List[DocumentChunk] = []
+    def _rewrite_groups(self, canonical_ids: Sequence[str]) -> None:
+        """
+        Перезапись канонических чанков с обновлённым списком источников, батчами по batch_size.
+        Текст канонического чанка не меняется, поэтому вектор берётся из хранилища, а не считается заново.
+        """
+        ids = list(canonical_ids)
+        step = max(1, int(self.batch_size))
+        for i in range(0, len(ids), step):
+            part = ids[i : i + step]
+            chunks = [ch for ch in (self._grouped(cid) for cid in part) if ch is not None]
+            if chunks:
+                self._write(chunks, stored=True)
+            if self.dedup is not None:
+                self.dedup.rewritten(part)
 
+    def _rewrite_stale(self) -> None:
+        """Группы, выросшие за файл (и за прерванные загрузки), перезаписываются один раз, а не после каждого батча."""
+        if self.dedup is not None:
+            self._rewrite_groups(self.dedup.stale())
+
+    def _collapse(self, chunks: List[DocumentChunk]) -> List[DocumentChunk]:
+        """
+        Почти-дубликаты уже сохранённых чанков не пишутся: они добавляются в группу канонического,
+        а тот перезаписывается со списком источников в конце файла (_rewrite_stale).
+        Возвращает чанки, которые надо записать.
+        """
+        if self.dedup is None:
+            return chunks
+        keep: Dict[str, DocumentChunk] = {}
+        touched: Dict[str, None] = {}
+        for ch in chunks:
+            canonical = self.dedup.find(ch.text)
+            if canonical is None or canonical == ch.id:
+                self.dedup.add(ch)
+                keep[ch.id] = ch
+            else:
+                self.dedup.add(ch, canonical_id=canonical)
+                touched[canonical] = None
+        for cid in touched:
+            if cid in keep:
+                keep[cid] = self._grouped(cid) or keep[cid]
+        return list(keep.values())
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """Эмбеддинги с постоянным кэшем: модель считает только тексты, которых ещё не видела."""
+        if self.embedding_cache is None:
+            return self.embedder.embed(texts)
+
+        vectors = self.embedding_cache.get_many(self.embedder, texts)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            fresh = self.embedder.embed(missing)
+            if len(fresh) != len(missing):
+                raise RuntimeError(f"Embedder returned {len(fresh)} vectors for {len(missing)} chunks")
+            self.embedding_cache.put_many(self.embedder, missing, fresh)
+            by_text = dict(zip(missing, fresh))
+            vectors = [v if v is not None else by_text[t] for t, v in zip(texts, vectors)]
+        return vectors
+
+    def _loader(self, path: str) -> DocumentLoader:
+        ext = Path(path).suffix.lower().lstrip(".")
+        loader = self.loaders.get(ext)
+        if loader is None:
+            raise ValueError(f"No loader for extension .{ext} (path={path})")
+        return loader
+
+    def _chunker_key(self) -> List[Any]:
+        return [
+            type(self.chunker).__qualname__,
+            getattr(self.chunker, "chunk_tokens", None),
+            getattr(self.chunker, "overlap_tokens", None),
+        ]
+
+    def _index_key(self) -> Dict[str, Any]:
+        """
+        Чем записаны чанки файла, кроме чанкера: эмбеддер, формат векторов, BM25 и dedup.
+        Если ключ манифеста с ним не совпал, записанное по файлу не годится (векторы другой модели,
+        пустой лексический индекс) — файл удаляется и индексируется заново целиком.
+        """
+        return {
+            "embedder": list(embedder_key(self.embedder)),
+            "sparse": self._sparse(),
+            "lexical": self.lexical is not None,
+            "dedup": self.dedup is not None,
+        }
+
+    def _sparse(self) -> bool:
+        return bool(getattr(self.store, "sparse", False)) and isinstance(self.embedder, SparseEmbedder)
+
+    def ingest_paths(
+        self,
+        paths: Sequence[str],
+        *,
+        replace: bool = False,
+        workers: Optional[int] = None,
+        progress: Optional[IngestProgress] = None,
+    ) -> int:
+        """
+        Потоковая загрузка: страницы -> чанки -> батчи по batch_size -> эмбеддинги -> upsert.
+        Каталоги обходятся рекурсивно (файлы с известными расширениями). Файлы, которые по манифесту
+        не менялись, пропускаются; в изменённых эмбеддятся только новые чанки, исчезнувшие удаляются.
+        В памяти не больше одного батча. После каждого батча прогресс пишется в checkpoints,
+        и прерванная загрузка того же (не изменившегося) файла продолжается с места падения.
+        Файлы, проиндексированные другим эмбеддером или без нынешних BM25/dedup (_index_key), сначала удаляются
+        и загружаются целиком заново.
+        replace — то же для всех файлов: манифест не учитывается, прежние чанки документа удаляются
+        (кроме тех, что записала прерванная загрузка той же версии файла — она продолжается).
+        workers (по умолчанию self.workers) > 1 — загрузка и чанкинг в пуле процессов по файлам
+        и диапазонам страниц; эмбеддинги и запись остаются в этом процессе, порядок чанков тот же.
+        progress — счётчики для опроса из другого потока (фоновые задачи API).
+        Возвращает число чанков, записанных этим вызовом.
+        """
+        # source чанков — str(Path(p)) (так его пишут загрузчики), по нему же удаление, checkpoints и манифест
+        # состояние файла (с sha256) снимается до загрузки: в манифест попадает хэш той версии,
+        # что была до чтения; если файл подменят во время ingest, следующий запуск увидит несовпадение
+        plan = [(path, self._loader(path)) for path in self._expand(paths)]
+        self._drop_stale([path for path, _ in plan], replace)
+        loaders = [(path, loader, state) for path, loader in plan if (state := self._changed_state(path)) is not None]
+        progress = progress if progress is not None else IngestProgress()
+        progress.files_total += len(loaders)
+        n_workers = int(self.workers if workers is None else workers)
+        if n_workers > 1 and self._picklable():
+            return self._ingest_parallel(loaders, replace, n_workers, progress)
+        return sum(
+            self._ingest_one(path, state, self.chunker.chunk(loader.load(path)), replace, progress)
+            for path, loader, state in loaders
+        )
+
+    def _expand(self, paths: Sequence[str]) -> List[str]:
+        out: List[str] = []
         for p in paths:
-            path = str(p)
-            ext = Path(path).suffix.lower().lstrip(".")
-            loader = self.loaders.get(ext)
-            if loader is None:
-                raise ValueError(f"No loader for extension .{ext} (path={path})")
+            path = Path(p)
+            if path.is_dir():
+                out.extend(
+                    str(f)
+                    for f in sorted(path.rglob("*"))
+                    if f.is_file() and f.suffix.lower().lstrip(".") in self.loaders
+                )
+            else:
+                out.append(str(path))
+        return out
+
+    def _drop_stale(self, paths: Sequence[str], replace: bool) -> None:
+        """
+        Удаляет всё записанное по файлам, чей манифест не совпал с _index_key (или все, что есть в манифесте,
+        при replace) — до первой записи: при смене модели в плотном хранилище не должны встретиться
+        векторы разной размерности.
+        """
+        if self.manifest is None:
+            return
+        index = self._index_key()
+        for path in paths:
+            entry = self.manifest.get(path)
+            if entry is not None and (replace or entry.get("index") != index):
+                self.delete_by_source(path)
+                if self.checkpoints is not None:
+                    self.checkpoints.clear(path)  # прерванная загрузка изменённой версии шла поверх удалённого
+
+    def _changed_state(self, path: str) -> Optional[Dict[str, Any]]:
+        """
+        None — файл уже проиндексирован этим же чанкером и не менялся (размер+mtime, при сомнении — sha256);
+        иначе состояние файла (_file_state) для манифеста.
+        """
+        entry = self.manifest.get(path) if self.manifest is not None else None
+        same = entry is not None and entry.get("chunker") == self._chunker_key()
+        if same:
+            st = Path(path).stat()
+            if entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:  # type: ignore[union-attr]
+                return None
+        state = _file_state(path)
+        if not same:
+            return state
+        if entry.get("size") == state["size"] and entry.get("sha256") == state["sha256"]:
+            self.manifest.put(path, {**entry, "mtime_ns": state["mtime_ns"]})  # type: ignore[union-attr]
+            return None
+        return state
+
+    def _picklable(self) -> bool:
+        try:
+            pickle.dumps((self.loaders, self.chunker))
+            return True
+        except Exception as e:
+            log.warning("Parallel ingest disabled, loaders/chunker are not picklable: %s", e)
+            return False
+
+    def _page_ranges(self, path: str, loader: DocumentLoader) -> List[Optional[Tuple[int, int]]]:
+        step = int(self.pages_per_task)
+        if step <= 0 or not isinstance(loader, PagedDocumentLoader):
+            return [None]
+        n = loader.page_count(path)
+        return [(a, min(a + step, n)) for a in range(0, n, step)] or [None]
+
+    def _ingest_parallel(
+        self,
+        loaders: List[Tuple[str, DocumentLoader, Dict[str, Any]]],
+        replace: bool,
+        n_workers: int,
+        progress: IngestProgress,
+    ) -> int:
+        plan = [(path, state, self._page_ranges(path, loader)) for path, loader, state in loaders]
+        tasks = [(path, r) for path, _, ranges in plan for r in ranges]
+        # spawn, а не fork: ingest зовут из uvicorn и фоновых задач, где живут потоки батчера, компактора
+        # и sqlite — fork копирует их захваченные блокировки; loaders/chunker и так обязаны быть picklable
+        ex = ProcessPoolExecutor(
+            n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.loaders, self.chunker),
+        )
+        try:
+            results = _ordered_map(lambda t: ex.submit(_load_and_chunk, t), tasks, 2 * n_workers)
+            total = 0
+            for path, state, ranges in plan:
+                chunks = itertools.chain.from_iterable(next(results) for _ in ranges)
+                total += self._ingest_one(path, state, chunks, replace, progress)
+            return total
+        finally:
+            ex.shutdown(cancel_futures=True)
+
+    def _ingest_one(
+        self,
+        path: str,
+        file_state: Dict[str, Any],
+        chunks: Iterable[DocumentChunk],
+        replace: bool,
+        progress: IngestProgress,
+    ) -> int:
+        key = {
+            "size": file_state["size"],
+            "mtime_ns": file_state["mtime_ns"],
+            "chunker": self._chunker_key(),
+            "index": self._index_key(),
+        }
+        entry = self.manifest.get(path) if self.manifest is not None else None
+        # id чанков выводятся из содержимого: совпавший id — тот же текст на том же месте, он уже в хранилище
+        stored = set(entry.get("ids", [])) if entry is not None else set()
+
+        state = self.checkpoints.get(path) if self.checkpoints is not None else None
+        skip = 0
+        if state is not None:
+            if state.get("key") == key:
+                skip = int(state.get("done", 0))
+            else:
+                self._delete_source(path)  # недогруженная старая версия файла
+                stored = set()
+        if skip == 0 and replace and entry is None:
+            self._delete_source(path)  # чанки, о которых манифест не знает
+        if self.checkpoints is not None:
+            self.checkpoints.put(path, {"key": key, "done": skip})
+
+        ids: List[str] = []
+        written = 0
+        batch: List[DocumentChunk] = []
+        page: Any = object()
+        for ch in chunks:
+            ids.append(ch.id)
+            progress.chunks += 1
+            if ch.page != page:
+                page = ch.page
+                progress.pages += 1
+            if len(ids) <= skip or ch.id in stored:
+                continue  # уже в хранилище; эмбеддинги не считаем
+            batch.append(ch)
+            if len(batch) >= max(1, int(self.batch_size)):
+                written += self._flush(batch, progress)
+                batch = []
+                if self.checkpoints is not None:
+                    self.checkpoints.put(path, {"key": key, "done": len(ids)})
+        if batch:
+            written += self._flush(batch, progress)
+        self._rewrite_stale()
+
+        self._delete_ids(sorted(stored - set(ids)))
+        if self.manifest is not None:
+            self.manifest.put(path, {**key, "sha256": file_state["sha256"], "ids": ids})
+        if self.checkpoints is not None:
+            self.checkpoints.clear(path)
+        progress.files_done += 1
+        return written
 
-            pages = loader.load(path)
-            chunks = list(self.chunker.chunk(pages))
-            all_chunks.extend(chunks)
+    def _flush(self, batch: List[DocumentChunk], progress: IngestProgress) -> int:
+        stored = self._collapse(batch)
+        if stored:
+            self._write(stored)
+        progress.embedded += len(stored)
+        return len(stored)
 
-        if not all_chunks:
-            return 0
+    def _stored_vectors(self, chunks: List[DocumentChunk]) -> List[List[float]]:
+        """Векторы из хранилища по id; чего там нет (дубликат, занявший место удалённого) — эмбеддится."""
+        vectors = self.store.vectors([c.id for c in chunks])
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            for i, v in zip(missing, self._embed([chunks[i].text for i in missing])):
+                vectors[i] = v
+        return vectors  # type: ignore[return-value]
 
-        vectors = self.embedder.embed([c.text for c in all_chunks])
+    def _write(self, chunks: List[DocumentChunk], stored: bool = False) -> None:
+        """Эмбеддинги + upsert в хранилище и лексический индекс; stored — тексты уже в хранилище под теми же id."""
+        texts = [c.text for c in chunks]
+        if self._sparse():
+            # без плотных векторов: память O(токенов); кэш эмбеддингов не нужен — hashing дешевле sqlite
+            self.store.upsert_sparse(chunks, self.embedder.embed_sparse(texts))
+        else:
+            vectors = self._stored_vectors(chunks) if stored else self._embed(texts)
 
-        if len(vectors) != len(all_chunks):
-            raise RuntimeError(f"Embedder returned {len(vectors)} vectors for {len(all_chunks)} chunks")
+            if len(vectors) != len(chunks):
+                raise RuntimeError(f"Embedder returned {len(vectors)} vectors for {len(chunks)} chunks")
 
-        dim = getattr(self.embedder, "dim", None)
-        if isinstance(dim, int) and dim > 0:
-            for v in vectors:
-                if len(v) != dim:
-                    raise RuntimeError(f"Vector dim mismatch: got {len(v)} expected {dim}")
+            dim = getattr(self.embedder, "dim", None)
+            if isinstance(dim, int) and dim > 0:
+                for v in vectors:
+                    if len(v) != dim:
+                        raise RuntimeError(f"Vector dim mismatch: got {len(v)} expected {dim}")
 
-        self.store.upsert(all_chunks, vectors)
-        return len(all_chunks)
+            self.store.upsert(chunks, vectors)
+        if self.lexical is not None:
+            self.lexical.add(chunks)